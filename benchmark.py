@@ -0,0 +1,405 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks the client against the fake Riak node, no live server needed.
+
+    python benchmark.py                     # Everything, over HTTP
+    python benchmark.py -n 5000 small_get   # Just one workload
+    python benchmark.py --transport pbc --json > before.json
+
+The fake node runs in a child process, so it doesn't fight the client for
+the GIL or show up in its numbers. Every workload goes through Client,
+Bucket, RObject or MapReduce, like an application would, except for the
+micro benchmarks of a single hot spot (parse_headers, build_request). For
+each one, this reports:
+
+    ops/s     operations (objects, for bulk ingest) per second.
+    p50..p99  latency of an operation, in milliseconds.
+    objs/op   gc tracked objects an operation (an object, for bulk ingest)
+              leaves behind, with the collector off: the garbage cycles it
+              makes plus whatever it keeps. Python 2 has no tracemalloc,
+              this is the closest allocation count there is.
+    rss       growth of the peak resident size over the run, in KB.
+"""
+
+from riak2 import Client, ChunkedBucket, serializers
+from riak2.core import HttpTransport, PbcTransport, HistogramCollector, Histogram
+from fake_riak import FakeHttpServer, FakePbcServer
+from collections import OrderedDict
+import argparse
+import gc
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+class Workload(object):
+    """One thing to measure.
+
+    setup() runs once, before the clock starts. run(i) is the i-th
+    operation. It returns how many objects it dealt with, which is what
+    throughput is counted in.
+    """
+
+    name = None
+    # Fraction of -n this workload runs, for the slow ones.
+    scale = 1.0
+
+    def __init__(self, client, options):
+        self.client = client
+        self.options = options
+        self.bucket = client.bucket("bench_%s" % self.name)
+
+    def setup(self):
+        pass
+
+    def run(self, i):
+        raise NotImplementedError
+
+    def fill(self, count, data=None, indexes=False):
+        for obj, result in self.bucket.multistore(self.objects(count, data, indexes),
+                                                  return_body=False):
+            if isinstance(result, Exception):
+                raise result
+
+    def objects(self, count, data=None, indexes=False):
+        for i in xrange(count):
+            obj = self.bucket.new("key%d" % i, {"i": i} if data is None else data)
+            if indexes:
+                obj.add_index("n_int", i)
+                obj.add_index("group_bin", "g%d" % (i % 10))
+            yield obj
+
+
+class Ping(Workload):
+    name = "ping"
+
+    def run(self, i):
+        self.client.is_alive()
+        return 1
+
+
+class SmallPut(Workload):
+    name = "small_put"
+
+    def run(self, i):
+        self.bucket.new("key%d" % i, {"i": i, "name": "small"}).store()
+        return 1
+
+
+class SmallGet(Workload):
+    name = "small_get"
+
+    def setup(self):
+        self.fill(100)
+
+    def run(self, i):
+        self.bucket.get("key%d" % (i % 100))
+        return 1
+
+
+class LargePut(Workload):
+    name = "large_put"
+    scale = 0.1
+
+    def setup(self):
+        self.value = "x" * self.options.size
+
+    def run(self, i):
+        self.bucket.new("key%d" % (i % 10), self.value, "text/plain").store(return_body=False)
+        return 1
+
+
+class LargeGet(Workload):
+    name = "large_get"
+    scale = 0.1
+
+    def setup(self):
+        self.fill(10, "x" * self.options.size)
+
+    def run(self, i):
+        self.bucket.get("key%d" % (i % 10))
+        return 1
+
+
+class ChunkedPut(Workload):
+    """large_put, through a ChunkedBucket."""
+
+    name = "chunked_put"
+    scale = 0.1
+
+    def setup(self):
+        self.value = "x" * self.options.size
+        # Nobody reads what's replaced: it goes right away, as it's put.
+        self.files = ChunkedBucket(self.bucket, self.options.chunk_size, grace=0)
+
+    def run(self, i):
+        self.files.put("key%d" % (i % 10), self.value)
+        return 1
+
+
+class ChunkedGet(ChunkedPut):
+    """large_get, through a ChunkedBucket."""
+
+    name = "chunked_get"
+
+    def setup(self):
+        ChunkedPut.setup(self)
+        for i in xrange(10):
+            ChunkedPut.run(self, i)
+
+    def run(self, i):
+        self.files.get_data("key%d" % (i % 10))
+        return 1
+
+
+class SiblingGet(Workload):
+    """A key with many siblings, all of them loaded on every get."""
+
+    name = "sibling_get"
+    scale = 0.5
+
+    def setup(self):
+        self.bucket.set_properties(allow_mult=True)
+        for i in xrange(self.options.siblings):
+            # No vclock, so every store makes a sibling.
+            self.bucket.new("key", {"sibling": i}).store(return_body=False)
+
+    def run(self, i):
+        obj = self.bucket.get("key")
+        assert len(obj.siblings) == self.options.siblings
+        return 1
+
+
+class IndexQuery(Workload):
+    name = "index"
+    scale = 0.5
+
+    def setup(self):
+        self.fill(1000, indexes=True)
+
+    def run(self, i):
+        if i % 2:
+            keys = self.bucket.index("group_bin", "g%d" % (i % 10))
+        else:
+            start = i % 900
+            keys = self.bucket.index("n_int", start, start + 99)
+        assert len(keys) == 100
+        return 1
+
+
+class MapReduceJob(Workload):
+    name = "mapreduce"
+    scale = 0.2
+
+    def setup(self):
+        self.fill(100)
+
+    def run(self, i):
+        self.client.add(self.bucket.name).map("Riak.mapValuesJson") \
+                   .reduce("riak_kv_mapreduce:reduce_identity").run()
+        return 1
+
+
+class BulkIngest(Workload):
+    """multistore(), batch after batch. Latencies are of the single stores."""
+
+    name = "bulk_ingest"
+    scale = 0.1
+    batch = 100
+
+    def run(self, i):
+        objects = (self.bucket.new("key%d" % (i * self.batch + j), {"j": j})
+                   for j in xrange(self.batch))
+        for obj, result in self.bucket.multistore(objects, return_body=False):
+            if isinstance(result, Exception):
+                raise result
+        return self.batch
+
+
+class ParseHeaders(Workload):
+    """Micro benchmark: HttpTransport parsing the headers of an object with
+    many indexes and links. Nothing goes over the network, whatever the
+    transport."""
+
+    name = "parse_headers"
+
+    def setup(self):
+        self.transport = HttpTransport()
+        headers = {"http_code": 200, "content-type": "application/json",
+                   "x-riak-vclock": "a85hYGBgzGDKBVIcypz/fgaUHjmdwZTImMfKkD3z10m+LAA=",
+                   "etag": "6dQBm9oYA1mxRSH0e96l5W", "last-modified": "Sat, 12 May 2012 17:05:41 GMT",
+                   "link": ", ".join('</riak/friends/user%d>; riaktag="friend"' % i
+                                    for i in xrange(100))}
+        for i in xrange(20):
+            headers["x-riak-index-tag%d_bin" % i] = ", ".join("value%d" % j for j in xrange(10))
+            headers["x-riak-index-score%d_int" % i] = ", ".join(str(j) for j in xrange(10))
+            headers["x-riak-meta-m%d" % i] = "meta%d" % i
+        self.response = (headers, "{}")
+
+    def run(self, i):
+        self.transport._parse_response(self.response, 200)
+        return 1
+
+
+class BuildRequest(Workload):
+    """Micro benchmark: HttpTransport building the URLs and headers of a get
+    and of a put with links, indexes and usermeta, over 100 keys. Nothing
+    goes over the network, whatever the transport."""
+
+    name = "build_request"
+
+    def setup(self):
+        self.transport = HttpTransport()
+        self.meta = {"content_type": "application/json",
+                     "links": [("friends", "user%d" % i, "friend") for i in xrange(5)],
+                     "indexes": [("tag_bin", "a"), ("tag_bin", "b"), ("score_int", 10)],
+                     "usermeta": {"owner": "me"}}
+
+    def run(self, i):
+        key = "key%d" % (i % 100)
+        self.transport._build_rest_path("bench_bucket", key, {"r": "quorum"})
+        self.transport._build_rest_path("bench_bucket", key, {"returnbody": "true", "w": 2})
+        self.transport.make_put_header(**self.meta)
+        return 1
+
+
+WORKLOADS = OrderedDict((w.name, w) for w in (Ping, SmallPut, SmallGet, LargePut, LargeGet,
+                                              ChunkedPut, ChunkedGet, SiblingGet,
+                                              IndexQuery, MapReduceJob,
+                                              BulkIngest, ParseHeaders, BuildRequest))
+
+def bench(workload, n):
+    """Runs workload n times.
+
+    :rtype: A dictionary of the results.
+    """
+    workload.setup()
+    for i in xrange(min(n, 10)): # Warm up connections and caches.
+        workload.run(i)
+
+    # The stores multistore makes are timed by the instrumentation.
+    bulk = isinstance(workload, BulkIngest)
+    collector = HistogramCollector()
+    if bulk:
+        workload.client.instrument = collector
+    histogram = Histogram()
+    objects = 0
+
+    gc.collect()
+    gc.disable()
+    tracked = len(gc.get_objects())
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    try:
+        for i in xrange(n):
+            op_start = time.time()
+            objects += workload.run(i)
+            histogram.add(time.time() - op_start)
+        elapsed = time.time() - start
+        leftover = len(gc.get_objects()) - tracked
+    finally:
+        gc.enable()
+        workload.client.instrument = None
+
+    if bulk:
+        stats = collector.stats()["store"]
+    else:
+        stats = histogram.summary()
+    return OrderedDict([
+        ("workload", workload.name),
+        ("ops", objects),
+        ("ops/s", objects / elapsed),
+        ("p50", stats["p50"] * 1000),
+        ("p95", stats["p95"] * 1000),
+        ("p99", stats["p99"] * 1000),
+        ("max", stats["max"] * 1000),
+        ("objs/op", leftover / float(objects)),
+        ("rss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss),
+    ])
+
+def serve(server_class, ports, stop):
+    server = server_class().start()
+    ports.put(server.port)
+    stop.wait()
+    server.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the client against the fake Riak node.")
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help="What to run, out of %s. Defaults to all." % ", ".join(WORKLOADS))
+    parser.add_argument("-n", type=int, default=2000,
+                        help="Operations per workload, before the workload's own scaling.")
+    parser.add_argument("--transport", choices=("http", "pbc"), default="http")
+    parser.add_argument("--size", type=int, default=256 * 1024,
+                        help="Value size of the large workloads, in bytes.")
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024,
+                        help="Chunk size of the chunked workloads, in bytes.")
+    parser.add_argument("--siblings", type=int, default=20,
+                        help="Siblings of the sibling_get key.")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Stores in flight in bulk_ingest.")
+    parser.add_argument("--compression", choices=sorted(serializers.COMPRESSORS),
+                        help="Compress bodies of 1KB or more with this content encoding.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    options = parser.parse_args(argv)
+
+    names = options.workloads or WORKLOADS.keys()
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error("unknown workload %s" % name)
+
+    server_class, transport_class = (FakeHttpServer, None) if options.transport == "http" \
+                                    else (FakePbcServer, PbcTransport)
+    ports = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(server_class, ports, stop))
+    server.daemon = True
+    server.start()
+    try:
+        kwargs = {"port": ports.get(timeout=10)}
+        if transport_class is not None:
+            kwargs["transport_class"] = transport_class
+        client = Client(**kwargs)
+        client.concurrency = options.concurrency
+        client.compression = options.compression
+
+        results = []
+        for name in names:
+            workload = WORKLOADS[name](client, options)
+            results.append(bench(workload, max(int(options.n * workload.scale), 1)))
+            if not options.json:
+                print_result(results[-1], len(results) == 1)
+    finally:
+        stop.set()
+        server.join(5)
+
+    if options.json:
+        json.dump(results, sys.stdout, indent=2)
+        print
+
+def print_result(result, header):
+    columns = "%-12s %8s %10s %8s %8s %8s %8s %8s %8s"
+    if header:
+        print columns % tuple(result.keys())
+    print columns % (result["workload"], result["ops"], "%.0f" % result["ops/s"],
+                     "%.2f" % result["p50"], "%.2f" % result["p95"], "%.2f" % result["p99"],
+                     "%.2f" % result["max"], "%.2f" % result["objs/op"], result["rss"])
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,721 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""An in-process fake of a Riak node, for tests.
+
+FakeRiak is the storage: a dictionary of buckets with just enough of Riak's
+semantics (vclocks, siblings with allow_mult, 2i, a few builtin map reduce
+functions) for the client to be exercised end to end. FakePbcServer speaks the
+PB protocol on top of it, FakeHttpServer the HTTP one.
+
+    server = FakePbcServer().start()
+    client = riak2.Client(port=server.port, transport_class=PbcTransport)
+    ...
+    server.stop()
+"""
+
+from riak2.core import riakpb
+from email.utils import formatdate
+from urllib import quote_plus, unquote_plus
+import BaseHTTPServer
+import SocketServer
+import ast
+import base64
+import itertools
+import json
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import urlparse
+
+DEFAULT_PROPS = {
+    "n_val": 3,
+    "allow_mult": False,
+    "last_write_wins": False,
+    "precommit": [],
+    "postcommit": [],
+    "r": "quorum",
+    "w": "quorum",
+    "dw": "quorum",
+    "rw": "quorum",
+    "pr": 0,
+    "pw": 0,
+    "basic_quorum": False,
+    "notfound_ok": True
+}
+
+def _js_value(value):
+    """Riak.mapValuesJson runs in javascript, which is a lot more forgiving
+    than json.loads. Fall back to a python literal for things like {1 : 2}."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        value = ast.literal_eval(value)
+        if isinstance(value, dict):
+            value = dict((unicode(k), v) for k, v in value.iteritems())
+        return value
+
+class FakeRiak(object):
+    """The storage behind the fake servers.
+
+    Objects are stored as a vclock and a list of contents. A content is a
+    dictionary with value, content_type, content_encoding (None if not
+    given), links [(bucket, key, tag)], usermeta {key: value}, indexes
+    [(field, value)], vtag and last_mod.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.buckets = {}
+        self.props = {}
+        self._counter = itertools.count(1)
+
+    def _next_vclock(self):
+        return base64.b64encode("fakevclock%d" % next(self._counter))
+
+    def _next_vtag(self):
+        return "vtag%d" % next(self._counter)
+
+    def get_props(self, bucket):
+        with self.lock:
+            props = dict(DEFAULT_PROPS)
+            props.update(self.props.get(bucket, {}))
+            return props
+
+    def set_props(self, bucket, props):
+        with self.lock:
+            self.props.setdefault(bucket, {}).update(props)
+
+    def get(self, bucket, key):
+        """:rtype: vclock, contents or None"""
+        with self.lock:
+            return self.buckets.get(bucket, {}).get(key)
+
+    def put(self, bucket, key, content, vclock=None):
+        """Stores content, creating a sibling if allow_mult is on and the
+        vclock given is not the current one.
+
+        :rtype: key, vclock, contents
+        """
+        with self.lock:
+            objects = self.buckets.setdefault(bucket, {})
+            if key is None:
+                key = base64.b32encode(struct.pack("!Q", next(self._counter))).rstrip("=")
+
+            content = dict(content)
+            content["vtag"] = self._next_vtag()
+            content["last_mod"] = int(time.time())
+
+            current = objects.get(key)
+            if current is not None and self.get_props(bucket)["allow_mult"] \
+                    and vclock != current[0]:
+                contents = current[1] + [content]
+            else:
+                contents = [content]
+
+            objects[key] = (self._next_vclock(), contents)
+            return key, objects[key][0], contents
+
+    def delete(self, bucket, key):
+        with self.lock:
+            self.buckets.get(bucket, {}).pop(key, None)
+
+    def keys(self, bucket):
+        with self.lock:
+            return self.buckets.get(bucket, {}).keys()
+
+    def bucket_names(self):
+        with self.lock:
+            return [name for name, objects in self.buckets.iteritems() if objects]
+
+    def index(self, bucket, field, start, end=None):
+        is_int = field.endswith("_int")
+        if is_int:
+            start = int(start)
+            end = None if end is None else int(end)
+        results = []
+        with self.lock:
+            for key, (vclock, contents) in self.buckets.get(bucket, {}).iteritems():
+                for content in contents:
+                    for f, value in content["indexes"]:
+                        if f != field:
+                            continue
+                        if is_int:
+                            value = int(value)
+                        if (end is None and value == start) or \
+                           (end is not None and start <= value <= end):
+                            results.append((value, key))
+        results.sort()
+        return results
+
+    def index_page(self, bucket, field, start, end=None, max_results=None, continuation=None):
+        """:rtype: The (value, key) of one page of index(), and the
+                continuation of the next one, or None."""
+        results = self.index(bucket, field, start, end)
+        if continuation is not None:
+            last = tuple(json.loads(base64.urlsafe_b64decode(continuation)))
+            results = [result for result in results if result > last]
+        if max_results is None or len(results) <= max_results:
+            return results, None
+        results = results[:max_results]
+        return results, base64.urlsafe_b64encode(json.dumps(results[-1]))
+
+    def mapreduce(self, job):
+        """Runs the few builtin phases we know about.
+
+        :rtype: A list of (phase, results) for the phases with keep set.
+        """
+        inputs = job["inputs"]
+        if isinstance(inputs, basestring):
+            inputs = [[inputs, key] for key in self.keys(inputs)]
+
+        values = [list(i) for i in inputs]
+        kept = []
+        last = len(job["query"]) - 1
+        for number, phase in enumerate(job["query"]):
+            mode, spec = phase.items()[0]
+            values = getattr(self, "_" + mode)(spec, values)
+            # Like riak, the last phase is kept unless told otherwise.
+            if spec.get("keep", number == last):
+                kept.append((number, values))
+        return kept
+
+    def _map(self, spec, inputs):
+        name = spec.get("name") or "%s:%s" % (spec.get("module"), spec.get("function"))
+        results = []
+        for item in inputs:
+            obj = self.get(item[0], item[1])
+            if obj is None:
+                continue
+            value = obj[1][0]["value"]
+            if name in ("Riak.mapValuesJson",):
+                results.append(_js_value(value))
+            elif name in ("Riak.mapValues", "riak_kv_mapreduce:map_object_value"):
+                results.append(value)
+            elif "source" in spec:
+                # We can't run javascript. Anonymous functions get the
+                # identity treatment, [bucket, key].
+                results.append(item[:2])
+            else:
+                raise ValueError("Unknown map function %s" % name)
+        return results
+
+    def _reduce(self, spec, values):
+        name = spec.get("name") or "%s:%s" % (spec.get("module"), spec.get("function"))
+        if name in ("Riak.reduceSum",):
+            return [sum(values)]
+        elif name in ("riak_kv_mapreduce:reduce_identity", "Riak.reduceIdentity"):
+            return values
+        raise ValueError("Unknown reduce function %s" % name)
+
+    def _link(self, spec, inputs):
+        results = []
+        for item in inputs:
+            obj = self.get(item[0], item[1])
+            if obj is None:
+                continue
+            for bucket, key, tag in obj[1][0]["links"]:
+                if spec.get("bucket", "_") in ("_", bucket) and \
+                   spec.get("tag", "_") in ("_", tag):
+                    results.append([bucket, key, tag])
+        return results
+
+
+class _FakeServerMixin(object):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def start(self):
+        """Starts serving in a background thread. Returns self."""
+        self._requests = set()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # Kick out the clients still holding connections, so their handler
+        # threads exit rather than dying at interpreter shutdown.
+        for request in list(self._requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        deadline = time.time() + 1
+        while self._requests and time.time() < deadline:
+            time.sleep(0.005)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on us (say, half way through a stream) is fine.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.TCPServer.handle_error(self, request, client_address)
+
+    def process_request(self, request, client_address):
+        self._requests.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self._requests.discard(request)
+        SocketServer.TCPServer.shutdown_request(self, request)
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class FakePbcHandler(SocketServer.BaseRequestHandler):
+    def _recv(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.request.recv(size)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def _send(self, code, msg=None):
+        self.request.sendall(riakpb.frame(code, msg))
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            header = self._recv(5)
+            if header is None:
+                return
+            length, code = struct.unpack("!IB", header)
+            body = self._recv(length - 1) if length > 1 else ""
+            if body is None:
+                return
+            msg = riakpb.decode(riakpb.CODES[code], body) if code in riakpb.CODES else {}
+            handler = getattr(self, "on_%d" % code, None)
+            try:
+                if handler is None:
+                    raise ValueError("Unknown message code %d" % code)
+                handler(msg)
+            except Exception, e:
+                self._send(riakpb.ERROR_RESP, {"errmsg": str(e), "errcode": 0})
+
+    @property
+    def riak(self):
+        return self.server.riak
+
+    def _content(self, content):
+        result = {
+            "value": content["value"],
+            "content_type": content["content_type"],
+            "vtag": content["vtag"],
+            "last_mod": content["last_mod"],
+            "links": [{"bucket": b, "key": k, "tag": t} for b, k, t in content["links"]],
+            "usermeta": [{"key": k, "value": v} for k, v in content["usermeta"].iteritems()],
+            "indexes": [{"key": f, "value": v} for f, v in content["indexes"]]
+        }
+        if content["content_encoding"]:
+            result["content_encoding"] = content["content_encoding"]
+        return result
+
+    def on_1(self, msg): # ping
+        self._send(riakpb.PING_RESP)
+
+    def on_5(self, msg): # set client id
+        self._send(riakpb.SET_CLIENT_ID_RESP)
+
+    def on_9(self, msg): # get
+        obj = self.riak.get(msg["bucket"], msg["key"])
+        if obj is not None and msg.get("if_modified") == obj[0]:
+            self._send(riakpb.GET_RESP, {"unchanged": True})
+        elif obj is None:
+            self._send(riakpb.GET_RESP, {})
+        else:
+            self._send(riakpb.GET_RESP, {"vclock": obj[0],
+                                         "content": [self._content(c) for c in obj[1]]})
+
+    def on_11(self, msg): # put
+        content = msg["content"]
+        key, vclock, contents = self.riak.put(msg["bucket"], msg.get("key"), {
+            "value": content.get("value", ""),
+            "content_type": content.get("content_type", "application/octet-stream"),
+            "content_encoding": content.get("content_encoding"),
+            "links": [(l["bucket"], l["key"], l["tag"]) for l in content["links"]],
+            "usermeta": dict((p["key"], p.get("value", "")) for p in content["usermeta"]),
+            "indexes": [(p["key"], p["value"]) for p in content["indexes"]]
+        }, msg.get("vclock"))
+        response = {}
+        if "key" not in msg:
+            response["key"] = key
+        if msg.get("return_body"):
+            response["vclock"] = vclock
+            response["content"] = [self._content(c) for c in contents]
+        self._send(riakpb.PUT_RESP, response)
+
+    def on_13(self, msg): # delete
+        self.riak.delete(msg["bucket"], msg["key"])
+        self._send(riakpb.DEL_RESP)
+
+    def on_15(self, msg): # list buckets
+        self._send(riakpb.LIST_BUCKETS_RESP, {"buckets": self.riak.bucket_names()})
+
+    def on_17(self, msg): # list keys, streamed in small batches like riak does
+        keys = self.riak.keys(msg["bucket"])
+        for i in xrange(0, len(keys), 100):
+            self._send(riakpb.LIST_KEYS_RESP, {"keys": keys[i:i+100]})
+        self._send(riakpb.LIST_KEYS_RESP, {"done": True})
+
+    def on_19(self, msg): # get bucket
+        props = self.riak.get_props(msg["bucket"])
+        pb = {}
+        for name, value in props.iteritems():
+            if name in ("precommit", "postcommit"):
+                pb["has_" + name] = bool(value)
+                value = [{"modfun": {"module": h["mod"], "function": h["fun"]}}
+                         for h in value]
+            else:
+                value = riakpb.quorum(value)
+            pb[name] = value
+        self._send(riakpb.GET_BUCKET_RESP, {"props": pb})
+
+    def on_21(self, msg): # set bucket
+        props = {}
+        for name, value in msg["props"].iteritems():
+            if name.startswith("has_"):
+                continue
+            if name in ("precommit", "postcommit"):
+                value = [{"mod": h["modfun"]["module"], "fun": h["modfun"]["function"]}
+                         for h in value]
+            else:
+                value = riakpb.QUORUMS_REVERSED.get(value, value)
+            props[name] = value
+        self.riak.set_props(msg["bucket"], props)
+        self._send(riakpb.SET_BUCKET_RESP)
+
+    def on_23(self, msg): # map reduce
+        for phase, results in self.riak.mapreduce(json.loads(msg["request"])):
+            self._send(riakpb.MAPRED_RESP, {"phase": phase, "response": json.dumps(results)})
+        self._send(riakpb.MAPRED_RESP, {"done": True})
+
+    def on_25(self, msg): # 2i
+        if msg["qtype"] == riakpb.INDEX_EQ:
+            start, end = msg["key"], None
+        else:
+            start, end = msg["range_min"], msg["range_max"]
+        results, continuation = self.riak.index_page(msg["bucket"], msg["index"], start, end,
+                                                     msg.get("max_results"),
+                                                     msg.get("continuation"))
+        pages = [results[i:i+100] for i in xrange(0, len(results), 100)] \
+                if msg.get("stream") else [results]
+        for page in pages:
+            if msg.get("return_terms") and end is not None:
+                response = {"results": [{"key": str(value), "value": key} for value, key in page]}
+            else:
+                response = {"keys": [key for value, key in page]}
+            if msg.get("stream"):
+                self._send(riakpb.INDEX_RESP, response)
+        if msg.get("stream"):
+            response = {"done": True}
+        if continuation is not None:
+            response["continuation"] = continuation
+        self._send(riakpb.INDEX_RESP, response)
+
+
+class FakePbcServer(_FakeServerMixin, SocketServer.ThreadingTCPServer):
+    def __init__(self, riak=None, host="127.0.0.1", port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), FakePbcHandler)
+        self.riak = riak or FakeRiak()
+
+
+class FakeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer the response, BaseHTTPRequestHandler flushes it once it's done.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    _link_regex = re.compile(r'</[^/]+/([^/]+)/([^/>]+)>;\s*riaktag="([^"]*)"')
+
+    def setup(self):
+        # Like a real server, hang up on connections idle for too long.
+        self.timeout = self.server.keepalive_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        if self.server.close_connections: # Like an HTTP/1.0 proxy.
+            self.send_header("Connection", "close")
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+
+    @property
+    def riak(self):
+        return self.server.riak
+
+    def _handle(self):
+        url = urlparse.urlsplit(self.path)
+        parts = [unquote_plus(p) for p in url.path.split("/")[1:] if p]
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+        if self.headers.getheader("transfer-encoding", "").lower() == "chunked":
+            body = self._read_chunked()
+        else:
+            length = int(self.headers.getheader("content-length", 0))
+            body = self.rfile.read(length) if length else ""
+
+        try:
+            if parts == ["ping"]:
+                self._respond(200, "OK")
+            elif parts and parts[0] == "riak" and len(parts) <= 3:
+                resource = ("buckets", "bucket", "object")[len(parts) - 1]
+                handler = getattr(self, "_%s_%s" % (self.command.lower(), resource), None)
+                if handler is None:
+                    self._respond(405, "Method not allowed\n")
+                else:
+                    handler(params, body, *parts[1:])
+            elif parts[:1] == ["buckets"] and len(parts) in (5, 6) and parts[2] == "index":
+                self._get_index(params, *parts[1:])
+            elif parts == ["mapred"] and self.command == "POST":
+                self._post_mapred(params, body)
+            else:
+                self._respond(400, "Unknown resource %s %s\n" % (self.command, self.path))
+        except Exception, e:
+            self._respond(500, "%s\n" % e)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(";", 1)[0], 16)
+            if size == 0:
+                while self.rfile.readline() not in ("\r\n", "\n", ""): # Trailers
+                    pass
+                return "".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _respond(self, status, body="", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _respond_chunked(self, status, chunks, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+        self.wfile.write("0\r\n\r\n")
+
+    def _object_headers(self, vclock, content):
+        headers = [("X-Riak-Vclock", vclock),
+                   ("Content-Type", content["content_type"]),
+                   ("ETag", content["vtag"]),
+                   ("Last-Modified", formatdate(content["last_mod"], usegmt=True))]
+        if content["content_encoding"]:
+            headers.append(("Content-Encoding", content["content_encoding"]))
+        links = ['</riak/%s/%s>; riaktag="%s"' % (quote_plus(b), quote_plus(k), quote_plus(t))
+                 for b, k, t in content["links"]]
+        if links:
+            headers.append(("Link", ", ".join(links)))
+        for key, value in content["usermeta"].iteritems():
+            headers.append(("X-Riak-Meta-" + key, value))
+        indexes = {}
+        for field, value in content["indexes"]:
+            indexes.setdefault(field, []).append(str(value))
+        for field, values in indexes.iteritems():
+            headers.append(("X-Riak-Index-" + field, ", ".join(values)))
+        return headers
+
+    def _respond_object(self, status, obj, vtag=None):
+        vclock, contents = obj
+        if vtag is not None:
+            contents = [c for c in contents if c["vtag"] == vtag]
+            if not contents:
+                return self._respond(404, "not found\n")
+        if len(contents) > 1 and "multipart/mixed" in self.headers.getheader("accept", ""):
+            boundary = "fakeboundary%d" % id(self)
+            body = "".join("\r\n--%s\r\n%s\r\n\r\n%s" % (
+                               boundary,
+                               "\r\n".join("%s: %s" % h for h in self._object_headers(vclock, c)[1:]),
+                               c["value"])
+                           for c in contents) + "\r\n--%s--\r\n" % boundary
+            return self._respond(300, body, [
+                ("X-Riak-Vclock", vclock),
+                ("Content-Type", "multipart/mixed; boundary=%s" % boundary)])
+        elif len(contents) > 1:
+            body = "Siblings:\n" + "".join(c["vtag"] + "\n" for c in contents)
+            return self._respond(300, body, [("X-Riak-Vclock", vclock),
+                                             ("Content-Type", "text/plain")])
+        self._respond(status, contents[0]["value"], self._object_headers(vclock, contents[0]))
+
+    def _content_from_request(self, body):
+        links, usermeta, indexes = [], {}, []
+        for header, value in self.headers.items(): # lowered by mimetools
+            if header == "link":
+                links.extend((unquote_plus(b), unquote_plus(k), unquote_plus(t))
+                             for b, k, t in self._link_regex.findall(value))
+            elif header.startswith("x-riak-meta-"):
+                usermeta[header[12:]] = value
+            elif header.startswith("x-riak-index-"):
+                indexes.extend((header[13:], v.strip()) for v in value.split(","))
+        return {
+            "value": body,
+            "content_type": self.headers.getheader("content-type", "application/octet-stream"),
+            "content_encoding": self.headers.getheader("content-encoding"),
+            "links": links,
+            "usermeta": usermeta,
+            "indexes": indexes
+        }
+
+    def _get_buckets(self, params, body):
+        if params.get("buckets") == "stream":
+            names = self.riak.bucket_names()
+            self._respond_chunked(200, (json.dumps({"buckets": names[i:i+100]})
+                                        for i in xrange(0, len(names), 100)),
+                                  [("Content-Type", "application/json")])
+        elif params.get("buckets") == "true":
+            self._respond(200, json.dumps({"buckets": self.riak.bucket_names()}),
+                          [("Content-Type", "application/json")])
+        else:
+            self._respond(400, "buckets=true or buckets=stream required\n")
+
+    def _get_bucket(self, params, body, bucket):
+        props = {"props": self.riak.get_props(bucket)}
+        if params.get("props", "true") != "true":
+            props = {}
+        keys = params.get("keys", "false")
+        if keys == "stream":
+            def chunks():
+                if props:
+                    yield json.dumps(props)
+                all_keys = self.riak.keys(bucket)
+                for i in xrange(0, len(all_keys), 100):
+                    yield json.dumps({"keys": all_keys[i:i+100]})
+                yield json.dumps({"keys": []})
+            self._respond_chunked(200, chunks(), [("Content-Type", "application/json")])
+        else:
+            if keys == "true":
+                props["keys"] = self.riak.keys(bucket)
+            self._respond(200, json.dumps(props), [("Content-Type", "application/json")])
+
+    def _put_bucket(self, params, body, bucket):
+        self.riak.set_props(bucket, json.loads(body)["props"])
+        self._respond(204)
+
+    def _post_bucket(self, params, body, bucket):
+        key, vclock, contents = self.riak.put(bucket, None, self._content_from_request(body))
+        location = [("Location", "/riak/%s/%s" % (quote_plus(bucket), quote_plus(key)))]
+        if params.get("returnbody") == "true":
+            self._respond(201, contents[0]["value"],
+                          location + self._object_headers(vclock, contents[0]))
+        else:
+            self._respond(201, "", location)
+
+    def _get_object(self, params, body, bucket, key):
+        obj = self.riak.get(bucket, key)
+        if obj is None:
+            self._respond(404, "not found\n")
+        elif len(obj[1]) == 1 and obj[1][0]["vtag"] == self.headers.getheader("if-none-match"):
+            self._respond(304)
+        else:
+            self._respond_object(200, obj, params.get("vtag"))
+
+    def _put_object(self, params, body, bucket, key):
+        content = self._content_from_request(body)
+        key, vclock, contents = self.riak.put(bucket, key, content,
+                                              self.headers.getheader("x-riak-vclock"))
+        if params.get("returnbody") == "true":
+            self._respond_object(200, (vclock, contents))
+        else:
+            self._respond(204)
+
+    def _delete_object(self, params, body, bucket, key):
+        if self.riak.get(bucket, key) is None:
+            self._respond(404, "not found\n")
+        else:
+            self.riak.delete(bucket, key)
+            self._respond(204)
+
+    def _get_index(self, params, bucket, index, field, start, end=None):
+        max_results = params.get("max_results")
+        results, continuation = self.riak.index_page(
+            bucket, field, start, end, None if max_results is None else int(max_results),
+            params.get("continuation"))
+
+        def page(results):
+            if params.get("return_terms") == "true" and end is not None:
+                return {"results": [{str(value): key} for value, key in results]}
+            return {"keys": [key for value, key in results]}
+
+        if params.get("stream") == "true":
+            boundary = "fakeboundary%d" % id(self)
+            def chunks():
+                for i in xrange(0, len(results), 100):
+                    yield "\r\n--%s\r\nContent-Type: application/json\r\n\r\n%s" % (
+                        boundary, json.dumps(page(results[i:i+100])))
+                if continuation is not None:
+                    yield "\r\n--%s\r\nContent-Type: application/json\r\n\r\n%s" % (
+                        boundary, json.dumps({"continuation": continuation}))
+                yield "\r\n--%s--\r\n" % boundary
+            return self._respond_chunked(200, chunks(), [
+                ("Content-Type", "multipart/mixed; boundary=%s" % boundary)])
+
+        response = page(results)
+        if continuation is not None:
+            response["continuation"] = continuation
+        self._respond(200, json.dumps(response), [("Content-Type", "application/json")])
+
+    def _post_mapred(self, params, body):
+        kept = self.riak.mapreduce(json.loads(body))
+        if params.get("chunked") == "true":
+            boundary = "fakeboundary%d" % id(self)
+            def chunks():
+                for phase, values in kept:
+                    for i in xrange(0, max(len(values), 1), 100):
+                        yield "\r\n--%s\r\nContent-Type: application/json\r\n\r\n%s" % (
+                            boundary, json.dumps({"phase": phase, "data": values[i:i+100]}))
+                yield "\r\n--%s--\r\n" % boundary
+            return self._respond_chunked(200, chunks(), [
+                ("Content-Type", "multipart/mixed; boundary=%s" % boundary)])
+
+        if len(kept) == 1:
+            results = kept[0][1]
+        else:
+            results = [values for phase, values in kept]
+        self._respond(200, json.dumps(results), [("Content-Type", "application/json")])
+
+
+class FakeHttpServer(_FakeServerMixin, SocketServer.ThreadingTCPServer):
+    def __init__(self, riak=None, host="127.0.0.1", port=0, keepalive_timeout=None,
+                       close_connections=False):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), FakeHttpHandler)
+        self.riak = riak or FakeRiak()
+        self.keepalive_timeout = keepalive_timeout
+        self.close_connections = close_connections
@@ -1,5 +1,8 @@
 from bucket import Bucket
 from client import Client
+from futureclient import FutureClient
+from cache import ObjectCache
+from chunked import ChunkedBucket
 from robject import Sibling, RObject
 from mapreduce import MapReduce
 from exceptions import *
@@ -17,9 +17,9 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from copy import copy
-from utils import do_nothing
+from utils import do_nothing, concurrent_imap, Registry
 from robject import RObject
+from exceptions import ConflictError
 
 class Bucket(object):
 
@@ -44,8 +44,9 @@ class Bucket(object):
         self.transport = client.transport
         self.name = name
 
-        self.encoders = copy(client.encoders)
-        self.decoders = copy(client.decoders)
+        self.encoders = Registry(client.encoders)
+        self.decoders = Registry(client.decoders)
+        self.compressors = Registry(client.compressors)
 
     def __setattr__(self, name, value):
         if name in self.quorums.keys():
@@ -55,6 +56,8 @@ class Bucket(object):
             self.__dict__[name] = value
 
     def __getattr__(self, name):
+        if name in ("compression", "compress_threshold"): # Unless set on the bucket
+            return getattr(self.client, name)
         try:
             return self.quorums[name]
         except KeyError:
@@ -102,6 +105,82 @@ class Bucket(object):
         obj = RObject(self.client, self, key, conflict_handler)
         return obj.reload(r or self.r)
 
+    def get_stream(self, key, r=None):
+        """Gets an object's value as a file-like object, read off the
+        connection as it arrives rather than all at once. For large values.
+
+        The value is as stored: not decoded nor decompressed. Close the
+        reader (it's a context manager), or read it to the end, to let go of
+        the connection.
+
+        :param key: The key
+        :param r: The r value
+        :rtype: A reader with read(size), readinto(buffer), iteration over
+                chunks and close(), plus the object's vclock and metadata
+                as attributes. None if the object is not found.
+        """
+        result = self.client.transport.get_stream(self.name, key, r or self.r)
+        if result is None:
+            return None
+        if isinstance(result, list):
+            raise ConflictError("Multiple siblings found for %s!" % key)
+        reader = result[2]
+        reader.vclock, reader.metadata = result[0], result[1]
+        return reader
+
+    def multiget(self, keys, r=None, conflict_handler=do_nothing, concurrency=None):
+        """Gets many objects from this bucket at once. See Client.multiget
+
+        :param keys: A list of keys
+        :param r: The r value
+        :param conflict_handler: A function that handles conflict.
+        :param concurrency: Number of requests in flight.
+        :rtype: A list of RObject (or exceptions, for the keys that failed) in
+                the same order as keys.
+        """
+        return self.client.multiget([(self, key) for key in keys], r,
+                                    conflict_handler, concurrency)
+
+    def multistore(self, objects, w=None, dw=None, return_body=True, concurrency=None):
+        """Stores many objects, with up to concurrency stores in flight.
+
+        This is a generator: nothing is stored until you iterate over it.
+        objects can be a generator too, it is consumed only as fast as the
+        stores complete.
+
+        :param objects: An iterable of RObject
+        :param w: The W value
+        :param dw: The DW value
+        :param return_body: Reload the objects with what the server has.
+        :param concurrency: Number of requests in flight. Defaults to
+                            client.concurrency
+        :rtype: Yields (obj, result) as stores complete. result is obj if it
+                was stored, or the exception that was raised.
+        """
+        store = lambda obj: obj.store(w, dw, return_body)
+        return concurrent_imap(store, objects, concurrency or self.client.concurrency,
+                               self.client.executor)
+
+    def multidelete(self, keys, rw=None, concurrency=None):
+        """Deletes many keys, with up to concurrency deletes in flight.
+
+        This is a generator, like multistore.
+
+        :param keys: An iterable of keys
+        :param rw: The RW value
+        :param concurrency: Number of requests in flight. Defaults to
+                            client.concurrency
+        :rtype: Yields (key, result) as deletes complete. result is None if
+                the key was deleted, or the exception that was raised.
+        """
+        rw = rw or self.rw
+        def delete(key):
+            self.transport.delete(self.name, key, rw)
+            if self.client.cache is not None:
+                self.client.cache.invalidate(self.name, key)
+        return concurrent_imap(delete, keys, concurrency or self.client.concurrency,
+                               self.client.executor)
+
     def set_properties(self, **props):
         self.transport.set_bucket_properties(self.name, props)
 
@@ -114,8 +193,50 @@ class Bucket(object):
     def get_keys(self):
         return self.transport.get_keys(self.name)
 
-    def index(self, field, startkey, endkey=None):
-        return self.transport.index(self.name, field, startkey, endkey)
+    def stream_keys(self):
+        """Lists the keys in this bucket without holding them all in memory.
+        See Transport.stream_keys
+
+        :rtype: A generator of keys
+        """
+        return self.transport.stream_keys(self.name)
+
+    def index(self, field, startkey, endkey=None, return_terms=False, max_results=None,
+                    continuation=None):
+        """Queries a secondary index, for an exact value or a range.
+
+        :param return_terms: Give (term, key) pairs rather than keys.
+        :param max_results: The size of a page. None is everything at once.
+        :param continuation: Where the page starts, the continuation of the
+                             page before it. None is the first page.
+        :rtype: An IndexPage, a list of keys (or (term, key) pairs) with the
+                continuation of the next page.
+        """
+        results, next_continuation = self.transport.index_page(
+            self.name, field, startkey, endkey, return_terms, max_results, continuation)
+        return IndexPage(self, (field, startkey, endkey, return_terms, max_results),
+                         results, next_continuation)
+
+    def iter_index(self, field, startkey, endkey=None, return_terms=False, max_results=None,
+                         continuation=None):
+        """Like index, but the results are handed out as Riak streams them,
+        never all held in memory. With max_results, the pages are fetched
+        one after the other, until the last one. As with stream_keys,
+        stopping early closes the connection.
+
+        :rtype: A generator of keys, or (term, key) pairs.
+        """
+        while True:
+            next_continuation = None
+            for results, page_continuation in self.transport.stream_index(
+                    self.name, field, startkey, endkey, return_terms, max_results, continuation):
+                for result in results:
+                    yield result
+                if page_continuation is not None:
+                    next_continuation = page_continuation
+            if next_continuation is None:
+                return
+            continuation = next_continuation
 
     def search(self, query):
         return MapReduce(self.client).search(self.name, query)
@@ -128,7 +249,10 @@ class Bucket(object):
         :rtype: A list of RObject
         """
         results = self.transport.solr.search(self.name, query, params)
-        docs = [self.get(doc[u"id"]) for doc in results[u"response"][u"docs"]]
+        docs = self.multiget([doc[u"id"] for doc in results[u"response"][u"docs"]])
+        for doc in docs:
+            if isinstance(doc, Exception):
+                raise doc
         return docs
 
     def search_enabled(self):
@@ -159,3 +283,21 @@ class Bucket(object):
         return True
 
 from mapreduce import MapReduce
+
+
+class IndexPage(list):
+    """A page of Bucket.index results. continuation is None on the last
+    page."""
+
+    def __init__(self, bucket, query, results, continuation):
+        list.__init__(self, results)
+        self.bucket = bucket
+        self.query = query
+        self.continuation = continuation
+
+    def next_page(self):
+        """:rtype: The IndexPage after this one, or None if this is the
+                last one."""
+        if self.continuation is None:
+            return None
+        return self.bucket.index(*self.query, continuation=self.continuation)
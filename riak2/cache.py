@@ -0,0 +1,195 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from collections import OrderedDict
+import threading
+import time
+
+class ObjectCache(object):
+    """A client side, read through cache of objects, keyed by (bucket, key).
+
+    Give one to Client(cache=...) and Bucket.get() (and RObject.reload())
+    go through it. What's kept is the loaded sibling: vclock, metadata and
+    decoded data. Objects with siblings are never cached. RObject.store()
+    refreshes the entry (or drops it with return_body=False) and
+    RObject.delete() drops it. Writes made by anybody else are only seen once
+    the entry expires, unless revalidate is on.
+
+    Entries are evicted least recently used first, once there are more than
+    max_entries of them or they add up to more than max_bytes. The size of an
+    entry is the size of the body plus the headers it came with, which is a
+    rough guess of what it takes in memory.
+
+    With revalidate, instead of being dropped, entries past their ttl are
+    checked with a conditional GET (If-None-Match over HTTP, if_modified over
+    PBC): if the object hasn't changed, Riak doesn't send it again. Without a
+    ttl, that makes every hit a conditional GET, which is always up to date
+    and still saves the body and the decoding.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None, revalidate=False):
+        """
+        :param max_entries: Maximum number of objects kept. None is unbounded.
+        :param max_bytes: Maximum total size of the objects kept. None is
+                          unbounded.
+        :param ttl: Seconds an entry is good for. None keeps them until they
+                    are evicted.
+        :param revalidate: Revalidate stale entries rather than dropping them.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.revalidate = revalidate
+
+        self._lock = threading.Lock()
+        # (bucket, key): (sibling, size, expires), least recently used first.
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """:rtype: A dictionary of the counters, plus entries and bytes."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "revalidated": self.revalidated, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.bytes}
+
+    def load(self, obj, r=None):
+        """Loads obj (an RObject) from the cache, going to Riak for it if
+        need be.
+
+        :rtype: obj
+        """
+        k = (obj.bucket.name, obj.key)
+        sibling, fresh = self._lookup(k)
+        if sibling is not None and fresh:
+            return self._load_hit(k, sibling, obj)
+
+        previous = None if sibling is None else (sibling.vclock, sibling.metadata, None)
+        response = obj.client.transport.get(k[0], k[1], r, None, previous)
+        if response is not None and response is previous:
+            with self._lock:
+                self.hits += 1
+                self.revalidated += 1
+                entry = self._entries.get(k)
+                if entry is not None and entry[0] is sibling:
+                    self._entries[k] = (sibling, entry[1], self._expires())
+            return self._load_hit(k, sibling, obj)
+
+        with self._lock:
+            self.misses += 1
+        size = None if response is None or isinstance(response, list) else self._size(response)
+        obj._load_with_response(response)
+        self.update(obj, size)
+        return obj
+
+    def _load_hit(self, k, sibling, obj):
+        """Loads a copy of the cached sibling into obj. The entry's data is
+        decoded by the first hit, for the ones after it to share."""
+        copy = sibling.copy(obj)
+        if not sibling.is_decoded():
+            copy.snapshot("data")
+            decoded = copy.copy(None)
+            with self._lock:
+                entry = self._entries.get(k)
+                if entry is not None and entry[0] is sibling:
+                    self._entries[k] = (decoded,) + entry[1:]
+        return obj._load_with_sibling(copy)
+
+    def update(self, obj, size=None):
+        """Caches what obj holds now, or drops the entry if it can't be
+        cached (not found or in conflict).
+
+        :param size: The size of the entry, if known.
+        """
+        k = (obj.bucket.name, obj.key)
+        if not obj.exists or len(obj.siblings) != 1:
+            return self.invalidate(k[0], k[1])
+
+        sibling = obj.siblings.values()[0]
+        if size is None:
+            size = len(sibling.vclock or "") + len(sibling.encoded_data() or "")
+        self._put(k, sibling.copy(None), size)
+
+    def invalidate(self, bucket, key):
+        with self._lock:
+            entry = self._entries.pop((bucket, key), None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _lookup(self, k):
+        """:rtype: sibling, fresh. sibling is None on a miss."""
+        with self._lock:
+            entry = self._entries.pop(k, None)
+            if entry is None:
+                return None, False
+
+            sibling, size, expires = entry
+            fresh = expires is None or time.time() < expires
+            if fresh and self.revalidate and self.ttl is None:
+                fresh = False
+            if not fresh and not self.revalidate:
+                self.bytes -= size
+                return None, False
+
+            self._entries[k] = entry # Most recently used.
+            if fresh:
+                self.hits += 1
+            return sibling, fresh
+
+    def _put(self, k, sibling, size):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return self.invalidate(*k)
+
+        expires = self._expires()
+        with self._lock:
+            old = self._entries.pop(k, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[k] = (sibling, size, expires)
+            self.bytes += size
+
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+                  (self.max_bytes is not None and self.bytes > self.max_bytes):
+                k, (sibling, size, expires) = self._entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def _expires(self):
+        return None if self.ttl is None else time.time() + self.ttl
+
+    def _size(self, response):
+        vclock, metadata, data = response
+        size = len(vclock or "") + len(data or "")
+        for name, value in metadata.iteritems():
+            if isinstance(value, basestring):
+                size += len(name) + len(value)
+        size += sum(len(str(v)) for f, v in metadata.get("index", ()))
+        size += sum(len(b) + len(k) + len(t or "") for b, k, t in metadata.get("link", ()))
+        size += sum(len(k) + len(v) for k, v in metadata.get("usermeta", {}).iteritems())
+        return size
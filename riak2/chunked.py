@@ -0,0 +1,219 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""Values too large for a single Riak object, split into chunks.
+
+Riak doesn't do well with values over a few megabytes. A ChunkedBucket
+stores them as fixed size chunk objects, in a bucket of their own, plus a
+manifest object listing them, under the key itself:
+
+    files = ChunkedBucket(client["files"], chunk_size=1024 * 1024)
+    with open("video.mp4", "rb") as f:
+        files.put("video", f, "video/mp4")
+    with files.get("video") as reader:
+        shutil.copyfileobj(reader, out)
+
+Chunks are sent and fetched several at a time over the connection pool,
+and read back lazily: only a few of them are held in memory at once, on the
+way up or down. Every chunk is checked against the MD5 the manifest has
+for it.
+
+Every version of a value has chunk keys of its own, and the chunks of the
+version a put replaces are kept for grace seconds: a reader that got the
+old manifest reads the old value whole. They're deleted by a put or delete
+of the key after that. A reader slower than that gets ChangedError.
+"""
+
+from core.stream import ChunkReader
+from exceptions import ChangedError, IntegrityError, NotFoundError
+from robject import RObject
+from collections import deque
+import hashlib
+import time
+import uuid
+
+class ChunkedBucket(object):
+
+    CONTENT_TYPE = "application/octet-stream"
+
+    def __init__(self, bucket, chunk_size=1024 * 1024, chunk_bucket=None, concurrency=None,
+                       grace=600):
+        """
+        :param bucket: The Bucket the manifests go in.
+        :param chunk_size: Size of the chunks, in bytes.
+        :param chunk_bucket: The Bucket the chunks go in. Defaults to the
+                             bucket's name followed by "_chunks".
+        :param concurrency: Chunks in flight. Defaults to
+                            client.concurrency
+        :param grace: Seconds the chunks of a replaced value are kept for,
+                      for the readers still at it. Longer than a read takes,
+                      and than the clocks of the clients are apart.
+        """
+        self.bucket = bucket
+        self.client = bucket.client
+        self.name = bucket.name
+        self.chunk_size = chunk_size
+        self.chunk_bucket = chunk_bucket or self.client.bucket(bucket.name + "_chunks")
+        self.concurrency = concurrency or self.client.concurrency
+        self.grace = grace
+
+    def put(self, key, value, content_type=CONTENT_TYPE):
+        """Stores value, chunks first then the manifest. So a reader sees
+        either the old value or the new one, whole, if it's done within
+        grace seconds. The chunks of the old value are deleted after that.
+
+        :param value: A string, or a file-like object to read it from, from
+                      its current position to its end.
+        :rtype: The manifest: a dictionary of size, chunk_size,
+                content_type, chunks, a list of [key, md5, size], and
+                replaced, a list of [time replaced, chunks] of the versions
+                still in their grace period.
+        """
+        old = self.manifest(key)
+        version = uuid.uuid4().hex
+        chunks = []
+        replaced, expired = self._replaced(old)
+        manifest = {"size": 0, "chunk_size": self.chunk_size, "content_type": content_type,
+                    "chunks": chunks, "replaced": replaced}
+
+        def objects():
+            # Pulled by multistore as stores complete, so only the chunks in
+            # flight are in memory.
+            for data in self._split(value):
+                chunk_key = "%s/%s/%d" % (key, version, len(chunks))
+                chunks.append([chunk_key, hashlib.md5(data).hexdigest(), len(data)])
+                manifest["size"] += len(data)
+                obj = RObject(self.client, self.chunk_bucket, chunk_key)
+                obj.content_type = self.CONTENT_TYPE
+                obj.data = data
+                yield obj
+
+        try:
+            for obj, result in self.chunk_bucket.multistore(objects(), return_body=False,
+                                                            concurrency=self.concurrency):
+                if isinstance(result, Exception):
+                    raise result
+            self.bucket.new(key, manifest).store(return_body=False)
+        except Exception:
+            self._delete_chunks(chunks) # Whatever made it, nothing points to it.
+            raise
+        self._delete_chunks(expired)
+        return manifest
+
+    def _replaced(self, old):
+        """:rtype: The replaced versions of the manifest replacing old still
+                in their grace period, and the chunks of the others."""
+        if old is None:
+            return [], []
+        now = time.time()
+        replaced, expired = [], []
+        for when, chunks in old.get("replaced", []) + [[now, old["chunks"]]]:
+            if when + self.grace > now:
+                replaced.append([when, chunks])
+            else:
+                expired.extend(chunks)
+        return replaced, expired
+
+    def _split(self, value):
+        size = self.chunk_size
+        if hasattr(value, "read"):
+            while True:
+                data = value.read(size)
+                if not data:
+                    return
+                yield data
+        else:
+            for i in xrange(0, len(value), size):
+                yield value[i:i + size]
+
+    def manifest(self, key):
+        """:rtype: The manifest of key (see put), or None if not found."""
+        obj = self.bucket.get(key)
+        return obj.data if obj.exists else None
+
+    def get(self, key):
+        """Gets a value, to be read as its chunks arrive. Up to concurrency
+        chunks are fetched ahead of the reader.
+
+        :rtype: A file-like reader (read, readinto, iteration over chunks,
+                close; see Bucket.get_stream), with the manifest, size and
+                content_type as attributes. None if not found. Reading
+                raises IntegrityError if a chunk doesn't match the manifest,
+                ChangedError if the value was replaced more than grace
+                seconds ago and NotFoundError if a chunk is gone otherwise.
+        """
+        manifest = self.manifest(key)
+        if manifest is None:
+            return None
+        reader = ChunkReader(self._fetch_chunks(manifest["chunks"]))
+        reader.manifest = manifest
+        reader.size = manifest["size"]
+        reader.content_type = manifest["content_type"]
+        return reader
+
+    def get_data(self, key):
+        """:rtype: The whole value of key, or None if not found."""
+        reader = self.get(key)
+        if reader is None:
+            return None
+        with reader:
+            return reader.read()
+
+    def _fetch_chunks(self, chunks):
+        # In order, with a window of concurrency fetches in flight on the
+        # client's threads. If the reader stops early, they finish unread.
+        executor = self.client.executor
+        pending = iter(chunks)
+        window = deque()
+        for chunk in pending:
+            window.append(executor.submit(self._fetch_chunk, *chunk))
+            if len(window) >= self.concurrency:
+                break
+        while window:
+            data = window.popleft().result()
+            for chunk in pending:
+                window.append(executor.submit(self._fetch_chunk, *chunk))
+                break
+            yield data
+
+    def _fetch_chunk(self, chunk_key, md5, size):
+        obj = self.chunk_bucket.get(chunk_key)
+        if not obj.exists:
+            manifest = self.manifest(chunk_key.rsplit("/", 2)[0])
+            if manifest is None or [chunk_key, md5, size] not in manifest["chunks"]:
+                raise ChangedError("%s was replaced or deleted while it was read, and "
+                                   "its grace period is over" % chunk_key.rsplit("/", 2)[0])
+            raise NotFoundError("Chunk %s is missing" % chunk_key)
+        data = obj.get_encoded_data()
+        if len(data) != size or hashlib.md5(data).hexdigest() != md5:
+            raise IntegrityError("Chunk %s doesn't match its manifest" % chunk_key)
+        return data
+
+    def delete(self, key):
+        """Deletes the manifest, then the chunks, those of the replaced
+        versions included: there's no grace period."""
+        obj = self.bucket.get(key)
+        if obj.exists:
+            chunks = list(obj.data["chunks"])
+            for when, old in obj.data.get("replaced", []):
+                chunks.extend(old)
+            obj.delete()
+            self._delete_chunks(chunks)
+
+    def _delete_chunks(self, chunks):
+        keys = [chunk[0] for chunk in chunks]
+        for key, result in self.chunk_bucket.multidelete(keys, concurrency=self.concurrency):
+            pass # Best effort, an orphaned chunk only takes room.
@@ -18,8 +18,8 @@ from core import HttpTransport, ConnectionManager
 from bucket import Bucket
 from weakref import WeakValueDictionary
 from mapreduce import MapReduce
-import json
-import httplib
+from utils import do_nothing, concurrent_map, Executor, Registry
+import serializers
 
 
 class Client(object):
@@ -28,42 +28,75 @@ class Client(object):
     Extremely lightweight.
     """
 
-    def __init__(self, host="127.0.0.1", port=8098, mapred_prefix="mapred",
+    def __init__(self, host="127.0.0.1", port=None, mapred_prefix="mapred",
                        transport_class=HttpTransport, connection_manager=None,
-                       client_id=None):
+                       client_id=None, cache=None, retry_policy=None, deadline=None,
+                       instrument=None):
         """Construct a new instance of a client
 
         :param host: The host IP.
-        :param port: The host port.
+        :param port: The host port. Defaults to the transport's default port.
         :param mapred_prefix: URL prefix for map reduce
         :param transport_class: The transport class to be used. Defaults to HTTP
         :param connection_manager: The connection manager instance to be used,
                                    default to a http connection manager
         :param client_id: A client id, default to a random client id.
+        :param cache: An ObjectCache for Bucket.get() to read through. Defaults
+                      to None, no caching.
+        :param retry_policy: A RetryPolicy for the transport. Defaults to
+                             the transport's default.
+        :param deadline: Seconds a request may take, retries included, unless
+                         it's given its own deadline. Defaults to None, no
+                         limit. See Transport.
+        :param instrument: An Instrument to tell about every operation, such
+                           as a HistogramCollector. Defaults to None, which
+                           costs next to nothing.
         """
 
 
         if connection_manager is None:
-            connection_manager = ConnectionManager(httplib.HTTPConnection, [(host, port)])
+            port = port or transport_class.default_port
+            connection_manager = ConnectionManager(transport_class.connection_class,
+                                                   [(host, port)])
 
         self.connection_manager = connection_manager
         self.transport = transport_class(connection_manager,
                                          mapred_prefix=mapred_prefix,
-                                         client_id=client_id)
+                                         client_id=client_id,
+                                         retry_policy=retry_policy,
+                                         deadline=deadline,
+                                         instrument=instrument)
 
         self.r = "quorum"
         self.w = "quorum"
         self.dw = "quorum"
         self.rw = "quorum"
+        # Number of requests bulk operations keep in flight, on the threads
+        # of executor. They're started as needed, and kept.
+        self.concurrency = 8
+        self.executor = Executor(None)
+        self.cache = cache
         self.client_id = self.transport.client_id
-        self.encoders = {"application/json": json.dumps,
-                         "text/json": json.dumps}
-
-        self.decoders = {"application/json": json.loads,
-                         "text/json": json.loads}
+        # See serializers. Buckets fall back to these.
+        self.encoders = Registry(serializers.ENCODERS)
+        self.decoders = Registry(serializers.DECODERS)
+        self.compressors = Registry(serializers.COMPRESSORS)
+        # The content encoding bodies of compress_threshold bytes or more
+        # are stored with, one of compressors. None doesn't compress.
+        self.compression = None
+        self.compress_threshold = 1024
 
         self._buckets = WeakValueDictionary()
 
+    @property
+    def instrument(self):
+        """The transport's Instrument. RObject reports to it too."""
+        return self.transport.instrument
+
+    @instrument.setter
+    def instrument(self, instrument):
+        self.transport.instrument = instrument
+
     def get_buckets(self):
         """Get all the buckets. Not recommended for production use.
 
@@ -71,6 +104,13 @@ class Client(object):
         """
         return self.transport.get_buckets()
 
+    def stream_buckets(self):
+        """Like get_buckets, but the buckets are handed out as they are listed.
+
+        :rtype: A generator of bucket names
+        """
+        return self.transport.stream_buckets()
+
     def is_alive(self):
         """Check if the server is alive.
 
@@ -94,6 +134,29 @@ class Client(object):
         self._buckets[name] = b
         return b
 
+    def multiget(self, keys, r=None, conflict_handler=do_nothing, concurrency=None):
+        """Gets many objects at once, possibly from different buckets. The
+        requests are spread over the calling thread and the threads of
+        self.executor, so they are in flight at the same time over the
+        connection pool.
+
+        :param keys: A list of (bucket, key). bucket can be a name or a Bucket.
+        :param r: The r value. Defaults to each bucket's r.
+        :param conflict_handler: A function that handles conflict.
+        :param concurrency: Number of requests in flight. Defaults to
+                            self.concurrency
+        :rtype: A list of RObject in the same order as keys. Objects that are
+                not found have exists set to False. If getting an object
+                failed, the exception is in its place instead.
+        """
+        def get(bucket_key):
+            bucket, key = bucket_key
+            if not isinstance(bucket, Bucket):
+                bucket = self.bucket(bucket)
+            return bucket.get(key, r, conflict_handler)
+
+        return concurrent_map(get, keys, concurrency or self.concurrency, self.executor)
+
     def get_from_link(self, link):
         bucket = self.bucket(link[0])
         return bucket.get(link[1])
@@ -14,7 +14,9 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from connection import ConnectionManager
+from connection import ConnectionManager, RoundRobin, LeastOutstanding, LatencyWeighted
 from http import HttpTransport
 from exceptions import *
-from pbc import PbcTransport
+from pbc import PbcTransport, PbcConnection
+from retry import RetryPolicy
+from instrument import Instrument, Operation, Histogram, HistogramCollector
@@ -15,73 +15,501 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from exceptions import PoolTimeout
+from collections import deque
 import httplib
 import contextlib
-import socket
+import itertools
+import threading
+import time
 
 class NoHostsDefined(Exception): pass
 
+class Host(object):
+    """Everything the ConnectionManager knows about one host/port."""
+
+    # How much a new latency sample weighs in the moving average.
+    LATENCY_DECAY = 0.3
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # (connection, last used) pairs. Taken from and given back to the
+        # right hand side, so the warmest connection is reused first.
+        self.idle = deque()
+        # Borrowed connection: time it was taken.
+        self.busy = {}
+        # Number of connections alive, idle or busy. Only touched with the
+        # manager's lock held.
+        self.count = 0
+        # Exponentially weighted moving average of how long a connection is
+        # borrowed for, in seconds. None until the first sample.
+        self.latency = None
+        # Circuit breaker. Consecutive failures, how many times in a row the
+        # host got ejected, and until when. ejected_until is None when the
+        # host is healthy.
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+
+    @property
+    def hostport(self):
+        return (self.host, self.port)
+
+    @property
+    def inflight(self):
+        return len(self.busy)
+
+    @property
+    def healthy(self):
+        return self.ejected_until is None
+
+    def record_latency(self, seconds):
+        # Racy, but losing a sample of a moving average doesn't matter.
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += (seconds - self.latency) * self.LATENCY_DECAY
+
+
+class RoundRobin(object):
+    """Cycles through the hosts."""
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def select(self, hosts):
+        return hosts[next(self._counter) % len(hosts)]
+
+
+class LeastOutstanding(object):
+    """Picks the host with the fewest requests in flight."""
+
+    def select(self, hosts):
+        return min(hosts, key=lambda host: host.inflight)
+
+
+class LatencyWeighted(object):
+    """Picks the host with the lowest expected wait: its moving average
+    latency times the requests already in flight there (plus ours). Hosts
+    that haven't been measured yet go first."""
+
+    def select(self, hosts):
+        return min(hosts, key=lambda host: (host.latency or 0.0) * (host.inflight + 1))
+
+
+class HealthChecker(threading.Thread):
+    """Pings ejected hosts once their ejection window is over, through the
+    transport, and puts them back in rotation if they answer."""
+
+    def __init__(self, cm, transport, interval=1.0):
+        threading.Thread.__init__(self, name="riak2-health-checker")
+        self.daemon = True
+        self.cm = cm
+        self.transport = transport
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self):
+        for host in self.cm.hosts:
+            ejected_until = host.ejected_until
+            if ejected_until is None or time.time() < ejected_until:
+                continue
+
+            try:
+                with self.cm.pin(host.host, host.port):
+                    alive = self.transport.ping()
+            except Exception:
+                alive = False
+
+            if alive:
+                self.cm.mark_healthy(host)
+            elif host.ejected_until == ejected_until:
+                # The transport didn't already report it.
+                self.cm.eject(host)
+
+
 class ConnectionManager(object):
+    """A thread safe pool of connections.
+
+    Connections are created lazily, up to max_connections per host. Once every
+    host is at its limit, take() blocks until a connection is given back,
+    or raises PoolTimeout after timeout seconds.
+
+    Which host a connection is taken from is up to the selector: RoundRobin
+    (the default), LeastOutstanding or LatencyWeighted. Anything with a
+    select(hosts) method returning one of the Host objects will do.
+
+    Transports tell the manager how each connection fared with
+    report_success() and report_failure(). After max_failures failures in a row
+    a host is ejected: no connections are handed out for it for eject_for
+    seconds, doubling every time it fails again, up to max_eject_for. Once the
+    window is over, the host gets traffic again, and one more failure ejects
+    it right away. If start_health_checks() was called, the host is pinged in
+    the background instead, and only comes back once it answers. If every host
+    is ejected, they all get traffic anyway.
+
+    Taking an idle connection doesn't touch the lock: deque.pop and
+    deque.append are atomic, so the common case of a warm pool is just that.
+    """
 
     @classmethod
     def get_http_cm(cls, host="localhost", port=8098):
         """Don't use this.'"""
         return cls(httplib.HTTPConnection, [(host, port)])
 
-    def __init__(self, connection_class, hostports=[]):
+    @classmethod
+    def get_pbc_cm(cls, host="localhost", port=8087):
+        """Don't use this either."""
+        from pbc import PbcConnection
+        return cls(PbcConnection, [(host, port)])
+
+    def __init__(self, connection_class, hostports=[], max_connections=None,
+                       timeout=None, idle_timeout=None, selector=None,
+                       max_failures=3, eject_for=1.0, max_eject_for=30.0):
+        """Construct a new connection manager.
+
+        :param connection_class: A class taking host, port. It should connect
+                                 lazily, like httplib.HTTPConnection.
+        :param hostports: A list of (host, port)
+        :param max_connections: Maximum number of connections per host.
+                                Defaults to None, which is unbounded.
+        :param timeout: Seconds to wait in take() for a connection when every
+                        host is at max_connections. None waits forever.
+        :param idle_timeout: Connections idle for longer than this many seconds
+                             are closed instead of being handed out. None
+                             keeps them around forever.
+        :param selector: The host selection strategy. Defaults to RoundRobin()
+        :param max_failures: Consecutive failures before a host is ejected.
+        :param eject_for: Seconds a host is ejected for the first time.
+        :param max_eject_for: Upper bound of the ejection window.
+        """
         self.connection_class = connection_class
-        self.hostports = hostports[:]
-        self.connections = [connection_class(host, port)
-            for host, port in hostports]
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.selector = RoundRobin() if selector is None else selector
+        self.max_failures = max_failures
+        self.eject_for = eject_for
+        self.max_eject_for = max_eject_for
+        self.health_checker = None
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._waiters = 0
+        self._ejected = 0
+        self._local = threading.local()
+        # hostports and _host_list are replaced, never mutated, so readers
+        # don't need the lock.
+        self._hosts = {}
+        self._host_list = []
+
+        now = time.time()
+        for host, port in hostports:
+            h = self._hosts.get((host, port))
+            if h is None:
+                h = self._hosts[(host, port)] = Host(host, port)
+                self._host_list = self._host_list + [h]
+            h.count += 1
+            h.idle.append((connection_class(host, port), now))
+
+    @property
+    def hostports(self):
+        return [host.hostport for host in self._host_list]
+
+    @property
+    def hosts(self):
+        return self._host_list
 
     def add_hostport(self, host, port):
-        self.hostports.append(host, port)
-        self.conns.append(self.connection_class(host, port))
+        with self._lock:
+            if (host, port) not in self._hosts:
+                h = self._hosts[(host, port)] = Host(host, port)
+                self._host_list = self._host_list + [h]
+            self._available.notify_all()
 
     def remove_hostport(self, host, port=None):
-        if port is None:
-            self.hostports = [(h, p) for h, p in self.hostports if h != host]
-        else:
-            self.hostports.remove((host, port))
+        matches = lambda h: h.host == host and (port is None or h.port == port)
+        with self._lock:
+            removed = [h for h in self._host_list if matches(h)]
+            self._host_list = [h for h in self._host_list if not matches(h)]
+            for h in removed:
+                del self._hosts[h.hostport]
+                if h.ejected_until is not None:
+                    self._ejected -= 1
 
-        new_connections = []
-        for conn in self.connections:
-            if conn.host == host and (port is None or conn.port == port):
+        for h in removed:
+            for conn, last_used in self._drain(h):
                 conn.close()
-            else:
-                new_connections.append(conn)
 
-        self.connections = new_connections
+    def take(self, timeout=None, exclude=None):
+        """Takes a connection out of the pool. Give it back with giveback().
 
-    def take(self):
-        if len(self.connections) == 0:
-            return self._new_connection()
+        :param timeout: Overrides the manager's timeout for this call.
+        :param exclude: (host, port) to stay away from if there are others,
+                        like the ones a request just failed on.
+        """
+        hosts = self._routable(exclude)
+        host = self.selector.select(hosts)
+        while True:
+            try:
+                conn, last_used = host.idle.pop()
+            except IndexError:
+                return self._take_slow(host, self.timeout if timeout is None else timeout,
+                                       exclude)
 
-        return self.connections.pop()
+            if self._expired(last_used):
+                self._discard(host, conn)
+            else:
+                host.busy[conn] = time.time()
+                return conn
 
     def giveback(self, conn):
-        # Connections using a host/port pair that is NOT in self.hostports
-        # should be ignored. Likely, remove_host() was called while this
-        # connection was borrowed for some work.
-        if (conn.host, conn.port) in self.hostports:
-            self.connections.append(conn)
-        else:
+        host = self._hosts.get((conn.host, conn.port))
+        if host is None:
+            # Connections using a host/port pair that is NOT in self.hostports
+            # should be ignored. Likely, remove_host() was called while this
+            # connection was borrowed for some work.
             # Proactively close the connection. The caller won"t know whether
             # we put it into our list, or left the connection for the caller
             # to deal with (and close)
             conn.close()
+            return
+
+        now = time.time()
+        taken = host.busy.pop(conn, None)
+        if taken is not None:
+            host.record_latency(now - taken)
+        host.idle.append((conn, now))
+        # A waiter increments _waiters before it looks at the idle lists, so
+        # either it sees this connection or we see it waiting.
+        if self._waiters:
+            with self._lock:
+                self._available.notify()
 
     @contextlib.contextmanager
-    def withconn(self):
-        conn = self.take()
+    def withconn(self, timeout=None, exclude=None):
+        conn = self.take(timeout, exclude)
         try:
             yield conn
         finally:
             self.giveback(conn)
 
-    def _new_connection(self):
-        if len(self.hostports) == 0:
+    @contextlib.contextmanager
+    def pin(self, host, port):
+        """Within this block, connections taken by this thread all go to
+        host/port, healthy or not."""
+        h = self._hosts.get((host, port))
+        if h is None:
             raise NoHostsDefined()
+        self._local.pinned = h
+        try:
+            yield h
+        finally:
+            self._local.pinned = None
+
+    def report_success(self, conn):
+        host = self._hosts.get((conn.host, conn.port))
+        if host is not None and (host.failures or host.ejected_until is not None):
+            self.mark_healthy(host)
+
+    def report_failure(self, conn):
+        host = self._hosts.get((conn.host, conn.port))
+        if host is None:
+            return
+        with self._lock:
+            host.failures += 1
+            if host.ejected_until is None:
+                eject = host.failures >= self.max_failures
+            else:
+                # An ejected host getting traffic again is on probation.
+                eject = time.time() >= host.ejected_until
+        if eject:
+            self.eject(host)
+
+    def mark_healthy(self, host):
+        with self._lock:
+            host.failures = 0
+            if host.ejected_until is not None:
+                host.ejected_until = None
+                host.ejections = 0
+                self._ejected -= 1
+                self._available.notify_all()
+
+    def eject(self, host):
+        """Takes a host out of rotation for its backoff window."""
+        with self._lock:
+            host.ejections += 1
+            window = min(self.eject_for * 2 ** (host.ejections - 1), self.max_eject_for)
+            if host.ejected_until is None:
+                self._ejected += 1
+            host.ejected_until = time.time() + window
+
+        # Whatever is idle there is likely dead too.
+        for conn, last_used in self._drain(host):
+            self._discard(host, conn)
+
+    def start_health_checks(self, transport, interval=1.0):
+        """Starts pinging ejected hosts in the background through
+        transport.ping(). The transport should be using this manager."""
+        self.stop_health_checks()
+        self.health_checker = HealthChecker(self, transport, interval)
+        self.health_checker.start()
+
+    def stop_health_checks(self):
+        if self.health_checker is not None:
+            self.health_checker.stop()
+            self.health_checker = None
+
+    def reap(self):
+        """Closes every idle connection that has passed idle_timeout.
+
+        take() already skips over those, this just lets you release the
+        sockets earlier, from a timer or between batches of work.
+
+        :rtype: The number of connections closed.
+        """
+        reaped = 0
+        for host in self._host_list:
+            for conn, last_used in self._drain(host):
+                if self._expired(last_used):
+                    self._discard(host, conn)
+                    reaped += 1
+                else:
+                    host.idle.append((conn, last_used))
+        return reaped
 
-        return self.connection_class(*self.hostports[0])
+    def close(self):
+        """Closes every idle connection."""
+        for host in self._host_list:
+            for conn, last_used in self._drain(host):
+                self._discard(host, conn)
+
+    def size(self, host=None, port=None):
+        """The number of connections alive, optionally for one host/port."""
+        with self._lock:
+            return sum(h.count for h in self._host_list
+                       if (host is None or h.host == host) and (port is None or h.port == port))
+
+    def _routable(self, exclude=None):
+        """The hosts take() may pick from."""
+        pinned = getattr(self._local, "pinned", None)
+        if pinned is not None:
+            return [pinned]
+
+        hosts = self._host_list
+        if len(hosts) == 0:
+            raise NoHostsDefined()
+        if exclude:
+            hosts = [h for h in hosts if h.hostport not in exclude] or hosts
+        if not self._ejected:
+            return hosts
+
+        now = time.time()
+        probing = self.health_checker is not None
+        healthy = [h for h in hosts if h.ejected_until is None or
+                   (not probing and now >= h.ejected_until)]
+        return healthy or hosts
+
+    def _drain(self, host):
+        items = []
+        while True:
+            try:
+                items.append(host.idle.popleft())
+            except IndexError:
+                return items
+
+    def _expired(self, last_used):
+        return self.idle_timeout is not None and \
+               time.time() - last_used > self.idle_timeout
+
+    def _uncount(self, host):
+        # Called with the lock held.
+        if host.count > 0:
+            host.count -= 1
+        self._available.notify()
+
+    def _discard(self, host, conn):
+        conn.close()
+        with self._lock:
+            self._uncount(host)
+
+    def _has_room(self, host):
+        return self.max_connections is None or host.count < self.max_connections
+
+    def _take_slow(self, preferred, timeout, exclude=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._waiters += 1
+            try:
+                while True:
+                    conn, host = self._take_locked(preferred, exclude)
+                    if conn is not None or host is not None:
+                        break
+
+                    if deadline is None:
+                        self._available.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise PoolTimeout("No connection available after %ss" % timeout)
+                        self._available.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+        if conn is None:
+            conn = self._new_connection(host.hostport)
+        host.busy[conn] = time.time()
+        return conn
+
+    def _take_locked(self, preferred, exclude=None):
+        """Called with the lock held. Returns an idle connection and its host,
+        or None and a host that now has room for one more connection, or
+        None and None if everything is busy."""
+        hosts = self._routable(exclude)
+        if preferred not in hosts:
+            preferred = self.selector.select(hosts)
+
+        # The preferred host, idle or new, so that a host with nothing idle
+        # (just added, or back from an ejection) still gets its share.
+        conn = self._pop_idle(preferred)
+        if conn is not None:
+            return conn, preferred
+        if self._has_room(preferred):
+            preferred.count += 1
+            return None, preferred
+
+        # It's full. Borrow from the others, idle connections first.
+        others = [h for h in hosts if h is not preferred]
+        for host in others:
+            conn = self._pop_idle(host)
+            if conn is not None:
+                return conn, host
+        candidates = [h for h in others if self._has_room(h)]
+        if len(candidates) == 0:
+            return None, None
+        host = self.selector.select(candidates)
+        host.count += 1
+        return None, host
+
+    def _pop_idle(self, host):
+        # Called with the lock held.
+        while True:
+            try:
+                conn, last_used = host.idle.pop()
+            except IndexError:
+                return None
+            if not self._expired(last_used):
+                return conn
+            conn.close()
+            self._uncount(host)
 
+    def _new_connection(self, hostport):
+        return self.connection_class(*hostport)
@@ -15,4 +15,5 @@
 # under the License.
 
 class ConnectionError(Exception): pass
+class PoolTimeout(ConnectionError): pass
 class RiakError(Exception): pass
@@ -20,13 +20,20 @@
 from exceptions import ConnectionError
 from transport import Transport
 from connection import ConnectionManager
-import errno
+from retry import RetryPolicy
+from instrument import operation
+from stream import (JsonStreamDecoder, MultipartStreamDecoder, ChunkReader, FileBody,
+                    iter_chunks, multipart_boundary)
 from urllib import quote_plus, urlencode
 import csv
+import errno
 import re
 import json
+import select
 import socket
-from httplib import HTTPException
+import threading
+import time
+from httplib import HTTPConnection, HTTPException
 from xml.dom.minidom import Document
 from xml.etree import ElementTree
 
@@ -35,9 +42,32 @@ from xml.etree import ElementTree
 
 # MAX_LINK_HEADER_SIZE = 8184
 
+class _Memo(dict):
+    """func, memoized, for up to size different arguments. Once full it
+    forgets everything, which is cheaper than keeping track of what was
+    used last. Hot arguments come right back."""
+
+    def __init__(self, func, size=10000):
+        self.func = func
+        self.size = size
+
+    def __missing__(self, arg):
+        if len(self) >= self.size:
+            self.clear()
+        value = self[arg] = self.func(arg)
+        return value
+
+
 class HttpTransport(Transport):
     api = 2
-    RETRY_COUNT = 3
+    connection_class = HTTPConnection
+    default_port = 8098
+
+    # Asking for multipart gets all the siblings in the 300 response.
+    _accept = "multipart/mixed, */*; q=0.5"
+    # Headers shared by every request of a kind. Never changed, copied if
+    # need be. The ones with Accept in are built by __init__, from _accept.
+    _json_headers = {"Content-Type": "application/json"}
 
     class HttpSolrTransport(Transport.SolrTransport):
         def __init__(self, client):
@@ -57,7 +87,8 @@ class HttpTransport(Transport):
             xml.appendChild(root)
 
             url = "/solr/%s/update" % index
-            self.client._request("POST", url, {"Content-Type": "text/xml"}, xml.toxml())
+            self.client._request("POST", url, {"Content-Type": "text/xml"}, xml.toxml(),
+                                 end=self.client._deadline(None))
 
         def delete_index(self, index, docs=None, queries=None):
             xml = Document()
@@ -76,20 +107,22 @@ class HttpTransport(Transport):
 
             xml.appendChild(root)
             url = "/solr/%s/update" % index
-            self.client._request("POST", url, {"Content-Type": "text/xml"}, xml.toxml())
+            self.client._request("POST", url, {"Content-Type": "text/xml"}, xml.toxml(),
+                                 end=self.client._deadline(None))
 
         def search(self, index, query, params={}):
             options = {'q': query, 'wt': 'json'}
             options.update(params)
             url = "/solr/%s/select" % index + "?" + urlencode(options)
-            headers, response = self.client._request("GET", url)
+            headers, response = self.client._request("GET", url,
+                                                     end=self.client._deadline(None))
             return json.loads(response)
 
     def make_put_header(self, content_type="application/json",
                               links=[],     # These are safe. Why? Because I'm
                               indexes=[],   # not modifying them in the function
                               usermeta={},  # If you do, you should change this.
-                              vclock=None):
+                              vclock=None, content_encoding=None):
         """Creates a header for put. This is done so that the function arguments
         for put is not too crazy, and it also gives you a chance to manipulate
         the headers if required.
@@ -99,189 +132,591 @@ class HttpTransport(Transport):
         :param indexes: A list of 2 item tuples for 2i, consisting of field, value
         :param usermeta: A dictionary of metadata
         :param vclock: Vector clock data.
+        :param content_encoding: How content is compressed, if it is. Riak
+                                 keeps it and hands it back.
         :rtype: A dictionary of a fully constructed header.
         """
-        headers = {
-            "Accept" : "text/plain, */*; q=0.5",
-            "X-Riak-ClientId" : self.client_id,
-            "Content-Type" : content_type
-        }
+        headers = self._put_headers.copy()
+        headers["Content-Type"] = content_type
 
         if vclock:
             headers["X-Riak-Vclock"] = vclock
 
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+
         for key, value in usermeta.iteritems():
-            headers["X-Riak-Meta-%s" % key] = value
+            headers["X-Riak-Meta-" + key] = value
 
-        for field, value in indexes:
-            key = "X-Riak-Index-%s" % field
-            if key in headers:
-                headers[key] += ", " + value
-            else:
-                headers[key] = value
+        if indexes:
+            fields = {}
+            for field, value in indexes:
+                fields.setdefault(field, []).append(str(value))
+            for field, values in fields.iteritems():
+                headers["X-Riak-Index-" + field] = ", ".join(values)
 
-        for bucket, key, tag in links:
-            link = self._to_link_header(bucket, key, tag)
-            if "Link" in headers:
-                headers["Link"] += ", " + link
-            else:
-                headers["Link"] = link
+        if links:
+            link_headers = self._link_headers
+            headers["Link"] = ", ".join([link_headers[tuple(link)] for link in links])
 
         return headers
 
     def __init__(self, cm=None, client_id=None, prefix="riak",
-                 mapred_prefix="mapred"):
+                 mapred_prefix="mapred", max_requests=None, keepalive_timeout=None,
+                 retry_policy=None, deadline=None, instrument=None):
+        """Keep-alive connections are checked before they are used, and
+        reopened rather than reused if they have served max_requests already,
+        have been idle for longer than keepalive_timeout seconds (set it a bit
+        below the server's), or if the server hung up on them in the
+        meantime.
+
+        :param max_requests: Requests per connection. None is unlimited.
+        :param keepalive_timeout: Seconds a connection may sit idle and still
+                                  be reused. None is forever.
+        :param retry_policy: A RetryPolicy. Defaults to RetryPolicy()
+        :param deadline: Default deadline of a request, in seconds.
+        :param instrument: An Instrument to tell about every operation.
+        """
         if cm is None:
             cm = ConnectionManager.get_http_cm()
         self._connections = cm
         self._prefix = prefix
         self._mapred_prefix = mapred_prefix
+        # Bucket and key names come back over and over, quoting them (and
+        # links) once will do. See _Memo.
+        self._quote = _Memo(quote_plus)
+        self._bucket_paths = _Memo(lambda bucket: "/%s/%s" % (prefix, quote_plus(bucket)), 1000)
+        self._link_headers = _Memo(lambda link: self._to_link_header(*link))
+        self.max_requests = max_requests
+        self.keepalive_timeout = keepalive_timeout
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.deadline = deadline
+        self.instrument = instrument
 
         self.solr = self.HttpSolrTransport(self)
 
-        self.client_id = client_id or self.random_client_id()
-
-    def ping(self):
-        response = self._request("GET", "/ping")
-        return response[1] == "OK"
-
-    def get(self, bucket, key, r=None, vtag=None):
-        params = {}
+        self._get_headers = {"Accept": self._accept}
+        self.client_id = client_id or self.random_client_id() # Sets _put_headers
+
+        # Connection reuse counters. See connection_stats()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.connects = 0
+        self.reconnects = 0
+
+    @property
+    def client_id(self):
+        return self._put_headers["X-Riak-ClientId"]
+
+    @client_id.setter
+    def client_id(self, client_id):
+        # What every put starts with.
+        self._put_headers = {"Accept": self._accept, "X-Riak-ClientId": client_id}
+
+    def connection_stats(self):
+        """How well connections are being reused.
+
+        :rtype: A dictionary. requests is the number of requests sent, reused
+                how many went over a warm connection and connects how many
+                had to open a new one. reconnects is how many connections
+                were reopened before use by the keep-alive checks. reuse_ratio
+                is reused / requests.
+        """
+        with self._stats_lock:
+            stats = {"requests": self.requests, "reused": self.reused,
+                     "connects": self.connects, "reconnects": self.reconnects}
+        stats["reuse_ratio"] = stats["reused"] / float(stats["requests"] or 1)
+        return stats
+
+    def ping(self, deadline=None):
+        with operation(self.instrument, "ping") as op:
+            response = self._request("GET", "/ping", end=self._deadline(deadline), op=op)
+            return response[1] == "OK"
+
+    def get(self, bucket, key, r=None, vtag=None, if_modified=None, deadline=None):
+        with operation(self.instrument, "get", bucket) as op:
+            end = self._deadline(deadline)
+            params = self._timeout_params(end)
+            if r is not None:
+                params["r"] = r
+            if vtag is not None:
+                params["vtag"] = vtag
+            url = self._build_rest_path(bucket, key, params=params)
+            headers = self._get_headers
+            if if_modified is not None and "etag" in if_modified[1]:
+                headers = dict(headers)
+                headers["If-None-Match"] = if_modified[1]["etag"]
+            response = self._request("GET", url, headers, end=end, op=op)
+            if response[0]["http_code"] == 304 and "If-None-Match" in headers:
+                return if_modified
+            result = self._parse_response(response, 200, 300, 404)
+            if op is not None:
+                op.mark("parse")
+        return self._fetch_siblings(bucket, key, r, end, result)
+
+    def get_stream(self, bucket, key, r=None, deadline=None):
+        end = self._deadline(deadline)
+        params = self._timeout_params(end)
         if r is not None:
             params["r"] = r
-        if vtag is not None:
-            params["vtag"] = vtag
-        url = self._build_rest_path(bucket, key, params=params)
-        response = self._request("GET", url)
-        return self._parse_response(response, 200, 300, 404)
-
-    def put(self, bucket, key, content, meta, w=None, dw=None, return_body=True, meta_is_headers=False):
-        headers = meta if meta_is_headers else self.make_put_header(**meta)
-
-        params = {
-                    "returnbody" : "true" if return_body else "false",
-                }
-        if w is not None:
-            params["w"] = w
-        if dw is not None:
-            params["dw"] = dw
         url = self._build_rest_path(bucket, key, params=params)
 
-        if key is None:
-            response = self._request("POST", url, headers, content)
-            location = response[0]["location"]
-            idx = location.rindex("/")
-            key = location[idx+1:]
-            if return_body:
-                vclock, metadata, data = self._parse_response(response, 201)
-                return key, vclock, metadata
-            else:
-                self._assert_http_code(response, 201)
-                return key, None, None
-        else:
-            response = self._request("PUT", url, headers, content)
-            if return_body:
-                return self._parse_response(response, 200, 201, 300)
+        def stream():
+            with operation(self.instrument, "get_stream", bucket) as op:
+                for item in self._stream("GET", url, self._get_headers, expected_status=(200, 300, 404),
+                                         end=end, op=op):
+                    yield item
+        chunks = stream()
+        headers = next(chunks)
+        if headers["http_code"] != 200:
+            result = self._parse_response((headers, "".join(chunks)), 300, 404)
+            return self._fetch_siblings(bucket, key, r, end, result)
+        vclock, metadata, data = self._parse_response((headers, ""), 200)
+        return vclock, metadata, ChunkReader(chunks)
+
+    def put(self, bucket, key, content, meta, w=None, dw=None, return_body=True,
+                  meta_is_headers=False, deadline=None):
+        with operation(self.instrument, "put", bucket) as op:
+            headers = meta if meta_is_headers else self.make_put_header(**meta)
+            # A file that can't be rewound can't be sent twice.
+            idempotent = None
+            if hasattr(content, "read"):
+                content = FileBody(content)
+                if not content.seekable:
+                    idempotent = False
+
+            end = self._deadline(deadline)
+            params = self._timeout_params(end)
+            params["returnbody"] = "true" if return_body else "false"
+            if w is not None:
+                params["w"] = w
+            if dw is not None:
+                params["dw"] = dw
+            url = self._build_rest_path(bucket, key, params=params)
+
+            if key is None:
+                response = self._request("POST", url, headers, content, end=end, op=op)
+                location = response[0]["location"]
+                idx = location.rindex("/")
+                key = location[idx+1:]
+                if return_body:
+                    vclock, metadata, data = self._parse_response(response, 201)
+                    if op is not None:
+                        op.mark("parse")
+                    return key, vclock, metadata
+                else:
+                    self._assert_http_code(response, 201)
+                    return key, None, None
             else:
-                self._assert_http_code(response, 204)
-                return None, None, None
-
-    def delete(self, bucket, key, rw=None):
-        if rw is None:
-            params = {}
-        else:
-            params = {"rw" : rw}
-        url = self._build_rest_path(bucket, key, params)
-        self._assert_http_code(self._request("DELETE", url), 204, 404)
-
-    def _get_stuff(self, bucket, params):
-        url = self._build_rest_path(bucket, params=params)
-        response = self._request("GET", url)
-        self._assert_http_code(response, 200)
-        return json.loads(response[1])
-
-    def get_keys(self, bucket):
-        return self._get_stuff(bucket, {"keys" : "true"})["keys"]
-
-    def get_buckets(self):
-        return self._get_stuff(None, {"buckets" : "true"})["buckets"]
-
-    def get_bucket_properties(self, bucket):
-        return self._get_stuff(bucket, {"props" : "true", "keys" : "false"})["props"]
-
-    def set_bucket_properties(self, bucket, properties):
-        url = self._build_rest_path(bucket)
-        headers = {"Content-Type" : "application/json"}
-        content = json.dumps({"props" : properties})
-        response = self._request("PUT", url, headers, content)
-
-        self._assert_http_code(response, 204)
-
-    def index(self, bucket, field, start, end=None):
-        url = "/buckets/%s/index/%s/%s" % (quote_plus(bucket),
-                                           quote_plus(str(field)),
+                response = self._request("PUT", url, headers, content, idempotent, end=end, op=op)
+                if not return_body:
+                    self._assert_http_code(response, 204)
+                    return None, None, None
+                result = self._parse_response(response, 200, 201, 300)
+                if op is not None:
+                    op.mark("parse")
+        return self._fetch_siblings(bucket, key, None, end, result)
+
+    def _fetch_siblings(self, bucket, key, r, end, result):
+        # Riak didn't do multipart, all we got is the vtags. One GET each.
+        if isinstance(result, list) and result and isinstance(result[0], basestring):
+            result = [self.get(bucket, key, r, vtag, deadline=self._remaining(end))
+                      for vtag in result]
+            result = [sibling for sibling in result if sibling is not None]
+        return result
+
+    def delete(self, bucket, key, rw=None, deadline=None):
+        with operation(self.instrument, "delete", bucket) as op:
+            end = self._deadline(deadline)
+            params = self._timeout_params(end)
+            if rw is not None:
+                params["rw"] = rw
+            url = self._build_rest_path(bucket, key, params)
+            self._assert_http_code(self._request("DELETE", url, end=end, op=op), 204, 404)
+
+    def _get_stuff(self, name, bucket, params, deadline):
+        with operation(self.instrument, name, bucket) as op:
+            end = self._deadline(deadline)
+            params.update(self._timeout_params(end))
+            url = self._build_rest_path(bucket, params=params)
+            response = self._request("GET", url, end=end, op=op)
+            self._assert_http_code(response, 200)
+            result = json.loads(response[1])
+            if op is not None:
+                op.mark("parse")
+            return result
+
+    def _stream_json(self, name, bucket, params, field, end):
+        with operation(self.instrument, name, bucket) as op:
+            url = self._build_rest_path(bucket, params=params)
+            chunks = self._stream("GET", url, end=end, op=op)
+            next(chunks) # headers
+            decoder = JsonStreamDecoder()
+            for chunk in chunks:
+                for value in decoder.feed(chunk):
+                    for item in value.get(field, ()):
+                        yield item
+            decoder.close()
+
+    def get_keys(self, bucket, deadline=None):
+        return list(self.stream_keys(bucket, deadline))
+
+    def stream_keys(self, bucket, deadline=None):
+        end = self._deadline(deadline)
+        params = self._timeout_params(end)
+        params.update({"keys" : "stream", "props" : "false"})
+        return self._stream_json("stream_keys", bucket, params, "keys", end)
+
+    def get_buckets(self, deadline=None):
+        return self._get_stuff("get_buckets", None, {"buckets" : "true"}, deadline)["buckets"]
+
+    def stream_buckets(self, deadline=None):
+        end = self._deadline(deadline)
+        params = self._timeout_params(end)
+        params["buckets"] = "stream"
+        return self._stream_json("stream_buckets", None, params, "buckets", end)
+
+    def get_bucket_properties(self, bucket, deadline=None):
+        return self._get_stuff("get_bucket_properties", bucket,
+                               {"props" : "true", "keys" : "false"}, deadline)["props"]
+
+    def set_bucket_properties(self, bucket, properties, deadline=None):
+        with operation(self.instrument, "set_bucket_properties", bucket) as op:
+            url = self._build_rest_path(bucket)
+            headers = self._json_headers
+            content = json.dumps({"props" : properties})
+            response = self._request("PUT", url, headers, content, end=self._deadline(deadline),
+                                     op=op)
+
+            self._assert_http_code(response, 204)
+
+    def index(self, bucket, field, start, end=None, deadline=None):
+        return self.index_page(bucket, field, start, end, deadline=deadline)[0]
+
+    def index_page(self, bucket, field, start, end=None, return_terms=False, max_results=None,
+                         continuation=None, deadline=None):
+        with operation(self.instrument, "index", bucket) as op:
+            until = self._deadline(deadline) # end is taken.
+            url = self._index_url(bucket, field, start, end, until, return_terms, max_results,
+                                  continuation)
+            response = self._request("GET", url, end=until, op=op)
+            self._assert_http_code(response, 200)
+            result = json.loads(response[1])
+            results = self._index_results(field, start, result, return_terms)
+            if op is not None:
+                op.mark("parse")
+            return results, result.get("continuation")
+
+    def stream_index(self, bucket, field, start, end=None, return_terms=False,
+                           max_results=None, continuation=None, deadline=None):
+        with operation(self.instrument, "stream_index", bucket) as op:
+            until = self._deadline(deadline)
+            url = self._index_url(bucket, field, start, end, until, return_terms, max_results,
+                                  continuation, stream=True)
+            chunks = self._stream("GET", url, end=until, op=op)
+            headers = next(chunks)
+            boundary = multipart_boundary(headers.get("content-type", ""))
+            if boundary is None:
+                raise ConnectionError("Expected a multipart response, got %s" % headers.get("content-type"))
+
+            decoder = MultipartStreamDecoder(boundary)
+            for chunk in chunks:
+                for part_headers, body in decoder.feed(chunk):
+                    result = json.loads(body)
+                    yield (self._index_results(field, start, result, return_terms),
+                           result.get("continuation"))
+            decoder.close()
+
+    def _index_url(self, bucket, field, start, end, until, return_terms, max_results,
+                         continuation, stream=False):
+        url = "/buckets/%s/index/%s/%s" % (self._quote[bucket],
+                                           self._quote[str(field)],
                                            quote_plus(str(start)))
         if end is not None:
             url += "/" + quote_plus(str(end))
-        response = self._request("GET", url)
-        self._assert_http_code(response, 200)
-        return json.loads(response[1])["keys"]
-
-    def mapreduce(self, inputs, query, timeout=None):
+        params = self._timeout_params(until)
+        if return_terms:
+            params["return_terms"] = "true"
+        if max_results is not None:
+            params["max_results"] = max_results
+        if continuation is not None:
+            params["continuation"] = continuation
+        if stream:
+            params["stream"] = "true"
+        if params:
+            url += "?" + urlencode(params)
+        return url
+
+    def _index_results(self, field, start, result, return_terms):
+        if not return_terms:
+            return result.get("keys", [])
+        if "results" not in result: # Exact matches come without their term.
+            return [(start, key) for key in result.get("keys", [])]
+        is_int = field.endswith("_int")
+        return [(int(term) if is_int else term, key) for pair in result["results"]
+                                                      for term, key in pair.iteritems()]
+
+    def mapreduce(self, inputs, query, timeout=None, deadline=None):
+        with operation(self.instrument, "mapreduce") as op:
+            end = self._deadline(deadline)
+            content = self._mapred_job(inputs, query, timeout, end)
+            url = "/" + self._mapred_prefix
+            response = self._request("POST", url, {"Content-Type" : "application/json"}, content,
+                                     idempotent=True, end=end, op=op) # Map reduce doesn't write.
+            self._assert_http_code(response, 200)
+            result = json.loads(response[1])
+            if op is not None:
+                op.mark("parse")
+            return result
+
+    def stream_mapreduce(self, inputs, query, timeout=None, deadline=None):
+        with operation(self.instrument, "stream_mapreduce") as op:
+            end = self._deadline(deadline)
+            content = self._mapred_job(inputs, query, timeout, end)
+            url = "/%s?chunked=true" % self._mapred_prefix
+            chunks = self._stream("POST", url, {"Content-Type" : "application/json"}, content,
+                                  end=end, op=op)
+            headers = next(chunks)
+            boundary = multipart_boundary(headers.get("content-type", ""))
+            if boundary is None:
+                raise ConnectionError("Expected a multipart response, got %s" % headers.get("content-type"))
+
+            decoder = MultipartStreamDecoder(boundary)
+            for chunk in chunks:
+                for part_headers, body in decoder.feed(chunk):
+                    result = json.loads(body)
+                    yield result.get("phase", 0), result.get("data", [])
+            decoder.close()
+
+    def _mapred_job(self, inputs, query, timeout, end):
         job = {"inputs": inputs, "query": query}
+        if timeout is None:
+            timeout = self._server_timeout(end)
         if timeout is not None:
             job["timeout"] = timeout
-        content = json.dumps(job)
-        url = "/" + self._mapred_prefix
-        response = self._request("POST", url, {"Content-Type" : "application/json"}, content)
-        self._assert_http_code(response, 200)
-        return json.loads(response[1])
+        return json.dumps(job)
+
+    def _timeout_params(self, end):
+        """:rtype: The query parameters passing the deadline on to Riak."""
+        timeout = self._server_timeout(end)
+        return {} if timeout is None else {"timeout" : timeout}
 
     def _build_rest_path(self, bucket=None, key=None, params=None, prefix=None):
         # Build "http://hostname:port/prefix/bucket"
-        path = "/" + (prefix or self._prefix)
-        if bucket is not None:
-            path += "/" + quote_plus(bucket)
+        if bucket is not None and prefix is None:
+            path = self._bucket_paths[bucket]
+        else:
+            path = "/" + (prefix or self._prefix)
+            if bucket is not None:
+                path += "/" + self._quote[bucket]
 
         if key is not None:
-            path += "/" + quote_plus(key)
+            path += "/" + self._quote[key]
 
-        if params is not None:
-            s = ""
-            for k in params.keys():
-                if s != "": s += "&"
-                s += quote_plus(k) + "=" + quote_plus(str(params[k]))
-            path += "?" + s
+        if params:
+            quote = self._quote
+            path += "?" + "&".join([quote[k] + "=" + quote_plus(str(v))
+                                    for k, v in params.iteritems()])
 
         return path
 
-    def _request(self, method, url, headers=None, body=""):
+    def _check_connection(self, conn):
+        """Called before conn is used. Closes it if it shouldn't be reused,
+        httplib reconnects on the next request."""
+        if conn.sock is None:
+            return
+        requests = getattr(conn, "_requests", 0)
+        last_used = getattr(conn, "_last_used", None)
+        if (self.max_requests is not None and requests >= self.max_requests) or \
+           (self.keepalive_timeout is not None and last_used is not None and
+            time.time() - last_used > self.keepalive_timeout) or \
+           self._is_stale(conn.sock):
+            conn.close()
+            with self._stats_lock:
+                self.reconnects += 1
+
+    def _is_stale(self, sock):
+        # An idle keep-alive socket has nothing to read. If it does, it's the
+        # server closing it (or garbage), either way it can't be used.
+        # select.select can't take descriptors past FD_SETSIZE, so poll, or
+        # peek where there's no poll.
+        try:
+            if hasattr(select, "poll"):
+                poller = select.poll()
+                poller.register(sock, select.POLLIN | select.POLLPRI)
+                return bool(poller.poll(0))
+            return self._can_read(sock)
+        except (select.error, socket.error):
+            return True
+
+    def _can_read(self, sock):
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            sock.recv(1, socket.MSG_PEEK) # Data or "", the end, alike.
+            return True
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        finally:
+            sock.settimeout(timeout)
+
+    def _send(self, conn, method, url, body, headers, timeout=None, op=None):
+        """:param body: A string, or a FileBody to stream.
+        :param timeout: The socket timeout, for connecting and for every
+                        read. None is the socket module's default.
+        :param op: The Operation to time the write and server phases in.
+        :rtype: The HTTPResponse. Its sock is the socket it is read from,
+                which conn may have closed already (on Connection: close):
+                the one under response.fp, left open for the response.
+        """
+        self._check_connection(conn)
+        self._settimeout(conn, timeout)
+        reused = conn.sock is not None
+        conn._requests = (getattr(conn, "_requests", 0) if reused else 0) + 1
+        with self._stats_lock:
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            else:
+                self.connects += 1
+        if isinstance(body, FileBody):
+            sent = self._send_file(conn, method, url, body, headers)
+        else:
+            conn.request(method, url, body, headers)
+            sent = len(body or "")
+        if op is not None:
+            op.mark("write")
+            op.bytes_out += sent
+        response = conn.getresponse()
+        if op is not None:
+            op.mark("server")
+        response.sock = response.fp._sock
+        conn._last_used = time.time()
+        return response
+
+    def _send_file(self, conn, method, url, body, headers):
+        # What conn.request does, with the body written as it's read.
+        names = set(name.lower() for name in headers)
+        conn.putrequest(method, url, skip_host="host" in names,
+                        skip_accept_encoding="accept-encoding" in names)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        if body.length is None:
+            conn.putheader("Transfer-Encoding", "chunked")
+        else:
+            conn.putheader("Content-Length", str(body.length))
+        conn.endheaders()
+        return body.send(conn.sock.sendall)
+
+    def _settimeout(self, conn, timeout):
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        conn.timeout = timeout # Used by connect()
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+    def _request(self, method, url, headers=None, body="", idempotent=None, end=None,
+                       op=None):
+        """Sends a request, retrying as the retry policy says.
+
+        :param idempotent: Whether sending the request twice is harmless.
+                           Defaults to True for everything but POST.
+        :param end: The deadline, as returned by _deadline().
+        :param op: The Operation this request is for, if instrumented.
+        :rtype: response headers, response body
+        """
         if headers is None: headers = {}
-
-        for retry in xrange(self.RETRY_COUNT):
-            with self._connections.withconn() as conn:
+        if idempotent is None: idempotent = method != "POST"
+
+        failed = []
+        def attempt():
+            if op is not None:
+                op.mark("retry" if op.attempts else "prepare")
+                op.attempts += 1
+            timeout = self._remaining(end)
+            with self._connections.withconn(timeout, exclude=failed) as conn:
+                if op is not None:
+                    op.mark("checkout")
+                    op.host = "%s:%s" % (conn.host, conn.port)
                 try:
-                    response = conn.request(method, url, body, headers)
-                    response = conn.getresponse()
+                    response = self._send(conn, method, url, body, headers, timeout, op)
                     try:
                         response_headers = {"http_code" : response.status}
                         for key, value in response.getheaders():
                             response_headers[key.lower()] = value
                         response_body = response.read()
+                        if op is not None:
+                            op.mark("read")
+                            op.bytes_in += len(response_body)
+                        self._connections.report_success(conn)
                         return response_headers, response_body
                     finally:
                         response.close()
-                except socket.error, e:
-                    conn.close()
-                    if e[0] == errno.ECONNRESET:
-                        continue
-                    raise e
-                except HTTPException, e:
+                except (socket.error, HTTPException):
                     conn.close()
-                    continue
+                    self._connections.report_failure(conn)
+                    failed.append((conn.host, conn.port))
+                    raise
+
+        return self.retry_policy.call(attempt, idempotent, end)
+
+    def _stream(self, method, url, headers=None, body="", expected_status=(200,), end=None,
+                      op=None):
+        """Like _request, but the body is read as it arrives.
+
+        A generator. The first item is the response headers, everything after
+        that is the body, in chunks. The connection is held until the body is
+        over. If the consumer stops early, the connection is closed since the
+        rest of the body is still in flight. Streams are not retried. The
+        deadline is for the whole stream. The time the consumer takes between
+        chunks is op's "consumer" phase.
+        """
+        if headers is None: headers = {}
 
-        # Raise the last error
-        raise e or ConnectionError("Some strange error has occured.")
+        if op is not None:
+            op.mark("prepare")
+            op.attempts += 1
+        timeout = self._remaining(end)
+        with self._connections.withconn(timeout) as conn:
+            if op is not None:
+                op.mark("checkout")
+                op.host = "%s:%s" % (conn.host, conn.port)
+            done = False
+            try:
+                response = self._send(conn, method, url, body, headers, timeout, op)
+                try:
+                    response_headers = {"http_code" : response.status}
+                    for key, value in response.getheaders():
+                        response_headers[key.lower()] = value
+                    if response.status not in expected_status:
+                        done = True # The body is read, the connection is fine.
+                        self._assert_http_code((response_headers, response.read()),
+                                               *expected_status)
+
+                    yield response_headers
+                    for chunk in iter_chunks(response):
+                        if op is not None:
+                            op.mark("read")
+                            op.bytes_in += len(chunk)
+                        yield chunk
+                        if op is not None:
+                            op.mark("consumer")
+                        if end is not None:
+                            response.sock.settimeout(self._remaining(end))
+                    done = True
+                    self._connections.report_success(conn)
+                finally:
+                    response.close()
+            except (socket.error, HTTPException):
+                conn.close()
+                self._connections.report_failure(conn)
+                raise
+            finally:
+                if not done:
+                    conn.close()
 
     def _assert_http_code_is_not(self, response, *unexpected_status):
         status = response[0]["http_code"]
@@ -305,56 +740,85 @@ class HttpTransport(Transport):
         if status == 404:
             return None
         elif status == 300:
-            siblings = data.strip().split("\n")
-            siblings.pop(0)
-            return siblings
+            boundary = multipart_boundary(headers.get("content-type", ""))
+            if boundary is None:
+                siblings = data.strip().split("\n")
+                siblings.pop(0)
+                return siblings # vtags
+            return self._parse_siblings(headers, data, boundary)
 
         vclock = None
-        metadata = {"usermeta" : {}, "index" : []}
+        usermeta = {}
+        indexes = []
         links = []
+        metadata = {"usermeta": usermeta, "index": indexes, "link": links}
 
+        # One pass, telling headers apart by their first 12 characters.
         for header, value in headers.iteritems(): # header keys are lowered in _request
-            if header == "x-riak-vclock":
+            kind = header[:12]
+            if kind == "x-riak-meta-":
+                usermeta[header[12:]] = value
+            elif kind == "x-riak-index" and header[12:13] == "-":
+                indexes.extend(self._parse_index(header[13:], value))
+            elif header == "x-riak-vclock":
                 vclock = value
-            elif header.startswith("x-riak-meta-"):
-                metadata["usermeta"][header[12:]] = value
-            elif header.startswith("x-riak-index-"):
-                field = header.replace("x-riak-index-", "")
-                reader = csv.reader([value], skipinitialspace=True)
-                for line in reader:
-                    for token in line:
-                        if field.endswith("_int"):
-                            token = int(token)
-                        metadata["index"].append((field, token))
             elif header == "link":
                 links.extend(self._parse_links(value))
             else:
                 metadata[header] = value
 
-        metadata["link"] = links
-
         return vclock, metadata, data
 
-    _link_regex = re.compile("</([^/]+)/([^/]+)/([^/]+)>; ?riaktag=\"([^\']+)\"")
+    def _parse_siblings(self, headers, data, boundary):
+        """Parses a multipart 300 response.
+
+        :rtype: A list of vclock, metadata, data tuples. One per sibling.
+        """
+        decoder = MultipartStreamDecoder(boundary)
+        parts = decoder.feed(data)
+        decoder.close()
+
+        siblings = []
+        for part_headers, body in parts:
+            part_headers["http_code"] = 200
+            if "x-riak-vclock" in headers:
+                part_headers["x-riak-vclock"] = headers["x-riak-vclock"]
+            siblings.append(self._parse_response((part_headers, body), 200))
+        return siblings
+
+    # Every link with a tag, in one go. The link to the bucket, and links
+    # without a tag, don't match.
+    _link_regex = re.compile("</[^/>]+/([^/>]+)/([^/>]+)>; ?riaktag=\"([^\"]+)\"")
     def _parse_links(self, links):
         """returns bucket, key, tag"""
-        new_links = []
-        for link_header in links.strip().split(','):
-            link_header = link_header.strip()
-            matches = self._link_regex.match(link_header)
-            if matches is not None:
-                # bucket, key, tag
-                new_links.append((matches.group(2),
-                                  matches.group(3),
-                                  matches.group(4)))
-        return new_links
+        return self._link_regex.findall(links)
+
+    _decode_json = json.JSONDecoder().raw_decode
+    def _parse_index(self, field, value):
+        """:rtype: A list of (field, value), one per value of an index header."""
+        if field.endswith("_int") and value:
+            # A JSON list, as far as the (C) JSON scanner is concerned, which
+            # beats int() on every value. Unless it has anything but integers
+            # in (floats, NaN, true, strings...): int() takes it, or raises.
+            text = "[" + value + "]"
+            try:
+                values, end = self._decode_json(text)
+                if end == len(text) and all(type(v) in (int, long) for v in values):
+                    return [(field, v) for v in values]
+            except ValueError:
+                pass
+            return [(field, int(token)) for token in value.split(",")]
+
+        if '"' in value: # Quoted, there may be commas in the values.
+            tokens = next(csv.reader([value], skipinitialspace=True), [])
+        elif value:
+            tokens = [token.lstrip(" ") for token in value.split(",")]
+        else:
+            tokens = []
+        return [(field, token) for token in tokens]
 
     def _to_link_header(self, bucket, key, tag):
-        header = '</'
-        header += self._prefix + '/'
-        header += quote_plus(bucket) + '/'
-        header += quote_plus(key) + '>; riaktag="'
-        header += quote_plus(tag) + '"'
-        return header
+        quote = self._quote
+        return '</%s/%s/%s>; riaktag="%s"' % (self._prefix, quote[bucket], quote[key], quote[tag])
 
 
@@ -0,0 +1,207 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from bisect import bisect_left
+import threading
+import time
+
+class Instrument(object):
+    """Gets told about every operation: transport requests (get, put,
+    index, ...) and the RObject paths on top of them (load, store).
+
+    Give one to Client(instrument=...), or set transport.instrument. begin()
+    is called when an operation starts and end() when it's over, both with
+    the Operation. Both are called from whatever thread runs the
+    operation, so they should be quick and thread safe. Subclass and
+    override either.
+    """
+
+    def begin(self, op):
+        pass
+
+    def end(self, op):
+        pass
+
+
+class Operation(object):
+    """One operation, as seen by an Instrument.
+
+    Phases are timed by marking their end: mark(phase) adds the time since
+    the previous mark (or the start) to phase. The transports use
+    "prepare" (up to the first attempt), "retry" (waiting before another
+    one), "checkout" (getting a connection), "write" (sending the request),
+    "server" (waiting for the response headers, HTTP only), "read"
+    (reading the response) and "parse". RObject uses "fetch" or "send"
+    (the transport call), "encode" and "decode".
+    """
+
+    def __init__(self, instrument, name, bucket=None):
+        self.instrument = instrument
+        self.name = name
+        self.bucket = bucket
+        # host:port of the node the (last) attempt went to, if any.
+        self.host = None
+        self.attempts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # phase: seconds
+        self.phases = {}
+        # The exception the operation ended with, if any.
+        self.error = None
+        # Seconds, once over.
+        self.duration = None
+
+        self.start = self._last = time.time()
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def __enter__(self):
+        self.instrument.begin(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.duration = time.time() - self.start
+        if value is not None and not isinstance(value, GeneratorExit): # Stopped early.
+            self.error = value
+        self.instrument.end(self)
+        return False
+
+
+class _Disabled(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+_DISABLED = _Disabled()
+
+def operation(instrument, name, bucket=None):
+    """A context manager around an operation. It gives the Operation, or
+    None if instrument is None. In which case it costs next to nothing.
+
+        with operation(self.instrument, "get", bucket) as op:
+            ...
+            if op is not None:
+                op.mark("parse")
+    """
+    if instrument is None:
+        return _DISABLED
+    return Operation(instrument, name, bucket)
+
+
+class Histogram(object):
+    """Counts of durations, in buckets growing by 10% from 10us to about
+    10 minutes. Percentiles are as precise as the buckets they fall in."""
+
+    BOUNDS = []
+    _bound = 0.00001
+    while _bound < 600:
+        BOUNDS.append(_bound)
+        _bound *= 1.1
+    del _bound
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """:param p: Between 0 and 100.
+        :rtype: Seconds. The upper bound of the bucket the percentile falls
+                in, or the maximum if that is lower. 0 if empty."""
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return 0.0
+
+    def summary(self):
+        """:rtype: A dictionary of count, mean, p50, p95, p99 and max."""
+        return {"count": self.count, "mean": self.total / (self.count or 1),
+                "p50": self.percentile(50), "p95": self.percentile(95),
+                "p99": self.percentile(99), "max": self.max}
+
+
+class HistogramCollector(Instrument):
+    """Keeps a latency histogram per operation, and per operation and host
+    and per operation and phase, in memory.
+
+        collector = HistogramCollector()
+        client = Client(instrument=collector)
+        ...
+        collector.stats()["get"]["p99"]
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def end(self, op):
+        with self._lock:
+            stats = self._operations.get(op.name)
+            if stats is None:
+                stats = self._operations[op.name] = {"all": Histogram(), "hosts": {},
+                                                     "phases": {}, "errors": 0,
+                                                     "bytes_in": 0, "bytes_out": 0}
+            stats["all"].add(op.duration)
+            if op.host is not None:
+                hosts = stats["hosts"]
+                if op.host not in hosts:
+                    hosts[op.host] = Histogram()
+                hosts[op.host].add(op.duration)
+            phases = stats["phases"]
+            for phase, seconds in op.phases.iteritems():
+                if phase not in phases:
+                    phases[phase] = Histogram()
+                phases[phase].add(seconds)
+            if op.error is not None:
+                stats["errors"] += 1
+            stats["bytes_in"] += op.bytes_in
+            stats["bytes_out"] += op.bytes_out
+
+    def stats(self):
+        """:rtype: A dictionary of operation name to its Histogram.summary(),
+                plus errors, bytes_in and bytes_out totals, hosts (host to
+                summary) and phases (phase to summary)."""
+        result = {}
+        with self._lock:
+            for name, stats in self._operations.iteritems():
+                summary = stats["all"].summary()
+                summary["errors"] = stats["errors"]
+                summary["bytes_in"] = stats["bytes_in"]
+                summary["bytes_out"] = stats["bytes_out"]
+                summary["hosts"] = dict((host, h.summary()) for host, h in stats["hosts"].iteritems())
+                summary["phases"] = dict((phase, h.summary()) for phase, h in stats["phases"].iteritems())
+                result[name] = summary
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
@@ -17,7 +17,480 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from exceptions import ConnectionError, RiakError
 from transport import Transport
+from connection import ConnectionManager
+from retry import RetryPolicy
+from instrument import operation
+from stream import ChunkReader
+from email.utils import formatdate
+import riakpb
+import errno
+import json
+import socket
+import struct
+
+class PbcConnection(object):
+    """A single socket to a Riak PB endpoint.
+
+    Like httplib.HTTPConnection, it connects lazily on first use and can be
+    reused after close(), so the ConnectionManager can pool it the same way.
+    """
+
+    def __init__(self, host, port=8087):
+        self.host = host
+        self.port = port
+        self.sock = None
+        # Socket timeout, for connecting and every read. See settimeout()
+        self.timeout = None
+        # The client id this socket has been told about, if any.
+        self.client_id = None
+        # Bytes sent and received over this connection, in whole messages.
+        self.sent = 0
+        self.received = 0
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.client_id = None
+
+    def send_msg(self, code, msg=None):
+        if self.sock is None:
+            self.connect()
+        data = riakpb.frame(code, msg)
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+    def _recv(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise socket.error(errno.ECONNRESET, "Connection closed by server")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def recv_msg(self):
+        """Reads a single frame.
+
+        :rtype: A 2 item tuple of message code and the decoded message.
+        """
+        length, code = struct.unpack("!IB", self._recv(5))
+        body = self._recv(length - 1) if length > 1 else ""
+        self.received += length + 4
+        return code, riakpb.parse(code, body)
+
 
 class PbcTransport(Transport):
     api = 2
+    connection_class = PbcConnection
+    default_port = 8087
+
+    # Bucket properties that riak_pb knows about.
+    _QUORUM_PROPS = ("pr", "r", "w", "pw", "dw", "rw")
+    _HOOK_PROPS = ("precommit", "postcommit")
+
+    def __init__(self, cm=None, client_id=None, prefix=None,
+                 mapred_prefix=None, retry_policy=None, deadline=None, instrument=None):
+        """prefix and mapred_prefix are only there so this can be swapped in
+        for HttpTransport. They mean nothing to PBC.
+
+        :param retry_policy: A RetryPolicy. Defaults to RetryPolicy()
+        :param deadline: Default deadline of a request, in seconds.
+        :param instrument: An Instrument to tell about every operation.
+        """
+        if cm is None:
+            cm = ConnectionManager.get_pbc_cm()
+        self._connections = cm
+        self.client_id = client_id or self.random_client_id()
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.deadline = deadline
+        self.instrument = instrument
+
+    def ping(self, deadline=None):
+        with operation(self.instrument, "ping") as op:
+            self._request(riakpb.PING_REQ, None, riakpb.PING_RESP, end=self._deadline(deadline),
+                          op=op)
+            return True
+
+    def get(self, bucket, key, r=None, vtag=None, if_modified=None, deadline=None):
+        with operation(self.instrument, "get", bucket) as op:
+            end = self._deadline(deadline)
+            msg = {"bucket": bucket, "key": key, "r": riakpb.quorum(r),
+                   "timeout": self._server_timeout(end)}
+            if if_modified is not None and if_modified[0]:
+                msg["if_modified"] = if_modified[0]
+            code, response = self._request(riakpb.GET_REQ, msg, riakpb.GET_RESP, end=end, op=op)
+            if response.get("unchanged"):
+                return if_modified
+            contents = response["content"]
+            if len(contents) == 0:
+                return None
+
+            vclock = response.get("vclock")
+            if vtag is not None:
+                # PB returns all siblings at once. Pick the one that was asked for.
+                for content in contents:
+                    if content.get("vtag") == vtag:
+                        return self._parse_content(vclock, content)
+                return None
+
+            result = self._parse_contents(vclock, contents)
+            if op is not None:
+                op.mark("parse")
+            return result
+
+    def get_stream(self, bucket, key, r=None, deadline=None):
+        # A protocol buffers message only comes whole, so does the value.
+        result = self.get(bucket, key, r, deadline=deadline)
+        if isinstance(result, tuple):
+            vclock, metadata, data = result
+            result = vclock, metadata, ChunkReader([data])
+        return result
+
+    def put(self, bucket, key, content, meta, w=None, dw=None, return_body=True,
+                  deadline=None):
+        with operation(self.instrument, "put", bucket) as op:
+            end = self._deadline(deadline)
+            if hasattr(content, "read"): # Same here, the message is sent whole.
+                content = content.read()
+            msg = {
+                "bucket": bucket,
+                "key": key,
+                "vclock": meta.get("vclock"),
+                "content": self._build_content(content, meta),
+                "w": riakpb.quorum(w),
+                "dw": riakpb.quorum(dw),
+                "return_body": return_body,
+                "timeout": self._server_timeout(end)
+            }
+            # Without a key, Riak makes one up. Twice if we send it twice.
+            code, response = self._request(riakpb.PUT_REQ, msg, riakpb.PUT_RESP,
+                                           idempotent=key is not None, end=end, op=op)
+            vclock = response.get("vclock")
+            contents = response["content"]
+
+            if key is None:
+                key = response["key"]
+                if return_body and contents:
+                    return key, vclock, self._parse_content(vclock, contents[0])[1]
+                return key, None, None
+
+            if return_body and contents:
+                result = self._parse_contents(vclock, contents)
+                if op is not None:
+                    op.mark("parse")
+                return result
+            return None, None, None
+
+    def delete(self, bucket, key, rw=None, deadline=None):
+        with operation(self.instrument, "delete", bucket) as op:
+            end = self._deadline(deadline)
+            msg = {"bucket": bucket, "key": key, "rw": riakpb.quorum(rw),
+                   "timeout": self._server_timeout(end)}
+            self._request(riakpb.DEL_REQ, msg, riakpb.DEL_RESP, end=end, op=op)
+
+    def get_keys(self, bucket, deadline=None):
+        return list(self.stream_keys(bucket, deadline))
+
+    def stream_keys(self, bucket, deadline=None):
+        with operation(self.instrument, "stream_keys", bucket) as op:
+            end = self._deadline(deadline)
+            msg = {"bucket": bucket, "timeout": self._server_timeout(end)}
+            for response in self._stream(riakpb.LIST_KEYS_REQ, msg, riakpb.LIST_KEYS_RESP, end,
+                                         op):
+                for key in response["keys"]:
+                    yield key
+
+    def get_buckets(self, deadline=None):
+        with operation(self.instrument, "get_buckets") as op:
+            # Older nodes don't take a body (and so a timeout) with this one.
+            code, response = self._request(riakpb.LIST_BUCKETS_REQ, None,
+                                           riakpb.LIST_BUCKETS_RESP, end=self._deadline(deadline),
+                                           op=op)
+            return response["buckets"]
+
+    def stream_buckets(self, deadline=None):
+        # RpbListBucketsResp comes in one piece.
+        return iter(self.get_buckets(deadline))
+
+    def get_bucket_properties(self, bucket, deadline=None):
+        with operation(self.instrument, "get_bucket_properties", bucket) as op:
+            code, response = self._request(riakpb.GET_BUCKET_REQ, {"bucket": bucket},
+                                           riakpb.GET_BUCKET_RESP, end=self._deadline(deadline),
+                                           op=op)
+            props = {}
+            for name, value in response.get("props", {}).iteritems():
+                if name in self._QUORUM_PROPS:
+                    value = riakpb.QUORUMS_REVERSED.get(value, value)
+                elif name in self._HOOK_PROPS:
+                    value = [self._decode_hook(hook) for hook in value]
+                elif name.startswith("has_"):
+                    continue
+                props[name] = value
+            return props
+
+    def set_bucket_properties(self, bucket, properties, deadline=None):
+        fields = riakpb.MESSAGES["RpbBucketProps"]
+        known = set(f[1] for f in fields)
+        props = {}
+        for name, value in properties.iteritems():
+            if name not in known or name.startswith("has_"):
+                raise ValueError("Bucket property %s is not supported over PBC" % name)
+            if name in self._QUORUM_PROPS:
+                value = riakpb.quorum(value)
+            elif name in self._HOOK_PROPS:
+                props["has_" + name] = True
+                value = [self._encode_hook(hook) for hook in value]
+            props[name] = value
+
+        with operation(self.instrument, "set_bucket_properties", bucket) as op:
+            self._request(riakpb.SET_BUCKET_REQ, {"bucket": bucket, "props": props},
+                          riakpb.SET_BUCKET_RESP, end=self._deadline(deadline), op=op)
+
+    def index(self, bucket, field, start, end=None, deadline=None):
+        return self.index_page(bucket, field, start, end, deadline=deadline)[0]
+
+    def index_page(self, bucket, field, start, end=None, return_terms=False, max_results=None,
+                         continuation=None, deadline=None):
+        with operation(self.instrument, "index", bucket) as op:
+            until = self._deadline(deadline) # end is taken.
+            msg = self._index_msg(bucket, field, start, end, until, return_terms, max_results,
+                                  continuation)
+            code, response = self._request(riakpb.INDEX_REQ, msg, riakpb.INDEX_RESP, end=until,
+                                           op=op)
+            return (self._index_results(field, start, response, return_terms),
+                    response.get("continuation"))
+
+    def stream_index(self, bucket, field, start, end=None, return_terms=False,
+                           max_results=None, continuation=None, deadline=None):
+        with operation(self.instrument, "stream_index", bucket) as op:
+            until = self._deadline(deadline)
+            msg = self._index_msg(bucket, field, start, end, until, return_terms, max_results,
+                                  continuation)
+            msg["stream"] = True
+            for response in self._stream(riakpb.INDEX_REQ, msg, riakpb.INDEX_RESP, until, op):
+                yield (self._index_results(field, start, response, return_terms),
+                       response.get("continuation"))
+
+    def _index_msg(self, bucket, field, start, end, until, return_terms, max_results,
+                         continuation):
+        msg = {"bucket": bucket, "index": field, "timeout": self._server_timeout(until)}
+        if end is None:
+            msg["qtype"] = riakpb.INDEX_EQ
+            msg["key"] = str(start)
+        else:
+            msg["qtype"] = riakpb.INDEX_RANGE
+            msg["range_min"] = str(start)
+            msg["range_max"] = str(end)
+        if return_terms:
+            msg["return_terms"] = True
+        if max_results is not None:
+            msg["max_results"] = max_results
+        if continuation is not None:
+            msg["continuation"] = continuation
+        return msg
+
+    def _index_results(self, field, start, response, return_terms):
+        if not return_terms:
+            return response.get("keys", [])
+        if not response.get("results"): # Exact matches come without their term.
+            return [(start, key) for key in response.get("keys", [])]
+        is_int = field.endswith("_int")
+        return [(int(pair["key"]) if is_int else pair["key"], pair["value"])
+                for pair in response["results"]]
+
+    def mapreduce(self, inputs, query, timeout=None, deadline=None):
+        phases = {}
+        for phase, results in self.stream_mapreduce(inputs, query, timeout, deadline):
+            phases.setdefault(phase, []).extend(results)
+
+        if len(phases) == 0:
+            return []
+        elif len(phases) == 1:
+            return phases.values()[0]
+        return [phases[phase] for phase in sorted(phases)]
+
+    def stream_mapreduce(self, inputs, query, timeout=None, deadline=None):
+        with operation(self.instrument, "stream_mapreduce") as op:
+            end = self._deadline(deadline)
+            job = {"inputs": inputs, "query": query}
+            if timeout is None:
+                timeout = self._server_timeout(end)
+            if timeout is not None:
+                job["timeout"] = timeout
+            msg = {"request": json.dumps(job), "content_type": "application/json"}
+
+            for response in self._stream(riakpb.MAPRED_REQ, msg, riakpb.MAPRED_RESP, end, op):
+                if "response" in response:
+                    yield response.get("phase", 0), json.loads(response["response"])
+
+    def _parse_contents(self, vclock, contents):
+        if len(contents) > 1:
+            return [self._parse_content(vclock, content) for content in contents]
+        return self._parse_content(vclock, contents[0])
+
+    def _parse_content(self, vclock, content):
+        """Turns a RpbContent into the same vclock, metadata, data tuple that
+        HttpTransport returns."""
+        metadata = {
+            "usermeta": dict((p["key"], p.get("value")) for p in content["usermeta"]),
+            "index": [],
+            "link": [(l.get("bucket"), l.get("key"), l.get("tag"))
+                     for l in content["links"]],
+            "content-type": content.get("content_type", "application/octet-stream")
+        }
+        for pair in content["indexes"]:
+            field = pair["key"]
+            value = pair.get("value")
+            if field.endswith("_int"):
+                value = int(value)
+            metadata["index"].append((field, value))
+
+        if "vtag" in content:
+            metadata["etag"] = content["vtag"]
+        if "charset" in content:
+            metadata["charset"] = content["charset"]
+        if "content_encoding" in content:
+            metadata["content-encoding"] = content["content_encoding"]
+        if "last_mod" in content:
+            metadata["last-modified"] = formatdate(content["last_mod"], usegmt=True)
+
+        return vclock, metadata, content.get("value", "")
+
+    def _build_content(self, content, meta):
+        result = {
+            "value": content,
+            "content_type": meta.get("content_type", "application/json"),
+            "links": [{"bucket": b, "key": k, "tag": t}
+                      for b, k, t in meta.get("links", [])],
+            "usermeta": [{"key": k, "value": v}
+                         for k, v in meta.get("usermeta", {}).iteritems()],
+            "indexes": [{"key": f, "value": str(v)}
+                        for f, v in meta.get("indexes", [])]
+        }
+        if meta.get("content_encoding"):
+            result["content_encoding"] = meta["content_encoding"]
+        return result
+
+    def _encode_hook(self, hook):
+        if "name" in hook:
+            return {"name": hook["name"]}
+        return {"modfun": {"module": hook["mod"], "function": hook["fun"]}}
+
+    def _decode_hook(self, hook):
+        if "modfun" in hook:
+            return {"mod": hook["modfun"]["module"], "fun": hook["modfun"]["function"]}
+        return {"name": hook["name"]}
+
+    def _ensure_client_id(self, conn):
+        if conn.client_id != self.client_id:
+            conn.send_msg(riakpb.SET_CLIENT_ID_REQ, {"client_id": self.client_id})
+            self._check(conn.recv_msg(), riakpb.SET_CLIENT_ID_RESP)
+            conn.client_id = self.client_id
+
+    def _check(self, response, expected_code):
+        code, msg = response
+        if code == riakpb.ERROR_RESP:
+            raise RiakError(msg.get("errmsg", "Unknown error"))
+        if code != expected_code:
+            raise ConnectionError("Expected Message Code: %d | Received: %d" % (expected_code, code))
+        return response
+
+    def _request(self, code, msg, expected_code, idempotent=True, end=None, op=None):
+        """Sends one message and reads one message back, retrying as the
+        retry policy says.
+
+        :param idempotent: Whether sending the message twice is harmless.
+        :param end: The deadline, as returned by _deadline().
+        :param op: The Operation this request is for, if instrumented.
+        :rtype: A 2 item tuple of message code and decoded message.
+        """
+        failed = []
+        def attempt():
+            if op is not None:
+                op.mark("retry" if op.attempts else "prepare")
+                op.attempts += 1
+            timeout = self._remaining(end)
+            with self._connections.withconn(timeout, exclude=failed) as conn:
+                if op is not None:
+                    op.mark("checkout")
+                    op.host = "%s:%s" % (conn.host, conn.port)
+                    sent, received = conn.sent, conn.received
+                try:
+                    conn.settimeout(timeout)
+                    self._ensure_client_id(conn)
+                    conn.send_msg(code, msg)
+                    if op is not None:
+                        op.mark("write")
+                    response = conn.recv_msg()
+                    if op is not None:
+                        op.mark("read")
+                        op.bytes_out += conn.sent - sent
+                        op.bytes_in += conn.received - received
+                    self._connections.report_success(conn)
+                    return self._check(response, expected_code)
+                except socket.error:
+                    conn.close()
+                    self._connections.report_failure(conn)
+                    failed.append((conn.host, conn.port))
+                    raise
+
+        return self.retry_policy.call(attempt, idempotent, end)
+
+    def _stream(self, code, msg, expected_code, end=None, op=None):
+        """Sends one message and yields responses until one of them is done.
+
+        The connection is held for the whole stream. If the consumer stops
+        early, the connection is closed since it still has data in flight.
+        The deadline is for the whole stream. The time the consumer takes
+        between responses is op's "consumer" phase.
+        """
+        if op is not None:
+            op.mark("prepare")
+            op.attempts += 1
+        timeout = self._remaining(end)
+        with self._connections.withconn(timeout) as conn:
+            if op is not None:
+                op.mark("checkout")
+                op.host = "%s:%s" % (conn.host, conn.port)
+                sent = conn.sent
+            done = False
+            try:
+                conn.settimeout(timeout)
+                self._ensure_client_id(conn)
+                conn.send_msg(code, msg)
+                if op is not None:
+                    op.mark("write")
+                    op.bytes_out += conn.sent - sent
+                while not done:
+                    if end is not None:
+                        conn.settimeout(self._remaining(end))
+                    received = conn.received
+                    code, response = self._check(conn.recv_msg(), expected_code)
+                    if op is not None:
+                        op.mark("read")
+                        op.bytes_in += conn.received - received
+                    done = response.get("done", False)
+                    yield response
+                    if op is not None:
+                        op.mark("consumer")
+                self._connections.report_success(conn)
+            except socket.error:
+                conn.close()
+                self._connections.report_failure(conn)
+                raise
+            finally:
+                if not done:
+                    conn.close()
@@ -0,0 +1,106 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from httplib import HTTPException
+import errno
+import random
+import socket
+import sys
+import time
+
+class RetryPolicy(object):
+    """Decides whether a failed request is tried again, and when.
+
+    Only connection level errors are retried. Errors coming from Riak itself
+    are not, trying again wouldn't help. Requests that are not idempotent
+    (storing without a key, which makes Riak pick one) are only retried if
+    they never made it out: the connection was refused.
+
+    Retries wait backoff * multiplier ** (retries so far), up to max_backoff,
+    with full jitter: the actual wait is random, between 0 and that. So
+    clients that failed at the same time don't all come back at the same
+    time. deadline bounds the time spent on a request, retries included: a
+    retry that would start after it isn't made.
+
+    The transports take a retry_policy. Subclass and override should_retry()
+    or delay() for anything fancier.
+    """
+
+    # Nothing was sent, trying again is always safe.
+    NOT_SENT = (errno.ECONNREFUSED,)
+    # The connection broke. The request may or may not have been processed.
+    BROKEN = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED, errno.ETIMEDOUT)
+
+    def __init__(self, attempts=3, backoff=0.05, multiplier=2.0, max_backoff=2.0,
+                       jitter=True, deadline=None):
+        """
+        :param attempts: Maximum number of attempts, the first one included.
+        :param backoff: Seconds to wait before the first retry.
+        :param multiplier: How much longer each retry waits than the last one.
+        :param max_backoff: Upper bound of the wait.
+        :param jitter: Randomize the wait.
+        :param deadline: Seconds a request may take, retries and waits
+                         included. None is no limit.
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def should_retry(self, error, attempt, idempotent):
+        """:param attempt: The number of attempts made so far."""
+        if attempt >= self.attempts:
+            return False
+        if isinstance(error, socket.error):
+            code = error.errno
+            if code in self.NOT_SENT:
+                return True
+            return idempotent and (isinstance(error, socket.timeout) or code in self.BROKEN)
+        return idempotent and isinstance(error, HTTPException)
+
+    def delay(self, attempt):
+        """:rtype: Seconds to wait before attempt + 1."""
+        delay = min(self.backoff * self.multiplier ** (attempt - 1), self.max_backoff)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def call(self, func, idempotent=True, deadline=None):
+        """Calls func() until it succeeds or it's not worth trying again, in
+        which case the last error is raised.
+
+        :param deadline: A time.time() past which no retry is started, on top
+                         of the policy's own deadline.
+        :rtype: Whatever func returns.
+        """
+        if self.deadline is not None:
+            end = time.time() + self.deadline
+            deadline = end if deadline is None else min(deadline, end)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func()
+            except Exception:
+                exc_info = sys.exc_info()
+                if not self.should_retry(exc_info[1], attempt, idempotent):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                delay = self.delay(attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if delay > 0:
+                    time.sleep(delay)
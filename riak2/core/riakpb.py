@@ -0,0 +1,407 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""A tiny protocol buffers codec for the messages in riak_pb.
+
+We don't want to depend on the protobuf library (or on riak_pb's generated
+code), and the subset of protobuf that Riak uses is small: varints, bools and
+length delimited bytes/messages. Messages are plain dictionaries. Repeated
+fields are lists. Unset fields are simply left out of the dictionary.
+
+Framing on the wire is a 4 byte big endian length (which counts the message
+code), a 1 byte message code and then the encoded message.
+"""
+
+import struct
+
+# Message codes
+ERROR_RESP = 0
+PING_REQ = 1
+PING_RESP = 2
+GET_CLIENT_ID_REQ = 3
+GET_CLIENT_ID_RESP = 4
+SET_CLIENT_ID_REQ = 5
+SET_CLIENT_ID_RESP = 6
+GET_SERVER_INFO_REQ = 7
+GET_SERVER_INFO_RESP = 8
+GET_REQ = 9
+GET_RESP = 10
+PUT_REQ = 11
+PUT_RESP = 12
+DEL_REQ = 13
+DEL_RESP = 14
+LIST_BUCKETS_REQ = 15
+LIST_BUCKETS_RESP = 16
+LIST_KEYS_REQ = 17
+LIST_KEYS_RESP = 18
+GET_BUCKET_REQ = 19
+GET_BUCKET_RESP = 20
+SET_BUCKET_REQ = 21
+SET_BUCKET_RESP = 22
+MAPRED_REQ = 23
+MAPRED_RESP = 24
+INDEX_REQ = 25
+INDEX_RESP = 26
+
+# Symbolic quorum values, as riak_pb encodes them.
+QUORUMS = {
+    "one": 0xfffffffe,
+    "quorum": 0xfffffffd,
+    "all": 0xfffffffc,
+    "default": 0xfffffffb
+}
+QUORUMS_REVERSED = dict((v, k) for k, v in QUORUMS.iteritems())
+
+INDEX_EQ = 0
+INDEX_RANGE = 1
+
+UINT32 = "uint32"
+BOOL = "bool"
+BYTES = "bytes"
+
+# name: ((field number, field name, type, repeated), ...)
+# type is either one of the above or the name of another message.
+MESSAGES = {
+    "RpbErrorResp": (
+        (1, "errmsg", BYTES, False),
+        (2, "errcode", UINT32, False),
+    ),
+    "RpbSetClientIdReq": (
+        (1, "client_id", BYTES, False),
+    ),
+    "RpbPair": (
+        (1, "key", BYTES, False),
+        (2, "value", BYTES, False),
+    ),
+    "RpbLink": (
+        (1, "bucket", BYTES, False),
+        (2, "key", BYTES, False),
+        (3, "tag", BYTES, False),
+    ),
+    "RpbContent": (
+        (1, "value", BYTES, False),
+        (2, "content_type", BYTES, False),
+        (3, "charset", BYTES, False),
+        (4, "content_encoding", BYTES, False),
+        (5, "vtag", BYTES, False),
+        (6, "links", "RpbLink", True),
+        (7, "last_mod", UINT32, False),
+        (8, "last_mod_usecs", UINT32, False),
+        (9, "usermeta", "RpbPair", True),
+        (10, "indexes", "RpbPair", True),
+        (11, "deleted", BOOL, False),
+    ),
+    "RpbGetReq": (
+        (1, "bucket", BYTES, False),
+        (2, "key", BYTES, False),
+        (3, "r", UINT32, False),
+        (4, "pr", UINT32, False),
+        (5, "basic_quorum", BOOL, False),
+        (6, "notfound_ok", BOOL, False),
+        (7, "if_modified", BYTES, False),
+        (8, "head", BOOL, False),
+        (9, "deletedvclock", BOOL, False),
+        (10, "timeout", UINT32, False),
+    ),
+    "RpbGetResp": (
+        (1, "content", "RpbContent", True),
+        (2, "vclock", BYTES, False),
+        (3, "unchanged", BOOL, False),
+    ),
+    "RpbPutReq": (
+        (1, "bucket", BYTES, False),
+        (2, "key", BYTES, False),
+        (3, "vclock", BYTES, False),
+        (4, "content", "RpbContent", False),
+        (5, "w", UINT32, False),
+        (6, "dw", UINT32, False),
+        (7, "return_body", BOOL, False),
+        (8, "pw", UINT32, False),
+        (9, "if_not_modified", BOOL, False),
+        (10, "if_none_match", BOOL, False),
+        (11, "return_head", BOOL, False),
+        (12, "timeout", UINT32, False),
+    ),
+    "RpbPutResp": (
+        (1, "content", "RpbContent", True),
+        (2, "vclock", BYTES, False),
+        (3, "key", BYTES, False),
+    ),
+    "RpbDelReq": (
+        (1, "bucket", BYTES, False),
+        (2, "key", BYTES, False),
+        (3, "rw", UINT32, False),
+        (4, "vclock", BYTES, False),
+        (10, "timeout", UINT32, False),
+    ),
+    "RpbListBucketsResp": (
+        (1, "buckets", BYTES, True),
+    ),
+    "RpbListKeysReq": (
+        (1, "bucket", BYTES, False),
+        (2, "timeout", UINT32, False),
+    ),
+    "RpbListKeysResp": (
+        (1, "keys", BYTES, True),
+        (2, "done", BOOL, False),
+    ),
+    "RpbModFun": (
+        (1, "module", BYTES, False),
+        (2, "function", BYTES, False),
+    ),
+    "RpbCommitHook": (
+        (1, "modfun", "RpbModFun", False),
+        (2, "name", BYTES, False),
+    ),
+    "RpbBucketProps": (
+        (1, "n_val", UINT32, False),
+        (2, "allow_mult", BOOL, False),
+        (3, "last_write_wins", BOOL, False),
+        (4, "precommit", "RpbCommitHook", True),
+        (5, "has_precommit", BOOL, False),
+        (6, "postcommit", "RpbCommitHook", True),
+        (7, "has_postcommit", BOOL, False),
+        (10, "old_vclock", UINT32, False),
+        (11, "young_vclock", UINT32, False),
+        (12, "big_vclock", UINT32, False),
+        (13, "small_vclock", UINT32, False),
+        (14, "pr", UINT32, False),
+        (15, "r", UINT32, False),
+        (16, "w", UINT32, False),
+        (17, "pw", UINT32, False),
+        (18, "dw", UINT32, False),
+        (19, "rw", UINT32, False),
+        (20, "basic_quorum", BOOL, False),
+        (21, "notfound_ok", BOOL, False),
+        (22, "backend", BYTES, False),
+        (23, "search", BOOL, False),
+    ),
+    "RpbGetBucketReq": (
+        (1, "bucket", BYTES, False),
+    ),
+    "RpbGetBucketResp": (
+        (1, "props", "RpbBucketProps", False),
+    ),
+    "RpbSetBucketReq": (
+        (1, "bucket", BYTES, False),
+        (2, "props", "RpbBucketProps", False),
+    ),
+    "RpbMapRedReq": (
+        (1, "request", BYTES, False),
+        (2, "content_type", BYTES, False),
+    ),
+    "RpbMapRedResp": (
+        (1, "phase", UINT32, False),
+        (2, "response", BYTES, False),
+        (3, "done", BOOL, False),
+    ),
+    "RpbIndexReq": (
+        (1, "bucket", BYTES, False),
+        (2, "index", BYTES, False),
+        (3, "qtype", UINT32, False),
+        (4, "key", BYTES, False),
+        (5, "range_min", BYTES, False),
+        (6, "range_max", BYTES, False),
+        (7, "return_terms", BOOL, False),
+        (8, "stream", BOOL, False),
+        (9, "max_results", UINT32, False),
+        (10, "continuation", BYTES, False),
+        (11, "timeout", UINT32, False),
+    ),
+    "RpbIndexResp": (
+        (1, "keys", BYTES, True),
+        (2, "results", "RpbPair", True),
+        (3, "continuation", BYTES, False),
+        (4, "done", BOOL, False),
+    ),
+}
+
+# Which message goes with which code. Codes with no entry have empty bodies.
+CODES = {
+    ERROR_RESP: "RpbErrorResp",
+    SET_CLIENT_ID_REQ: "RpbSetClientIdReq",
+    GET_REQ: "RpbGetReq",
+    GET_RESP: "RpbGetResp",
+    PUT_REQ: "RpbPutReq",
+    PUT_RESP: "RpbPutResp",
+    DEL_REQ: "RpbDelReq",
+    LIST_BUCKETS_RESP: "RpbListBucketsResp",
+    LIST_KEYS_REQ: "RpbListKeysReq",
+    LIST_KEYS_RESP: "RpbListKeysResp",
+    GET_BUCKET_REQ: "RpbGetBucketReq",
+    GET_BUCKET_RESP: "RpbGetBucketResp",
+    SET_BUCKET_REQ: "RpbSetBucketReq",
+    MAPRED_REQ: "RpbMapRedReq",
+    MAPRED_RESP: "RpbMapRedResp",
+    INDEX_REQ: "RpbIndexReq",
+    INDEX_RESP: "RpbIndexResp",
+}
+
+_by_name = {}
+for _name, _fields in MESSAGES.iteritems():
+    _by_name[_name] = dict((f[1], f) for f in _fields)
+_by_number = {}
+for _name, _fields in MESSAGES.iteritems():
+    _by_number[_name] = dict((f[0], f) for f in _fields)
+
+def _encode_varint(value, out):
+    """Appends the varint encoding of a non-negative integer to out."""
+    bits = value & 0x7f
+    value >>= 7
+    while value:
+        out.append(chr(0x80 | bits))
+        bits = value & 0x7f
+        value >>= 7
+    out.append(chr(bits))
+
+_tags = {}
+for _name, _fields in MESSAGES.iteritems():
+    for _number, _fname, _ftype, _repeated in _fields:
+        _tag = []
+        _encode_varint((_number << 3) | (0 if _ftype in (UINT32, BOOL) else 2), _tag)
+        _tags[(_name, _number)] = "".join(_tag)
+
+def _decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def _encode_value(ftype, value, out):
+    if ftype == UINT32:
+        _encode_varint(value, out)
+    elif ftype == BOOL:
+        out.append("\x01" if value else "\x00")
+    else:
+        if ftype != BYTES:
+            value = encode(ftype, value)
+        elif isinstance(value, unicode):
+            value = value.encode("utf-8")
+        else:
+            value = str(value)
+        _encode_varint(len(value), out)
+        out.append(value)
+
+def _encode_fields(name, msg, out):
+    fields = _by_name[name]
+    for fname, value in msg.iteritems():
+        if value is None:
+            continue
+        number, fname, ftype, repeated = fields[fname]
+        tag = _tags[(name, number)]
+        if repeated:
+            for item in value:
+                out.append(tag)
+                _encode_value(ftype, item, out)
+        else:
+            out.append(tag)
+            _encode_value(ftype, value, out)
+
+def encode(name, msg):
+    """Encodes a message dictionary into protobuf bytes.
+
+    :param name: The message name, such as RpbGetReq
+    :param msg: A dictionary of field name to value. None values are skipped.
+    :rtype: A string
+    """
+    out = []
+    _encode_fields(name, msg, out)
+    return "".join(out)
+
+def decode(name, data):
+    """Decodes protobuf bytes into a message dictionary.
+
+    Unknown fields are skipped, so newer servers don't break us.
+
+    :param name: The message name, such as RpbGetResp
+    :param data: The encoded bytes
+    :rtype: A dictionary. Repeated fields are always present as lists.
+    """
+    fields = _by_number[name]
+    msg = {}
+    for number, fname, ftype, repeated in MESSAGES[name]:
+        if repeated:
+            msg[fname] = []
+
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _decode_varint(data, pos)
+        number = key >> 3
+        wiretype = key & 0x7
+        if wiretype == 0:
+            value, pos = _decode_varint(data, pos)
+        elif wiretype == 2:
+            length, pos = _decode_varint(data, pos)
+            value = data[pos:pos+length]
+            pos += length
+        elif wiretype == 1:
+            pos += 8
+            continue
+        elif wiretype == 5:
+            pos += 4
+            continue
+        else:
+            raise ValueError("Unsupported wire type %d" % wiretype)
+
+        field = fields.get(number)
+        if field is None:
+            continue
+
+        number, fname, ftype, repeated = field
+        if ftype == BOOL:
+            value = bool(value)
+        elif ftype not in (UINT32, BYTES):
+            value = decode(ftype, value)
+
+        if repeated:
+            msg[fname].append(value)
+        else:
+            msg[fname] = value
+
+    return msg
+
+def frame(code, msg=None):
+    """Builds a full frame, ready to be written to the socket.
+
+    :param code: The message code
+    :param msg: The message dictionary, or None for an empty message.
+    :rtype: A string
+    """
+    body = "" if msg is None else encode(CODES[code], msg)
+    return struct.pack("!IB", len(body) + 1, code) + body
+
+def parse(code, body):
+    """Decodes the body of a frame according to its message code.
+
+    :rtype: A dictionary. Empty if the message code carries no body.
+    """
+    name = CODES.get(code)
+    if name is None:
+        return {}
+    return decode(name, body)
+
+def quorum(value):
+    """Converts a quorum value (an int or "quorum"/"all"/...) into its
+    protobuf representation."""
+    if value is None:
+        return None
+    return QUORUMS.get(value, value)
@@ -0,0 +1,324 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""Incremental parsers for Riak's streaming HTTP responses, and the file
+like objects large values are streamed through.
+
+The parsers are fed the body as it comes off the socket, in chunks of any
+size, and hand back whatever is complete so far.
+"""
+
+from exceptions import ConnectionError
+import json
+import os
+import re
+
+_whitespace = re.compile(r"\s*")
+
+class JsonStreamDecoder(object):
+    """Decodes back to back JSON values, like {"keys":[...]}{"keys":[...]},
+    which is what ?keys=stream and ?buckets=stream send back."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        """:rtype: A list of the values completed by data."""
+        buf = self._buffer + data
+        values = []
+        pos = _whitespace.match(buf, 0).end()
+        end = len(buf)
+        while pos < end:
+            try:
+                value, pos = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                break # Incomplete. Wait for more.
+            values.append(value)
+            pos = _whitespace.match(buf, pos).end()
+        self._buffer = buf[pos:]
+        return values
+
+    def close(self):
+        """Call at the end of the stream. Raises if there's junk left."""
+        if self._buffer.strip():
+            raise ConnectionError("Truncated JSON stream: %r" % self._buffer[:100])
+
+
+def iter_chunks(response, size=8192):
+    """Iterates over the body of an httplib.HTTPResponse as it arrives.
+
+    httplib's read(amt) on a chunked response waits until it has amt bytes,
+    which for a slow stream of small chunks (list keys, map reduce) means
+    waiting for a lot of them. So for chunked responses we read one chunk at
+    a time ourselves.
+    """
+    if not response.chunked:
+        while True:
+            data = response.read(size)
+            if not data:
+                return
+            yield data
+
+    fp = response.fp
+    while True:
+        line = fp.readline()
+        if not line:
+            raise ConnectionError("Connection closed in the middle of a chunked response")
+        try:
+            chunk_size = int(line.split(";", 1)[0], 16)
+        except ValueError:
+            raise ConnectionError("Bad chunk size: %r" % line)
+
+        if chunk_size == 0:
+            # Trailers, then the final CRLF.
+            while True:
+                line = fp.readline()
+                if not line or line in ("\r\n", "\n"):
+                    break
+            response.close()
+            return
+
+        data = fp.read(chunk_size)
+        if len(data) < chunk_size:
+            raise ConnectionError("Connection closed in the middle of a chunk")
+        fp.read(2) # CRLF
+        yield data
+
+
+class MultipartStreamDecoder(object):
+    """Splits a multipart/mixed body into its parts, like ?chunked=true map
+    reduce and sibling responses."""
+
+    def __init__(self, boundary):
+        self._delimiter = "\r\n--" + boundary
+        # The first delimiter doesn't need the CRLF in front of it.
+        self._buffer = "\r\n"
+        self._started = False
+        self.done = False
+
+    def feed(self, data):
+        """:rtype: A list of the (headers, body) parts completed by data.
+                   Header names are lowered."""
+        buf = self._buffer + data
+        delimiter = self._delimiter
+        parts = []
+        while not self.done:
+            if not self._started:
+                i = buf.find(delimiter)
+                if i == -1:
+                    buf = buf[-len(delimiter):] # Preamble
+                    break
+                buf = buf[i + len(delimiter):]
+                self._started = True
+                continue
+
+            if len(buf) < 2:
+                break
+            if buf.startswith("--"):
+                self.done = True
+                buf = ""
+                break
+
+            i = buf.find(delimiter)
+            if i == -1:
+                break
+            parts.append(self._parse_part(buf[:i]))
+            buf = buf[i + len(delimiter):]
+
+        self._buffer = buf
+        return parts
+
+    def close(self):
+        if not self.done:
+            raise ConnectionError("Truncated multipart stream")
+
+    def _parse_part(self, part):
+        # Whatever follows the delimiter on its line is padding.
+        part = part.split("\r\n", 1)[1] if "\r\n" in part else ""
+        if part.startswith("\r\n"):
+            return {}, part[2:]
+        head, body = part.split("\r\n\r\n", 1) if "\r\n\r\n" in part else (part, "")
+        headers = {}
+        for line in head.split("\r\n"):
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        return headers, body
+
+
+def multipart_boundary(content_type):
+    """:rtype: The boundary of a multipart content type, or None."""
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "boundary":
+            return value.strip('"')
+    return None
+
+
+class ChunkReader(object):
+    """A read only file-like object over an iterator of chunks, such as a
+    streamed response body. Chunks are handed out as they arrive, at most
+    one is held at a time.
+
+    close() closes the iterator (if it's a generator), which lets go of
+    what it holds, like a connection. Reading to the end does too.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ""
+        self._offset = 0
+        self.closed = False
+
+    def _next_chunk(self):
+        """:rtype: False at the end."""
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._chunks is not None:
+            for chunk in self._chunks:
+                if chunk:
+                    self._chunk = chunk
+                    self._offset = 0
+                    return True
+            self._release()
+        return False
+
+    def _release(self):
+        chunks, self._chunks = self._chunks, None
+        self._chunk = ""
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return "".join(self)
+        parts = []
+        while size > 0:
+            if self._offset >= len(self._chunk) and not self._next_chunk():
+                break
+            part = self._chunk[self._offset:self._offset + size]
+            self._offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        return "".join(parts)
+
+    def readinto(self, b):
+        """Fills b (a bytearray or writable buffer) straight from the
+        chunks. :rtype: The number of bytes read, 0 at the end."""
+        view = memoryview(b)
+        filled = 0
+        while filled < len(view):
+            if self._offset >= len(self._chunk) and not self._next_chunk():
+                break
+            n = min(len(view) - filled, len(self._chunk) - self._offset)
+            view[filled:filled + n] = memoryview(self._chunk)[self._offset:self._offset + n]
+            self._offset += n
+            filled += n
+        return filled
+
+    def __iter__(self):
+        """The rest of the data, chunk by chunk."""
+        if self._offset < len(self._chunk):
+            yield self._chunk[self._offset:]
+        self._chunk, self._offset = "", 0
+        while self._next_chunk():
+            yield self._chunk
+            self._chunk = ""
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+
+class FileBody(object):
+    """A request body read from a file-like object and sent chunk by chunk,
+    through one reused buffer.
+
+    Its length is taken from the file when it can be (its size on disk, or
+    by seeking to its end), in which case that's what is sent. Otherwise
+    length is None, and the body should be sent with chunked transfer
+    encoding. Files that can seek are rewound before every send, so the
+    request can be retried.
+    """
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        try:
+            self.start = fileobj.tell()
+        except (AttributeError, IOError, OSError, ValueError): # Pipes and sockets can't tell.
+            self.start = None
+        self.length = None if self.start is None else self._size() - self.start
+
+    def _size(self):
+        try:
+            return os.fstat(self.fileobj.fileno()).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            self.fileobj.seek(0, os.SEEK_END)
+            size = self.fileobj.tell()
+            self.fileobj.seek(self.start)
+            return size
+
+    @property
+    def seekable(self):
+        return self.start is not None
+
+    def send(self, write):
+        """Sends the body, chunked if its length isn't known, with
+        write(data). :rtype: The number of bytes of the body sent."""
+        if self.start is not None:
+            self.fileobj.seek(self.start)
+        chunked = self.length is None
+        remaining = self.length
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        readinto = getattr(self.fileobj, "readinto", None)
+        sent = 0
+        while remaining is None or remaining > 0:
+            if readinto is not None:
+                n = readinto(buf)
+                data = view[:n]
+            else:
+                data = self.fileobj.read(self.chunk_size)
+                n = len(data)
+            if not n:
+                break
+            if remaining is not None:
+                if n > remaining: # The file grew, stick to what was announced.
+                    n = remaining
+                    data = data[:n]
+                remaining -= n
+            if chunked:
+                write("%x\r\n" % n)
+                write(data)
+                write("\r\n")
+            else:
+                write(data)
+            sent += n
+        if chunked:
+            write("0\r\n\r\n")
+        elif remaining:
+            raise IOError("%d bytes short of the %d announced" % (remaining, self.length))
+        return sent
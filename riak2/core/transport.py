@@ -21,6 +21,8 @@ import base64
 import random
 import platform
 import os
+import socket
+import time
 
 class Transport(object):
     """Lowest level of API which handles the transports,
@@ -33,18 +35,35 @@ class Transport(object):
         - Link: (bucket, key, tag) <- 3 item tuple
         - 2i:   (field, value)     <- 2 item tuple
 
+    Every request takes a deadline: the seconds it may take, retries
+    included. None falls back to the transport's deadline, which Client sets.
+    It is enforced by the socket timeouts (connecting and reading) and by how
+    long a connection is waited for. It is also passed on to Riak as the
+    request's timeout, so Riak gives up on it about when we do. Running out
+    raises socket.timeout.
+
     """
     # Subclass should specify API level.
     # api = 2
 
-    def __init__(self, cm=None, client_id=None):
+    def __init__(self, cm=None, client_id=None, retry_policy=None, deadline=None,
+                       instrument=None):
         """Initialize a new transport class.
 
         Note that subclass that implements this should have all arguments be
-        keyword arguments. cm and client_id should always exists.
+        keyword arguments. cm, client_id, retry_policy, deadline and instrument
+        should always exists.
 
         :param cm: Connection Manager Instance.
         :param client_id: A client ID.
+        :param retry_policy: A RetryPolicy deciding which failed requests are
+                             tried again. Retries should go to another host
+                             of cm if there is one.
+        :param deadline: Default deadline of a request, in seconds. None is
+                         no limit.
+        :param instrument: An Instrument, told about every operation with
+                           its phases timed. Kept as self.instrument, None
+                           turns instrumentation off.
         """
         raise NotImplementedError
 
@@ -59,14 +78,40 @@ class Transport(object):
         thread = threading.currentThread().getName()
         return base64.b64encode("%s|%s|%s" % (machine, process, thread))
 
-    def ping(self):
+    def _deadline(self, deadline):
+        """:rtype: When a request with the given deadline (or the default
+                one) has to be over by, as a time.time(). None if never."""
+        if deadline is None:
+            deadline = self.deadline
+        return None if deadline is None else time.time() + deadline
+
+    @staticmethod
+    def _remaining(end):
+        """:rtype: Seconds left until end, None if end is None. Raises
+                socket.timeout if there are none left."""
+        if end is None:
+            return None
+        remaining = end - time.time()
+        if remaining <= 0:
+            raise socket.timeout("Deadline exceeded")
+        return remaining
+
+    @staticmethod
+    def _server_timeout(end):
+        """:rtype: What's left until end in milliseconds, for Riak's own
+                timeout parameters. None if end is None."""
+        if end is None:
+            return None
+        return max(int((end - time.time()) * 1000), 1)
+
+    def ping(self, deadline=None):
         """Check if server is alive.
 
         :rtype: Returns a boolean.
         """
         raise NotImplementedError
 
-    def get(self, bucket, key, r=None, vtag=None):
+    def get(self, bucket, key, r=None, vtag=None, if_modified=None, deadline=None):
         """Get from the database.
 
         :param bucket: The bucket name.
@@ -76,12 +121,30 @@ class Transport(object):
         :param r: The R value. Defaults to None, which uses db default
         :type r: integer
         :param vtag: The vector clock value.
+        :param if_modified: A vclock, metadata, data tuple you already have
+                            for this object. data can be None. If the object
+                            hasn't changed since, Riak doesn't send it again
+                            and if_modified itself is returned.
         :rtype: Returns vclock, metadata, data in a 3 item tuple. Or None if the
-                object is not found. or a list of siblings if that's requested.
+                object is not found. If there are siblings, a list of these
+                tuples, one per sibling. Their metadata has the vtag under
+                "etag".
         """
         raise NotImplementedError
 
-    def put(self, bucket, key, content, meta, w=None, dw=None, return_body=True):
+    def get_stream(self, bucket, key, r=None, deadline=None):
+        """Like get, but the value is read as it arrives.
+
+        :rtype: vclock, metadata, reader in a 3 item tuple, where reader is a
+                file-like object (read, readinto, iteration, close) over the
+                value. Close it, or read it to the end, to let go of the
+                connection it holds. Like get if the object is not found or
+                has siblings, whose values are read whole.
+        """
+        raise NotImplementedError
+
+    def put(self, bucket, key, content, meta, w=None, dw=None, return_body=True,
+                  deadline=None):
         """Puts something into the database
 
         If key is None, a key will be generated by riak.
@@ -91,7 +154,8 @@ class Transport(object):
         :param key: The key name
         :type key: string or None
         :param content: The content/body for the PUT/POST request
-        :type content: string
+        :type content: string, or a file-like object to stream it from. It
+                       is read from its current position to its end.
         :param meta: The metadatas.
         :type meta: dictionary. Keys are: content_type, links, indexes, usermeta, vclock
                     content_type defaults to application/json.
@@ -105,11 +169,12 @@ class Transport(object):
                 vclock, metadata as the 2nd and 3rd if return_body is True.
                 Otherwise those 2 elements will be None.
                 If key is not None, returns vclock, metadata, data if
-                return_body is True. Otherwise returns 3 None.
+                return_body is True (a list of them if there are siblings, like
+                get). Otherwise returns 3 None.
         """
         raise NotImplementedError
 
-    def delete(self, bucket, key, rw=None):
+    def delete(self, bucket, key, rw=None, deadline=None):
         """Deletes an object from the database.
 
         :param bucket: The bucket name.
@@ -118,7 +183,7 @@ class Transport(object):
         """
         raise NotImplementedError
 
-    def get_keys(self, bucket):
+    def get_keys(self, bucket, deadline=None):
         """Gets a list of keys from the database.
 
         Not recommended for production as it is very very slow! Requires
@@ -130,7 +195,20 @@ class Transport(object):
         """
         raise NotImplementedError
 
-    def get_buckets(self):
+    def stream_keys(self, bucket, deadline=None):
+        """Lists the keys of a bucket, as Riak sends them.
+
+        Same cost on the cluster as get_keys, but the keys are handed out
+        while the listing is still going, so the whole list never has to be
+        held in memory. If you stop iterating early, the connection the
+        listing was using is closed.
+
+        :param bucket: The bucket name
+        :rtype: A generator of keys.
+        """
+        raise NotImplementedError
+
+    def get_buckets(self, deadline=None):
         """Get a list of bucket from the database.
 
         Note recommended for production as it is very very slow! Requires
@@ -139,7 +217,14 @@ class Transport(object):
         :rtype: A list of buckets from the database"""
         raise NotImplementedError
 
-    def get_bucket_properties(self, bucket):
+    def stream_buckets(self, deadline=None):
+        """Lists the buckets like stream_keys lists keys.
+
+        :rtype: A generator of bucket names.
+        """
+        raise NotImplementedError
+
+    def get_bucket_properties(self, bucket, deadline=None):
         """Get a list of bucket properties.
 
         :param bucket: The bucket name
@@ -147,7 +232,7 @@ class Transport(object):
         """
         raise NotImplementedError
 
-    def set_bucket_properties(self, bucket, properties):
+    def set_bucket_properties(self, bucket, properties, deadline=None):
         """Sets bucket properties. Raises an error if fails.
 
         :param bucket: The bucket name
@@ -155,16 +240,31 @@ class Transport(object):
         """
         raise NotImplementedError
 
-    def mapreduce(self, inputs, query, timeout=None):
+    def mapreduce(self, inputs, query, timeout=None, deadline=None):
         """Map reduces on the database.
 
         :param input: The input
         :param query: The query dictionary
-        :param timeout: Timeout values.
+        :param timeout: Riak's timeout for the job, in milliseconds. Defaults
+                        to what's left of the deadline.
         :rtype: A list of results. These results are decoded via json.loads"""
         raise NotImplementedError
 
-    def index(self, bucket, field, start, end=None):
+    def stream_mapreduce(self, inputs, query, timeout=None, deadline=None):
+        """Map reduces on the database, handing out the results as the phases
+        produce them instead of once the whole job is over.
+
+        A phase's results may come in several pieces. As with stream_keys,
+        stopping early closes the connection.
+
+        :param input: The input
+        :param query: The query dictionary
+        :param timeout: Same as mapreduce.
+        :rtype: A generator of (phase, results). phase is the index of the
+                phase in query and results a list, decoded via json.loads"""
+        raise NotImplementedError
+
+    def index(self, bucket, field, start, end=None, deadline=None):
         """Perform an indexing operation.
 
         :param bucket: The bucket name
@@ -176,6 +276,31 @@ class Transport(object):
         """
         raise NotImplementedError
 
+    def index_page(self, bucket, field, start, end=None, return_terms=False, max_results=None,
+                         continuation=None, deadline=None):
+        """Like index, a page at a time.
+
+        :param return_terms: Give (term, key) pairs rather than keys. Terms
+                             of _int fields are integers.
+        :param max_results: The size of a page. None is everything at once.
+        :param continuation: Where the page starts, as given with the page
+                             before it. None is the first page.
+        :rtype: The results and the continuation of the next page, None if
+                this is the last one.
+        """
+        raise NotImplementedError
+
+    def stream_index(self, bucket, field, start, end=None, return_terms=False,
+                           max_results=None, continuation=None, deadline=None):
+        """Like index_page, but the results are handed out as Riak sends
+        them. As with stream_keys, stopping early closes the connection.
+
+        :rtype: A generator of (results, continuation). results is a list,
+                continuation is None but for the last item, if there are
+                more pages.
+        """
+        raise NotImplementedError
+
     class SolrTransport(object):
         def add_index(self, index, docs):
             """Add index to a Riak Search cluster. Only works under HTTP.
@@ -17,3 +17,5 @@
 class Riak2Error(Exception): pass
 class ConflictError(Riak2Error): pass
 class NotFoundError(Riak2Error): pass
+class IntegrityError(Riak2Error): pass
+class ChangedError(NotFoundError): pass
@@ -0,0 +1,293 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""Client, Bucket and RObject, with every call that talks to Riak returning
+a Future right away.
+
+The calls run on a pool of worker threads sharing the client's connection
+pool, so a program that can't block (an event loop, a UI) can keep several
+requests in flight and pick the results up through callbacks:
+
+    client = FutureClient(workers=32)
+    future = client["users"].get("bob")
+    future.add_done_callback(lambda f: render(f.result()))
+
+This is not a non-blocking transport: every request in flight holds a
+worker, so there are never more of them than workers. Streams (keys,
+buckets, index results, values) are handed to a function, called on a
+worker for each item as it arrives.
+"""
+
+from bucket import Bucket
+from client import Client
+from mapreduce import MapReduce
+from utils import do_nothing, Executor, Future, TimeoutError
+
+class FutureTransport(object):
+    """Wraps a Transport so every method returns a Future."""
+
+    def __init__(self, transport, executor):
+        self.transport = transport
+        self.executor = executor
+        self.client_id = transport.client_id
+
+    def __getattr__(self, name):
+        method = getattr(self.transport, name)
+        if not callable(method):
+            return method
+        return lambda *args, **kwargs: self.executor.submit(method, *args, **kwargs)
+
+
+def _feed(func, items):
+    """Calls func on every item. :rtype: The number of items."""
+    count = 0
+    for item in items:
+        func(item)
+        count += 1
+    return count
+
+
+class FutureRObject(object):
+    """Wraps an RObject. Everything that doesn't talk to Riak (data,
+    indexes, links...) goes straight to the RObject. store(), store_from(),
+    delete() and reload() return a Future of this FutureRObject."""
+
+    def __init__(self, obj, executor):
+        self.__dict__["obj"] = obj
+        self.__dict__["_executor"] = executor
+
+    def __getattr__(self, name):
+        return getattr(self.obj, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.obj, name, value)
+
+    def _submit(self, method, *args):
+        def call():
+            method(*args)
+            return self
+        return self._executor.submit(call)
+
+    def store(self, w=None, dw=None, return_body=True):
+        return self._submit(self.obj.store, w, dw, return_body)
+
+    save = store
+
+    def store_from(self, fileobj, w=None, dw=None):
+        return self._submit(self.obj.store_from, fileobj, w, dw)
+
+    def delete(self, rw=None):
+        return self._submit(self.obj.delete, rw)
+
+    def reload(self, r=None, vtag=None):
+        return self._submit(self.obj.reload, r, vtag)
+
+
+class FutureBucket(object):
+    """Wraps a Bucket: the same methods, returning Futures for those that
+    talk to Riak. The rest (properties like r and w, encoders...) go
+    straight to the Bucket."""
+
+    def __init__(self, bucket, executor):
+        self.__dict__["bucket"] = bucket
+        self.__dict__["_executor"] = executor
+
+    def __getattr__(self, name):
+        return getattr(self.bucket, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.bucket, name, value)
+
+    def _submit(self, method, *args, **kwargs):
+        return self._executor.submit(method, *args, **kwargs)
+
+    def _wrap(self, obj):
+        return FutureRObject(obj, self._executor)
+
+    def new(self, key, data=None, content_type="application/json",
+            conflict_handler=do_nothing):
+        """Doesn't talk to Riak, so this returns the FutureRObject directly."""
+        return self._wrap(self.bucket.new(key, data, content_type, conflict_handler))
+
+    def get(self, key, r=None, conflict_handler=do_nothing):
+        return self._submit(lambda: self._wrap(self.bucket.get(key, r, conflict_handler)))
+
+    def get_stream(self, key, func, r=None):
+        """Calls func(chunk) for each chunk of the value as it arrives.
+
+        :rtype: A Future of the reader (see Bucket.get_stream), read
+                through and closed, or None if not found.
+        """
+        def call():
+            reader = self.bucket.get_stream(key, r)
+            if reader is not None:
+                with reader:
+                    _feed(func, reader)
+            return reader
+        return self._submit(call)
+
+    def multiget(self, keys, r=None, conflict_handler=do_nothing):
+        """Returns a list of Futures of FutureRObject, one per key. Unlike
+        Bucket.multiget, the requests are spread over the workers."""
+        return [self.get(key, r, conflict_handler) for key in keys]
+
+    def multistore(self, objects, w=None, dw=None, return_body=True):
+        """:rtype: A list of Futures of FutureRObject, one per object (an
+                RObject or FutureRObject), like FutureRObject.store()."""
+        return [(obj if isinstance(obj, FutureRObject) else self._wrap(obj))
+                    .store(w, dw, return_body) for obj in objects]
+
+    def multidelete(self, keys, rw=None):
+        """:rtype: A list of Futures, one per key, of None once it's gone."""
+        def delete(key):
+            self.bucket.new(key).delete(rw)
+        return [self._submit(delete, key) for key in keys]
+
+    def set_properties(self, **props):
+        return self._submit(self.bucket.set_properties, **props)
+
+    def get_properties(self):
+        return self._submit(self.bucket.get_properties)
+
+    def get_property(self, name):
+        return self._submit(self.bucket.get_property, name)
+
+    def get_keys(self):
+        return self._submit(self.bucket.get_keys)
+
+    def stream_keys(self, func):
+        """Calls func(key) for each key as it's listed.
+
+        :rtype: A Future of the number of keys.
+        """
+        return self._submit(lambda: _feed(func, self.bucket.stream_keys()))
+
+    def index(self, field, startkey, endkey=None, return_terms=False, max_results=None,
+                    continuation=None):
+        """:rtype: A Future of the IndexPage. Its next_page() blocks."""
+        return self._submit(self.bucket.index, field, startkey, endkey, return_terms,
+                            max_results, continuation)
+
+    def iter_index(self, func, field, startkey, endkey=None, return_terms=False,
+                         max_results=None, continuation=None):
+        """Calls func on each result as it's streamed, see Bucket.iter_index.
+
+        :rtype: A Future of the number of results.
+        """
+        return self._submit(lambda: _feed(func, self.bucket.iter_index(
+            field, startkey, endkey, return_terms, max_results, continuation)))
+
+    def search(self, query):
+        return FutureMapReduce(self.bucket.client, self._executor).search(self.bucket.name,
+                                                                          query)
+
+    def solr_search(self, query, **params):
+        """:rtype: A Future of the list of RObject found."""
+        return self._submit(self.bucket.solr_search, query, **params)
+
+    def search_enabled(self):
+        return self._submit(self.bucket.search_enabled)
+
+    def enable_search(self):
+        return self._submit(self.bucket.enable_search)
+
+    def disable_search(self):
+        return self._submit(self.bucket.disable_search)
+
+
+class FutureMapReduce(MapReduce):
+    """MapReduce where run() returns a Future."""
+
+    def __init__(self, client, executor):
+        MapReduce.__init__(self, client)
+        self._executor = executor
+
+    def run(self, timeout=None):
+        return self._executor.submit(MapReduce.run, self, timeout)
+
+
+class FutureClient(object):
+    """Client, with Futures. See the module.
+
+    The workers share the client's connection manager, so it is a good idea
+    to give the manager at least as many max_connections as there are
+    workers.
+    """
+
+    def __init__(self, client=None, workers=8, **kwargs):
+        """
+        :param client: The Client to wrap. If None, one is constructed
+                       with kwargs.
+        :param workers: Number of worker threads, which is also the number of
+                        requests that can be in flight at once.
+        """
+        self.client = Client(**kwargs) if client is None else client
+        self.executor = Executor(workers)
+        self.transport = FutureTransport(self.client.transport, self.executor)
+        self._buckets = {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def bucket(self, name):
+        b = self._buckets.get(name)
+        if b is None:
+            b = self._buckets[name] = FutureBucket(self.client.bucket(name), self.executor)
+        return b
+
+    __getitem__ = bucket
+
+    def submit(self, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) on a worker, for anything else that
+        blocks. :rtype: A Future of what it returns."""
+        return self.executor.submit(func, *args, **kwargs)
+
+    def get_buckets(self):
+        return self.executor.submit(self.client.get_buckets)
+
+    def stream_buckets(self, func):
+        """Calls func(name) for each bucket as it's listed.
+
+        :rtype: A Future of the number of buckets.
+        """
+        return self.executor.submit(lambda: _feed(func, self.client.stream_buckets()))
+
+    def is_alive(self):
+        return self.executor.submit(self.client.is_alive)
+
+    def multiget(self, keys, r=None, conflict_handler=do_nothing):
+        """Returns a list of Futures of FutureRObject, one per (bucket, key)."""
+        return [self.bucket(bucket.name if isinstance(bucket, (Bucket, FutureBucket)) else bucket)
+                    .get(key, r, conflict_handler) for bucket, key in keys]
+
+    def get_from_link(self, link):
+        return self.bucket(link[0]).get(link[1])
+
+    def add(self, a, key=None, data=None):
+        return FutureMapReduce(self.client, self.executor).add(a, key, data)
+
+    def solr_search(self, index, query, **params):
+        return self.executor.submit(self.client.solr_search, index, query, **params)
+
+    def solr_add_index(self, index, docs):
+        return self.executor.submit(self.client.solr_add_index, index, docs)
+
+    def solr_delete_index(self, index, docs=None, queries=None):
+        return self.executor.submit(self.client.solr_delete_index, index, docs, queries)
+
+    def close(self):
+        """Stops the workers once the queued calls are done."""
+        self.executor.shutdown()
@@ -124,7 +124,11 @@ class MapReduce(object):
                        }
         return self
 
-    def run(self, timeout=None):
+    def _prepare(self):
+        """Finishes off the query before it is sent.
+
+        :rtype: True if the results are links, to be turned into RObjects.
+        """
         num_phases = len(self._query)
         if num_phases == 0:
             self.reduce(["riak_kv_mapreduce", "reduce_identity"])
@@ -150,10 +154,13 @@ class MapReduce(object):
                                 "key_filters": self._key_filters
                                }
 
+        return link_results_flag or self._query[-1].keys()[0] == "link"
+
+    def run(self, timeout=None):
+        link_results_flag = self._prepare()
         result = self.transport.mapreduce(self._inputs, self._query, timeout)
 
         # If the last phase is NOT a link phase, then return the result.
-        link_results_flag = link_results_flag or self._query[-1].keys()[0] == "link"
         if not link_results_flag:
             return result
 
@@ -168,3 +175,22 @@ class MapReduce(object):
             a.append(self.client.get_from_link(r))
 
         return a
+
+    def stream(self, timeout=None):
+        """Runs the job, handing out results as Riak sends them rather than
+        once the last phase is over.
+
+        Results of the last phase are turned into RObjects if it's a link
+        phase, like run() does.
+
+        :param timeout: Timeout values.
+        :rtype: A generator of (phase, results). phase is the index of the
+                phase that produced results, a list. A phase's results may
+                come in several pieces.
+        """
+        link_results_flag = self._prepare()
+        last = len(self._query) - 1
+        for phase, results in self.transport.stream_mapreduce(self._inputs, self._query, timeout):
+            if link_results_flag and phase == last:
+                results = [self.client.get_from_link(r) for r in results]
+            yield phase, results
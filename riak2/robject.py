@@ -18,9 +18,51 @@
 # under the License.
 
 from utils import *
+from core.instrument import operation
 from copy import deepcopy
 
+class _Lazy(object):
+    """A Sibling attribute kept in slot, which is None until the attribute
+    is first read (factory() is put there then) or set. So empty metadata,
+    indexes, links and usermeta take no memory."""
+
+    def __init__(self, slot, factory):
+        self.slot = slot
+        self.factory = factory
+
+    def __get__(self, sibling, cls):
+        if sibling is None:
+            return self
+        value = getattr(sibling, self.slot)
+        if value is None:
+            value = self.factory()
+            setattr(sibling, self.slot, value)
+        return value
+
+    def __set__(self, sibling, value):
+        setattr(sibling, self.slot, value)
+        sibling.changed(self.slot[1:])
+
+
+# Sibling._data of a body that's not been decoded yet.
+_UNDECODED = object()
+# Sibling._data of a copy sharing the read-only snapshot of the data it was
+# copied from, in _frozen, until it's needed as is (see copy()).
+_SHARED = object()
+# In Sibling._frozen, for an attribute handed out as is: it can be changed
+# in place, behind our back, so its snapshot can't be kept.
+_LIVE = object()
+_MISSING = object()
+
 class Sibling(object):
+    __slots__ = ("obj", "vclock", "_content_type", "_data", "_encoded",
+                 "_metadata", "_indexes", "_links", "_usermeta", "_frozen")
+
+    metadata = _Lazy("_metadata", dict)
+    indexes = _Lazy("_indexes", MultiDict)
+    links = _Lazy("_links", list)
+    usermeta = _Lazy("_usermeta", dict)
+
     def __init__(self, obj, vclock=None,
                        metadata=None, data=None,
                        content_type=None, indexes=None,
@@ -28,32 +70,187 @@ class Sibling(object):
         self.obj = obj
 
         self.vclock = vclock
-        self.metadata = {} if metadata is None else metadata
-        self.data = data
-        self.content_type = content_type
+        self._metadata = metadata
+        self._data = data
+        self._encoded = None
+        self._content_type = content_type
 
-        self.indexes = MultiDict() if indexes is None else indexes
-        self.links = [] if links is None else links
-        self.usermeta = {} if usermeta is None else usermeta
+        self._indexes = indexes
+        self._links = links
+        self._usermeta = usermeta
+        self._frozen = None
 
     def set(self, response):
-        self.vclock, self.metadata, self.data = response
-
-        indexes = self.metadata.pop("index")
-        self.indexes = MultiDict()
-        for field, value in indexes:
-            self.indexes.add(field, value)
-        self.content_type = self.metadata.pop("content-type")
-        self.links = self.metadata.pop("link")
-        self.usermeta = self.metadata.pop("usermeta")
+        self.vclock, metadata, data = response
 
-        self.data = self.obj.bucket.decoders.get(self.content_type, do_nothing)(self.data)
+        indexes = metadata.pop("index")
+        if indexes:
+            self._indexes = MultiDict()
+            for field, value in indexes:
+                self._indexes.add(field, value)
+        else:
+            self._indexes = None
+        self._content_type = metadata.pop("content-type")
+        self._links = metadata.pop("link") or None
+        self._usermeta = metadata.pop("usermeta") or None
+        self._metadata = metadata
+
+        # Decoded when first asked for, if at all.
+        self._data = _UNDECODED
+        self._encoded = data
+        self._frozen = None
+
+    @property
+    def data(self):
+        data = self._data
+        if data is _UNDECODED:
+            decoder = self.obj.bucket.decoders.get(self.content_type, do_nothing)
+            data = self._data = decoder(self._decompressed())
+            self._encoded = None # data can be changed in place from now on.
+        elif data is _SHARED:
+            data = self._data = thaw(self._frozen["data"])
+        return data
+
+    def is_decoded(self):
+        return self._data is not _UNDECODED
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._encoded = None
+        self.changed("data")
+
+    def snapshot(self, name):
+        """:rtype: A read-only snapshot of attribute name (see utils.freeze),
+                made once and kept until the attribute changes."""
+        frozen = self._frozen
+        if frozen is None:
+            frozen = self._frozen = {}
+        snapshot = frozen.get(name, _MISSING)
+        if snapshot is _MISSING:
+            snapshot = frozen[name] = freeze(getattr(self, name))
+        elif snapshot is _LIVE:
+            snapshot = freeze(getattr(self, name))
+        return snapshot
+
+    def live(self, name):
+        """:rtype: Attribute name as is, to be changed in place maybe. Its
+                snapshots are made afresh from then on, until it's set."""
+        value = getattr(self, name)
+        if self._frozen is None:
+            self._frozen = {}
+        self._frozen[name] = _LIVE
+        return value
+
+    def changed(self, name):
+        """Drops the snapshot of attribute name, after it's changed."""
+        if self._frozen:
+            self._frozen.pop(name, None)
+
+    @property
+    def content_type(self):
+        return self._content_type
+
+    @content_type.setter
+    def content_type(self, content_type):
+        if self._data is _UNDECODED and content_type != self._content_type:
+            self.data # It's encoded as the old type.
+        self._content_type = content_type
+
+    def _content_encoding(self):
+        return self._metadata.get("content-encoding") if self._metadata else None
+
+    def _decompressed(self):
+        """:rtype: The body as received, decompressed."""
+        encoding = self._content_encoding()
+        if encoding:
+            compressor = self.obj.bucket.compressors.get(encoding)
+            if compressor is not None:
+                return compressor[1](self._encoded)
+        return self._encoded
 
     def encoded_data(self):
-        return self.obj.bucket.encoders.get(self.content_type, do_nothing)(self.data)
+        data = self._data
+        if data is _UNDECODED:
+            return self._decompressed()
+        elif data is _SHARED:
+            data = self._frozen["data"] # Encodes just as well.
+        return self.obj.bucket.encoders.get(self.content_type, do_nothing)(data)
+
+    def body(self):
+        """:rtype: The body to send to Riak, and its content encoding (None
+                if not compressed). A body received compressed and never
+                decoded goes back as it came."""
+        if self._data is _UNDECODED:
+            encoding = self._content_encoding()
+            if encoding:
+                return self._encoded, encoding
+            data = self._encoded
+        else:
+            data = self.encoded_data()
+
+        bucket = self.obj.bucket
+        encoding = bucket.compression
+        if encoding is not None and data is not None and len(data) >= bucket.compress_threshold:
+            return bucket.compressors[encoding][0](data), encoding
+        return data, None
+
+    def copy(self, obj):
+        """A deep copy of this sibling, belonging to obj. Decoded data isn't
+        copied right away: both share its read-only snapshot, which the copy
+        hands out as is to get_data() and thaws into data of its own when
+        that's needed."""
+        sibling = Sibling(obj, self.vclock, deepcopy(self._metadata), None,
+                          self.content_type, deepcopy(self._indexes),
+                          self._links and list(self._links),
+                          self._usermeta and dict(self._usermeta))
+        if self._data is _UNDECODED:
+            sibling._data = _UNDECODED
+            sibling._encoded = self._encoded
+        else:
+            sibling._data = _SHARED
+            sibling._frozen = {"data": self.snapshot("data")}
+        return sibling
+
+
+class _SiblingAttribute(object):
+    """RObject.data and friends: the attribute of the object's only
+    sibling, as is (get_data() and friends give read-only snapshots). Raises
+    ConflictError if there are several siblings. Setting goes through
+    _set_things, uncopied, but thawed if frozen."""
+
+    def __init__(self, name, writable=True, convert=None):
+        self.name = name
+        self.writable = writable
+        self.convert = convert
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        siblings = obj.siblings
+        if len(siblings) == 1:
+            return siblings.itervalues().next().live(self.name)
+        return obj._only_sibling().live(self.name)
+
+    def __set__(self, obj, value):
+        if not self.writable:
+            raise AttributeError("%s can't be set!" % self.name)
+        if self.convert is not None:
+            value = self.convert(value)
+        obj._set_things(self.name, value, False)
 
 
 class RObject(object):
+    __slots__ = ("client", "bucket", "key", "siblings", "exists", "_conflict_handler")
+
+    data = _SiblingAttribute("data")
+    content_type = _SiblingAttribute("content_type")
+    metadata = _SiblingAttribute("metadata")
+    usermeta = _SiblingAttribute("usermeta")
+    indexes = _SiblingAttribute("indexes", convert=MultiDict) # This always copies
+    links = _SiblingAttribute("links")
+    vclock = _SiblingAttribute("vclock", writable=False)
+
     def __init__(self, client, bucket, key=None, conflict_handler=do_nothing):
         try:
             if isinstance(key, basestring): # TEMP FIX. See basho/riak-python-client#32
@@ -61,33 +258,14 @@ class RObject(object):
         except UnicodeError:
             raise TypeError('Unicode keys are not supported.')
 
-        self.__dict__["client"] = client
-        self.__dict__["bucket"] = bucket
-        self.__dict__["key"] = key
-
-        self.__dict__["siblings"] = {}
-        self.__dict__["exists"] = False
-
-        self.__dict__["_conflict_handler"] = conflict_handler
-
-        self.__dict__["_getattr_mapper"] = {
-            "data": lambda: self.get_data(False),
-            "content_type": self.get_content_type,
-            "metadata": lambda: self.get_metadata(False),
-            "usermeta": lambda: self.get_usermeta(False),
-            "indexes": lambda: self.get_indexes(None, False),
-            "links": lambda: self.get_links(False),
-            "vclock" : self.get_vclock
-        }
-
-        self.__dict__["_setattr_mapper"] = {
-            "data": lambda value: self.set_data(value, False),
-            "content_type": self.set_content_type,
-            "metadata": lambda value: self.set_metadata(value, False),
-            "usermeta": lambda value: self.set_usermeta(value, False),
-            "indexes": lambda value: self.set_indexes(value), # This always uses copy
-            "links": lambda value: self.set_links(value, False)
-        }
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+
+        self.siblings = {}
+        self.exists = False
+
+        self._conflict_handler = conflict_handler
 
     def _assert_no_conflict(self):
         if len(self.siblings) > 1:
@@ -99,36 +277,30 @@ class RObject(object):
 
         return self.siblings.values()[0]
 
-    def _set_things(self, attribute, things, use_copy=True):
+    def _only_sibling(self):
+        siblings = self.siblings
+        if len(siblings) == 1: # The usual case, made quick.
+            return siblings.itervalues().next()
         self._assert_no_conflict()
-        if use_copy:
-            things = deepcopy(things)
+        return self._get_only_sibling()
 
-        setattr(self._get_only_sibling(), attribute, things)
+    def _set_things(self, attribute, things, use_copy=True):
+        sibling = self._only_sibling()
+        if use_copy or isinstance(things, (FrozenDict, FrozenList)):
+            things = thaw(things) # A plain copy, frozen parts included.
+            setattr(sibling, attribute, things)
+        else:
+            setattr(sibling, attribute, things)
+            sibling.live(attribute) # The caller has it, and may change it.
         return self
 
     def _get_things(self, attribute, return_copy=True):
-        self._assert_no_conflict()
-        if return_copy:
-            return deepcopy(getattr(self._get_only_sibling(), attribute))
-        else:
-            return getattr(self._get_only_sibling(), attribute)
-
-    def __getattr__(self, name):
-        callback = self._getattr_mapper.get(name, None)
-        if callback is None:
-            raise AttributeError("%s doesn't exist!" % name)
-        return callback()
-
-    def __setattr__(self, name, value):
-        if name in self.__dict__:
-            self.__dict__[name] = value
-            return
-
-        callback = self._setattr_mapper.get(name, None)
-        if callback is None:
-            raise AttributeError("%s doesn't exist!" % name)
-        return callback(value)
+        """return_copy gives a read-only snapshot (see utils.freeze) rather
+        than a deep copy. It's made on the first call and handed out again
+        until the attribute is set, so reading costs nothing. Its thaw()
+        gives a copy that can be changed."""
+        sibling = self._only_sibling()
+        return sibling.snapshot(attribute) if return_copy else sibling.live(attribute)
 
     def get_data(self, return_copy=True):
         return self._get_things("data", return_copy)
@@ -141,7 +313,7 @@ class RObject(object):
         return self._get_only_sibling().encoded_data()
 
     def get_content_type(self):
-        return self._get_things("content_type", False)
+        return self._only_sibling().content_type
 
     def set_content_type(self, content_type):
         return self._set_things("content_type", content_type, False)
@@ -160,15 +332,12 @@ class RObject(object):
 
     def get_indexes(self, field=None, return_copy=True):
         self._assert_no_conflict()
-        if field is not None:
-            indexes = self._get_only_sibling().indexes.get(field, [])
-            if return_copy:
-                return deepcopy(indexes)
-            else:
-                return indexes
-        else:
-            indexes = self._get_only_sibling().indexes
-            return deepcopy(indexes) if return_copy else indexes
+        sibling = self._get_only_sibling()
+        if return_copy:
+            indexes = sibling.snapshot("indexes")
+            return indexes if field is None else indexes.get(field, FrozenList())
+        indexes = sibling.live("indexes")
+        return indexes if field is None else indexes.get(field, [])
 
     def set_indexes(self, indexes=None, field=None, use_copy=True):
         if field is None:
@@ -178,23 +347,27 @@ class RObject(object):
             if use_copy:
                 indexes = deepcopy(indexes)
 
-            self._get_only_sibling().indexes[field] = indexes
+            sibling = self._get_only_sibling()
+            sibling.indexes[field] = indexes # MultiDict copies it into a set.
+            sibling.changed("indexes")
         return self
 
     def add_index(self, field, value):
         self._assert_no_conflict()
-        self._get_only_sibling().indexes.add(field, value)
+        sibling = self._get_only_sibling()
+        sibling.indexes.add(field, value)
+        sibling.changed("indexes")
         return self
 
     def remove_index(self, field, value=None):
-        self._assert_no_conflict()
-        sibling = self._get_only_sibling()
-        if value is None:
-            if field in sibling.indexes:
-                del sibling.indexes[field]
-        else:
-            if field in sibling.indexes:
-                sibling.indexes[field].discard(value)
+        sibling = self._only_sibling()
+        indexes = sibling._indexes
+        if indexes and field in indexes:
+            if value is None:
+                del indexes[field]
+            else:
+                indexes[field].discard(value)
+            sibling.changed("indexes")
         return self
 
     def get_links(self, tags=None, return_copy=True):
@@ -219,6 +392,7 @@ class RObject(object):
         link = self._construct_link(obj, tag)
         sibling = self._get_only_sibling()
         sibling.links.append(link)
+        sibling.changed("links")
         return self
 
     def remove_link(self, obj, tag=None): # This shit.. it's inefficient.
@@ -234,6 +408,7 @@ class RObject(object):
             sibling.links = new_links
         else:
             sibling.links.remove(link)
+            sibling.changed("links")
 
         return self
 
@@ -242,9 +417,26 @@ class RObject(object):
         return self._get_only_sibling().vclock
 
     def reload(self, r=None, vtag=None):
-        response = self.client.transport.get(self.bucket.name, self.key,
-                                             r or self.bucket.r, vtag) # i <3 this line
-        self._load_with_response(response)
+        with operation(self.client.instrument, "load", self.bucket.name) as op:
+            cache = self.client.cache
+            if cache is not None and vtag is None:
+                cache.load(self, r or self.bucket.r)
+                if op is not None:
+                    op.mark("cache")
+                return self
+
+            response = self.client.transport.get(self.bucket.name, self.key,
+                                                 r or self.bucket.r, vtag) # i <3 this line
+            if op is not None:
+                op.mark("fetch")
+            self._load_with_response(response)
+            if op is not None:
+                op.mark("decode")
+        return self
+
+    def _load_with_sibling(self, sibling):
+        self.siblings = {sibling.vclock: sibling}
+        self.exists = True
         return self
 
     def _load_with_response(self, response):
@@ -253,14 +445,10 @@ class RObject(object):
         else:
             siblings = self.siblings = {}
             if isinstance(response, list):
-                for sibling in response:
-                    # TODO: Is it a good idea to get from this deep in the library?
-                    # It's kinda sneaky.
-                    res = self.client.transport.get(self.bucket.name, self.key,
-                                                    self.bucket.r, sibling)
-                    if res is not None:
-                        siblings[sibling] = Sibling(self)
-                        siblings[sibling].set(res)
+                for i, res in enumerate(response):
+                    sibling = Sibling(self)
+                    sibling.set(res)
+                    siblings[sibling.metadata.get("etag", i)] = sibling
 
                 self._conflict_handler(self) # Invoke conflict handling
 
@@ -284,32 +472,86 @@ class RObject(object):
 
     def store(self, w=None, dw=None, return_body=True):
         self._assert_no_conflict()
-        w = w or self.bucket.w
-        dw = dw or self.bucket.dw
+        with operation(self.client.instrument, "store", self.bucket.name) as op:
+            w = w or self.bucket.w
+            dw = dw or self.bucket.dw
+            sibling = self._get_only_sibling()
+            meta = self._store_meta(sibling)
+            data, meta["content_encoding"] = sibling.body()
+            if op is not None:
+                op.mark("encode")
+                op.bytes_out = len(data or "")
+            response = self.client.transport.put(self.bucket.name, self.key, data, meta,
+                                                 w, dw, return_body)
+            if op is not None:
+                op.mark("send")
+            if self.key is None:
+                self.key, vclock, metadata = response
+                if return_body:
+                    if meta["content_encoding"]:
+                        metadata["content-encoding"] = meta["content_encoding"]
+                    self._load_with_response((vclock, metadata, data))
+            elif return_body:
+                self._load_with_response(response)
+            self.exists = True
+            if op is not None and return_body:
+                op.mark("decode")
+
+            cache = self.client.cache
+            if cache is not None:
+                if return_body:
+                    cache.update(self, len(data or ""))
+                else:
+                    cache.invalidate(self.bucket.name, self.key)
+        return self
+
+    save = store
+
+    def store_from(self, fileobj, w=None, dw=None):
+        """Stores what fileobj holds, from its current position to its end,
+        as the value. It's streamed from the file in chunks, never read into
+        memory whole (except over protocol buffers, which can't stream).
+
+        The bytes go as they are: not encoded nor compressed, so they should
+        match content_type. Links, indexes and usermeta are the object's.
+        Nothing is loaded back, reload() to see what was stored.
+
+        :param fileobj: A file-like object. If it can't seek (a pipe, a
+                        socket), the store is not retried.
+        """
+        self._assert_no_conflict()
+        with operation(self.client.instrument, "store", self.bucket.name) as op:
+            w = w or self.bucket.w
+            dw = dw or self.bucket.dw
+            meta = self._store_meta(self._get_only_sibling())
+            response = self.client.transport.put(self.bucket.name, self.key, fileobj, meta,
+                                                 w, dw, return_body=False)
+            if op is not None:
+                op.mark("send")
+            if self.key is None:
+                self.key = response[0]
+            self.exists = True
+            if self.client.cache is not None:
+                self.client.cache.invalidate(self.bucket.name, self.key)
+        return self
+
+    def _store_meta(self, sibling):
         meta = {}
-        meta["links"] = self.get_links()
+        meta["links"] = sibling._links or []
         indexes = []
-        for field, values in self.indexes.iteritems():
+        for field, values in (sibling._indexes or {}).iteritems():
             for value in values:
                 indexes.append(Index(field, value))
         meta["indexes"] = indexes
-        meta["usermeta"] = self.get_usermeta()
-        meta["content_type"] = self.content_type
-        data = self.get_encoded_data()
-        response = self.client.transport.put(self.bucket.name, self.key, data, meta, w, dw)
-        if self.key is None:
-            self.key, vclock, metadata = response
-            self._load_with_response((vclock, metadata, data))
-        else:
-            self._load_with_response(response)
-        self.exists = True
-        return self
-
-    save = store
+        meta["usermeta"] = sibling._usermeta or {}
+        meta["content_type"] = sibling.content_type
+        return meta
 
     def delete(self, rw=None):
         rw = rw or self.bucket.rw
         self.client.transport.delete(self.bucket.name, self.key, rw)
+        if self.client.cache is not None:
+            self.client.cache.invalidate(self.bucket.name, self.key)
         self.clear()
         return self
 
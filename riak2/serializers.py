@@ -0,0 +1,78 @@
+# Copyright 2012 Shuhao Wu <shuhao@shuhaowu.com>
+#
+# This file is provided to you under the Apache License,
+# Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""The serializers and compressors every client starts with.
+
+ENCODERS and DECODERS map a content type to a function turning data into
+bytes and back. COMPRESSORS maps a content encoding to a (compress,
+decompress) pair of functions. Client.encoders, decoders and compressors
+are Registries over these, and Bucket's over the client's: register here
+for every client, on a client for its buckets, or on a bucket for just
+that one.
+
+JSON goes through the standard json module. use_fast_json() registers
+ujson or simplejson instead, where they're installed and known to be good
+enough for the data. application/x-msgpack is there if msgpack is installed.
+"""
+
+import json
+import zlib
+
+json_dumps, json_loads = json.dumps, json.loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+ENCODERS = {"application/json": json_dumps,
+            "text/json": json_dumps}
+
+DECODERS = {"application/json": json_loads,
+            "text/json": json_loads}
+
+if msgpack is not None:
+    ENCODERS["application/x-msgpack"] = msgpack.packb
+    DECODERS["application/x-msgpack"] = msgpack.unpackb
+
+COMPRESSORS = {"gzip": (gzip_compress, gzip_decompress),
+               "deflate": (zlib.compress, zlib.decompress)}
+
+def use_fast_json(encoders=ENCODERS, decoders=DECODERS, libraries=("ujson", "simplejson")):
+    """Registers the first of libraries installed for the JSON content types,
+    for every client by default, or on a client's or bucket's registries.
+    They're faster than json but not always the same: ujson, for one,
+    rounds floats unless told otherwise. Check they round-trip your data.
+
+    :rtype: The name of the library registered, None if none is installed.
+    """
+    for name in libraries:
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        for content_type in ("application/json", "text/json"):
+            encoders[content_type] = module.dumps
+            decoders[content_type] = module.loads
+        return name
+    return None
@@ -14,6 +14,17 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from Queue import Queue, Empty
+from collections import MutableMapping
+from copy import deepcopy
+import atexit
+import logging
+import sys
+import threading
+import weakref
+
+log = logging.getLogger(__name__)
+
 do_nothing = lambda x: x
 
 # simulate class
@@ -30,4 +41,378 @@ class MultiDict(dict):
     def add(self, key, value):
         self.setdefault(key, set()).add(value)
 
+class Registry(MutableMapping):
+    """A mapping that falls back to parent for the keys it doesn't have.
+    What's registered on the parent is seen here too, lookups and iteration
+    alike, unless overridden, without anything being copied. Deleting only
+    removes what was registered here."""
+
+    def __init__(self, parent=None, *args, **kwargs):
+        self.parent = parent
+        self._own = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        try:
+            return self._own[key]
+        except KeyError:
+            if self.parent is None:
+                raise
+            return self.parent[key]
+
+    def __setitem__(self, key, value):
+        self._own[key] = value
+
+    def __delitem__(self, key):
+        del self._own[key]
+
+    def __contains__(self, key):
+        return key in self._own or (self.parent is not None and key in self.parent)
+
+    def __iter__(self):
+        for key in self._own:
+            yield key
+        if self.parent is not None:
+            for key in self.parent:
+                if key not in self._own:
+                    yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "Registry(%r)" % dict(self.iteritems())
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("%s is read-only, thaw() it for a copy that isn't" % self.__class__.__name__)
+
+class FrozenDict(dict):
+    """A read-only snapshot of a dict, handed out instead of a deep copy.
+
+    It's a dict (json and anything else that wants one takes it as is) that
+    can't be changed: containers found inside are frozen too. thaw() makes a
+    plain, mutable deep copy, for when changing it is the point. So does
+    copy.deepcopy.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def thaw(self):
+        return thaw(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class FrozenList(list):
+    """FrozenDict's counterpart for lists."""
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = \
+        append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def thaw(self):
+        return thaw(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+# Immutable, nothing to freeze inside.
+_ATOMS = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+def freeze(value):
+    """:rtype: A read-only snapshot of value if it's a dict, list or set (or
+            a subclass): FrozenDict, FrozenList or frozenset. value itself
+            otherwise. About 4 times cheaper than the deepcopy it stands in
+            for, plain JSON-like data being the common case."""
+    t = type(value)
+    if t is dict:
+        return FrozenDict([(k, v if type(v) in _ATOMS else freeze(v))
+                           for k, v in value.iteritems()])
+    elif t is list:
+        return FrozenList([v if type(v) in _ATOMS else freeze(v) for v in value])
+    elif t in _ATOMS or t is FrozenDict or t is FrozenList or t is frozenset:
+        return value
+    elif isinstance(value, dict):
+        return FrozenDict([(k, freeze(v)) for k, v in value.iteritems()])
+    elif isinstance(value, list):
+        return FrozenList([freeze(v) for v in value])
+    elif isinstance(value, set):
+        return frozenset(value)
+    return value
+
+def thaw(value):
+    """:rtype: A mutable deep copy of value, with plain dicts and lists in
+            place of frozen ones."""
+    if isinstance(value, FrozenDict):
+        return dict([(k, thaw(v)) for k, v in value.iteritems()])
+    elif isinstance(value, FrozenList):
+        return [thaw(v) for v in value]
+    return deepcopy(value) # Whatever is frozen inside goes through __deepcopy__.
+
+class TimeoutError(Exception): pass
+
+class Future(object):
+    """The result of a call that hasn't necessarily finished yet."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the call to finish and returns what it returned, or
+        raises what it raised.
+
+        :param timeout: Seconds to wait. None waits forever.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Not done after %ss" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Not done after %ss" % timeout)
+        return None if self._exc_info is None else self._exc_info[1]
+
+    def add_done_callback(self, func):
+        """Calls func(future) once the call is done. Right away if it already
+        is. Callbacks run in the worker thread that finished the call; what
+        they raise is logged and otherwise ignored."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        self._call(func)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            self._call(func)
+
+    def _call(self, func):
+        # A raising callback mustn't take the worker thread, or the other
+        # callbacks, down with it.
+        try:
+            func(self)
+        except Exception:
+            log.exception("Exception in done callback %r", func)
+
+
+class Executor(object):
+    """A pool of daemon worker threads. They're started as the work needs
+    them, up to workers of them (None for no limit), and kept for the work
+    that comes after. They stop with shutdown(), once the Executor is
+    garbage collected, or when the program exits, if idle."""
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        # Workers waiting for a job that's not been submitted yet, under
+        # _lock. The threads don't hold on to the Executor itself.
+        self._lock = threading.Lock()
+        self._idle = [0]
+        _executors.add(self)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._idle[0]:
+                self._idle[0] -= 1
+            elif self.workers is None or len(self._threads) < self.workers:
+                t = threading.Thread(target=_work, args=(self._queue, self._lock, self._idle))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True, timeout=None):
+        """:param timeout: Seconds to wait for each thread, if wait."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for t in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join(timeout)
+
+    def __del__(self):
+        self.shutdown(wait=False)
+
+# Stopped at exit, before the interpreter is torn down under their feet.
+_executors = weakref.WeakSet()
+
+@atexit.register
+def _shutdown_executors():
+    for executor in list(_executors):
+        executor.shutdown(timeout=0.1)
+
+def _work(queue, lock, idle):
+    while True:
+        job = queue.get()
+        if job is None:
+            return
+        future, func, args, kwargs = job
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        else:
+            future.set_result(result)
+        job = future = func = args = kwargs = result = None # Not kept while idle.
+        with lock:
+            idle[0] += 1
+
+def concurrent_map(func, items, concurrency, executor=None):
+    """Calls func on every item, with up to concurrency calls in flight: in
+    the calling thread and on executor's threads, or on threads of their
+    own if there's no executor.
+
+    An exception raised by func doesn't stop the others, it takes the place
+    of that item's result instead.
+
+    :rtype: A list of results, in the same order as items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = iter(enumerate(items))
+    lock = threading.Condition()
+    # Helpers still working. Once over, those that start late (the executor
+    # being busy) have nothing to do and aren't waited for.
+    state = {"helping": 0, "over": False}
+
+    def work():
+        while True:
+            with lock:
+                try:
+                    i, item = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[i] = func(item)
+            except Exception, e:
+                results[i] = e
+
+    def help():
+        with lock:
+            if state["over"]:
+                return
+            state["helping"] += 1
+        try:
+            work()
+        finally:
+            with lock:
+                state["helping"] -= 1
+                lock.notify_all()
+
+    for i in xrange(min(concurrency, len(items)) - 1):
+        _submit(executor, help)
+    work()
+    with lock:
+        state["over"] = True
+        while state["helping"]:
+            lock.wait()
+    return results
+
+def _submit(executor, func):
+    if executor is None:
+        t = threading.Thread(target=func)
+        t.daemon = True
+        t.start()
+    else:
+        executor.submit(func)
+
+def concurrent_imap(func, items, concurrency, executor=None):
+    """Like concurrent_map, but yields (item, result) as soon as each call
+    completes, in no particular order. The calls are all made on executor's
+    threads (or threads of their own), so executor had better not be
+    limited to fewer than concurrency of them.
+
+    items is consumed lazily. At most concurrency calls are in flight and at
+    most concurrency results wait for the consumer, so a slow consumer (or a
+    huge generator of items) doesn't pile anything up in memory.
+
+    If the consumer stops early, the calls in flight are finished and the
+    rest of items is left alone.
+    """
+    pending = iter(items)
+    lock = threading.Lock()
+    results = Queue(concurrency)
+    done = object()
+    state = {"stopped": False, "error": None}
+
+    def work():
+        try:
+            while not state["stopped"]:
+                with lock:
+                    try:
+                        item = next(pending)
+                    except StopIteration:
+                        return
+                    except Exception, e:
+                        # items itself blew up. Hand it to the consumer.
+                        state["error"] = e
+                        state["stopped"] = True
+                        return
+                try:
+                    result = func(item)
+                except Exception, e:
+                    result = e
+                results.put((item, result))
+        finally:
+            results.put(done)
+
+    running = max(1, concurrency)
+    for i in xrange(running):
+        _submit(executor, work)
 
+    try:
+        while running:
+            result = results.get()
+            if result is done:
+                running -= 1
+            else:
+                yield result
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        state["stopped"] = True
+        # Unblock workers stuck on a full queue.
+        while running:
+            try:
+                if results.get(timeout=0.1) is done:
+                    running -= 1
+            except Empty:
+                pass
@@ -1,8 +1,28 @@
-from riak2.core import HttpTransport, PbcTransport
+from riak2.core import HttpTransport, PbcTransport, ConnectionManager, PbcConnection
+from riak2.core import PoolTimeout, LeastOutstanding, LatencyWeighted, RetryPolicy
+from riak2.core import Instrument, Histogram, HistogramCollector
+from riak2.core.instrument import operation
+from riak2.core.stream import JsonStreamDecoder, MultipartStreamDecoder, ChunkReader, FileBody
+from fake_riak import FakePbcServer, FakeHttpServer
 import riak2
+import argparse
+import benchmark
+import errno
+import httplib
+import json
+import logging
+import operator
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
 class Riak2CoreTransportTest(object):
+    def assertStatus(self, status, metadata):
+        self.assertEqual(status, metadata["http_code"])
+
     def test_ping(self):
         self.assertTrue(self.transport.ping())
 
@@ -13,7 +33,7 @@ class Riak2CoreTransportTest(object):
     def test_simple_put_and_get_and_delete(self):
         def check(result):
             self.assertEqual(3, len(result))
-            self.assertEqual(200, result[1]["http_code"])
+            self.assertStatus(200, result[1])
             self.assertEqual("this is a test", result[2])
 
         meta = {"content_type" : "text/plain"}
@@ -31,7 +51,7 @@ class Riak2CoreTransportTest(object):
         # Also tests meta_is_header
         def check(result):
             self.assertEqual(3, len(result))
-            self.assertEqual(200, result[1]["http_code"])
+            self.assertStatus(200, result[1])
             self.assertEqual("bar", result[1]["usermeta"]["testmeta"])
 
         headers = self.transport.make_put_header("application/json", [], [], {"testmeta" : "bar"})
@@ -48,7 +68,7 @@ class Riak2CoreTransportTest(object):
     def test_links_put_get_and_delete(self):
         def check(result):
             self.assertEqual(3, len(result))
-            self.assertEqual(200, result[1]["http_code"])
+            self.assertStatus(200, result[1])
             self.assertEqual(1, len(result[1]["link"]))
             self.assertEqual(("test_bucket", "foo", "test_bucket"), result[1]["link"][0])
 
@@ -70,10 +90,10 @@ class Riak2CoreTransportTest(object):
         result = self.transport.put("test_bucket", None, "{1 : 2}", {}, 2, 2)
         self.assertEqual(3, len(result))
         key, vclock, metadata = result
-        self.assertEqual(201, metadata["http_code"])
+        self.assertStatus(201, metadata)
         result = self.transport.get("test_bucket", key)
         self.assertEqual(3, len(result))
-        self.assertEqual(200, result[1]["http_code"])
+        self.assertStatus(200, result[1])
         self.assertEqual("{1 : 2}", result[2])
         self.transport.delete("test_bucket", key)
 
@@ -99,6 +119,72 @@ class Riak2CoreTransportTest(object):
         result = self.transport.get_keys("test_bucket")
         self.assertEqual(0, len(result))
 
+    def test_siblings(self):
+        self.transport.set_bucket_properties("sibling_bucket", {"allow_mult": True})
+        self.transport.put("sibling_bucket", "foo", "one", {"content_type": "text/plain"})
+        siblings = self.transport.put("sibling_bucket", "foo", "two",
+                                      {"content_type": "text/plain", "usermeta": {"m": "2"}})
+        self.assertEqual(2, len(siblings))
+        self.assertEqual(siblings, self.transport.get("sibling_bucket", "foo"))
+
+        self.assertEqual({"one", "two"}, set(data for vclock, metadata, data in siblings))
+        for vclock, metadata, data in siblings:
+            self.assertEqual("text/plain", metadata["content-type"])
+            self.assertEqual({"m": "2"} if data == "two" else {}, metadata["usermeta"])
+            sibling = self.transport.get("sibling_bucket", "foo", vtag=metadata["etag"])
+            self.assertEqual(data, sibling[2])
+        self.transport.delete("sibling_bucket", "foo")
+
+    def test_get_if_modified(self):
+        self.transport.put("test_bucket", "foo", "one", {"content_type": "text/plain"})
+        first = self.transport.get("test_bucket", "foo")
+        self.assertTrue(self.transport.get("test_bucket", "foo", if_modified=first) is first)
+
+        self.transport.put("test_bucket", "foo", "two",
+                           {"content_type": "text/plain", "vclock": first[0]})
+        second = self.transport.get("test_bucket", "foo", if_modified=first)
+        self.assertEqual("two", second[2])
+        self.transport.delete("test_bucket", "foo")
+
+    def test_deadline(self):
+        self.assertTrue(self.transport.ping(deadline=5))
+        self.assertEqual(None, self.transport.get("test_bucket", "foo", deadline=5))
+
+        blackhole = socket.socket()
+        blackhole.bind(("127.0.0.1", 0))
+        blackhole.listen(5) # Connecting works, nothing is ever answered.
+        try:
+            cm = ConnectionManager(self.transport.connection_class, [blackhole.getsockname()])
+            transport = self.transport.__class__(cm, retry_policy=RetryPolicy(backoff=0),
+                                                 deadline=0.1)
+            start = time.time()
+            self.assertRaises(socket.timeout, transport.ping)
+            self.assertRaises(socket.timeout, transport.get, "test_bucket", "foo", deadline=0.05)
+            self.assertRaises(socket.timeout, list, transport.stream_keys("test_bucket"))
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            blackhole.close()
+
+    def test_stream_keys(self):
+        keys = set("key%d" % i for i in xrange(250))
+        for key in keys:
+            self.transport.put("stream_bucket", key, "test", {}, return_body=False)
+
+        stream = self.transport.stream_keys("stream_bucket")
+        first = next(stream)
+        self.assertTrue(first in keys)
+        self.assertEqual(keys, set([first] + list(stream)))
+        self.assertTrue("stream_bucket" in list(self.transport.stream_buckets()))
+
+        # Stopping half way leaves the transport usable.
+        stream = self.transport.stream_keys("stream_bucket")
+        next(stream)
+        stream.close()
+        self.assertTrue(self.transport.ping())
+
+        for key in keys:
+            self.transport.delete("stream_bucket", key)
+
     def test_get_buckets(self):
         result = self.transport.get_buckets()
         self.assertTrue(isinstance(result, list))
@@ -118,7 +204,7 @@ class Riak2CoreTransportTest(object):
 
         def checkObj(result):
             self.assertEqual(3, len(result))
-            self.assertEqual(200, result[1]["http_code"])
+            self.assertStatus(200, result[1])
             self.assertEqual(2, len(result[1]["index"]))
             self.assertEqual({("foo_bin", "test"), ("bar_int", 42)}, set(result[1]["index"]))
 
@@ -151,6 +237,22 @@ class Riak2CoreTransportTest(object):
         self.assertEqual(2, result[0][u"1"])
         self.transport.delete("test_bucket", "foo")
 
+    def test_stream_mapreduce(self):
+        for i in xrange(150):
+            self.transport.put("mapred_bucket", "key%d" % i, str(i),
+                               {"content_type": "application/json"}, return_body=False)
+
+        query = [{"map": {"language": "javascript", "name": "Riak.mapValuesJson", "keep": True}},
+                 {"reduce": {"language": "javascript", "name": "Riak.reduceSum", "keep": True}}]
+        phases = {}
+        for phase, results in self.transport.stream_mapreduce("mapred_bucket", query):
+            phases.setdefault(phase, []).extend(results)
+        self.assertEqual(range(150), sorted(phases[0]))
+        self.assertEqual([sum(xrange(150))], phases[1])
+
+        for i in xrange(150):
+            self.transport.delete("mapred_bucket", "key%d" % i)
+
     def test_solr_simple_search(self):
         self.transport.put("search_bucket", "foo", '{"value" : 2}', {"content_type": "application/json"})
         results = self.transport.solr.search("search_bucket", "value:2")
@@ -165,9 +267,135 @@ class Riak2HttpTransportTest(Riak2CoreTransportTest, unittest.TestCase):
     def setUp(self):
         self.transport = HttpTransport()
 
-#class Riak2PbcTransportTest(Riak2CoreTransportTest, unittest.TestCase):
-#    def setUp(self):
-#        self.transport = PbcTransport()
+class Riak2FakeHttpTransportTest(Riak2CoreTransportTest, unittest.TestCase):
+    """The HTTP transport against the fake node, no live Riak needed."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeHttpServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.transport = HttpTransport(ConnectionManager.get_http_cm(self.server.host,
+                                                                     self.server.port))
+
+    def test_solr_simple_search(self):
+        pass # The fake node has no solr interface
+
+    def test_keepalive(self):
+        cm = ConnectionManager.get_http_cm(self.server.host, self.server.port)
+        transport = HttpTransport(cm, max_requests=2)
+        for i in xrange(5):
+            transport.ping()
+        stats = transport.connection_stats()
+        self.assertEqual((5, 2, 3, 2), (stats["requests"], stats["reused"],
+                                        stats["connects"], stats["reconnects"]))
+        self.assertEqual(0.4, stats["reuse_ratio"])
+
+        transport = HttpTransport(cm, keepalive_timeout=0.01)
+        transport.ping()
+        time.sleep(0.02)
+        transport.ping()
+        self.assertEqual(1, transport.reconnects)
+
+    def test_stale_connections_are_reopened(self):
+        server = FakeHttpServer(keepalive_timeout=0.02).start()
+        try:
+            cm = ConnectionManager.get_http_cm(server.host, server.port)
+            transport = HttpTransport(cm)
+            transport.ping()
+            time.sleep(0.1) # The server hangs up
+            transport.ping()
+            self.assertEqual(1, transport.reconnects)
+            self.assertEqual(0, cm.hosts[0].failures)
+        finally:
+            server.stop()
+
+    def test_stream_with_deadline_and_connection_close(self):
+        # httplib closes conn's socket as soon as it has the headers, the
+        # stream reads on from (and times) the one under the response.
+        server = FakeHttpServer(close_connections=True).start()
+        try:
+            cm = ConnectionManager.get_http_cm(server.host, server.port)
+            transport = HttpTransport(cm)
+            for i in xrange(3):
+                transport.put("close_bucket", "key%d" % i, "x", {"content_type": "text/plain"})
+            for i in xrange(2):
+                keys = list(transport.stream_keys("close_bucket", deadline=5))
+                self.assertEqual(["key0", "key1", "key2"], sorted(keys))
+            self.assertEqual(0, cm.hosts[0].failures)
+        finally:
+            server.stop()
+
+    def test_is_stale(self):
+        a, b = socket.socketpair()
+        # Past FD_SETSIZE, where select.select gives up.
+        os.dup2(a.fileno(), 2000)
+        c = socket.fromfd(2000, a.family, a.type)
+        os.close(2000)
+        try:
+            for sock in a, c:
+                self.assertFalse(self.transport._is_stale(sock))
+                self.assertFalse(self.transport._can_read(sock))
+            b.sendall("x")
+            for sock in a, c:
+                self.assertTrue(self.transport._is_stale(sock))
+                self.assertTrue(self.transport._can_read(sock))
+            a.recv(1)
+            b.close()
+            for sock in a, c:
+                self.assertTrue(self.transport._is_stale(sock))
+                self.assertTrue(self.transport._can_read(sock))
+                self.assertEqual(None, sock.gettimeout())
+        finally:
+            for sock in a, b, c:
+                sock.close()
+
+    def test_siblings_without_multipart(self):
+        # Like an old node: the 300 is just a list of vtags, one GET each.
+        class OldNodeTransport(HttpTransport):
+            _accept = "text/plain, */*; q=0.5"
+
+        collector = HistogramCollector()
+        cm = ConnectionManager.get_http_cm(self.server.host, self.server.port)
+        self.transport = OldNodeTransport(cm, instrument=collector)
+        self.test_siblings()
+        # Multipart takes 3: the get and a vtag get per sibling. The 300s to
+        # the put and the get cost one more per sibling each.
+        self.assertEqual(7, collector.stats()["get"]["count"])
+
+class Riak2PbcTransportTest(Riak2CoreTransportTest, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakePbcServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        cm = ConnectionManager(PbcConnection, [(self.server.host, self.server.port)])
+        self.transport = PbcTransport(cm)
+
+    def assertStatus(self, status, metadata):
+        pass # No status codes in PBC
+
+    def test_better_puts_and_get_and_delete(self):
+        meta = {"content_type": "application/json", "usermeta": {"testmeta": "bar"}}
+        result = self.transport.put("test_bucket", "foo", "{1 : 2}", meta)
+        self.assertEqual("bar", result[1]["usermeta"]["testmeta"])
+
+        result = self.transport.get("test_bucket", "foo")
+        self.assertEqual("bar", result[1]["usermeta"]["testmeta"])
+
+        self.transport.delete("test_bucket", "foo")
+        self.assertEqual(None, self.transport.get("test_bucket", "foo"))
+
+    def test_solr_simple_search(self):
+        pass # Solr is HTTP only
 
 class Riak2HigherAPITest(unittest.TestCase):
     def setUp(self):
@@ -326,5 +554,1329 @@ class Riak2HigherAPITest(unittest.TestCase):
         bucket.r = "quorum"
 
 
+class FakeRiakTest(unittest.TestCase):
+    """Higher level API tests against the fake PB server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakePbcServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.client = riak2.Client(self.server.host, self.server.port,
+                                   transport_class=PbcTransport)
+
+    def http_client(self):
+        """For the checks run over both transports: self.client's HTTP
+        counterpart, on a fake node of its own, stopped after the test."""
+        server = FakeHttpServer().start()
+        self.addCleanup(server.stop)
+        return riak2.Client(server.host, server.port)
+
+class Riak2BulkTest(FakeRiakTest):
+    def test_multiget(self):
+        bucket = self.client["test_bucket"]
+        keys = ["key%d" % i for i in xrange(20)]
+        for i, key in enumerate(keys):
+            bucket.new(key, {"value": i}).store()
+
+        objs = bucket.multiget(keys + ["nope"], concurrency=4)
+        self.assertEqual(keys + ["nope"], [o.key for o in objs])
+        self.assertEqual(range(20), [o.data["value"] for o in objs[:20]])
+        self.assertFalse(objs[20].exists)
+
+        for key in keys:
+            bucket.get(key).delete()
+
+    def test_threads_are_kept(self):
+        bucket = self.client["test_bucket"]
+        keys = ["key%d" % i for i in xrange(20)]
+        list(bucket.multistore([bucket.new(key, i) for i, key in enumerate(keys)],
+                               concurrency=4))
+        executor = self.client.executor
+        for i in xrange(20):
+            objs = bucket.multiget(keys, concurrency=4)
+            self.assertEqual(range(20), [o.data for o in objs])
+        threads = list(executor._threads)
+        self.assertTrue(0 < len(threads) <= 8, len(threads)) # Not 3 per call.
+        for obj, result in bucket.multidelete(keys, concurrency=4):
+            self.assertEqual(None, result)
+        self.assertEqual(threads, executor._threads[:len(threads)])
+
+        # Called from the executor's own threads, none of them left idle.
+        executor = riak2.utils.Executor(2)
+        def nested(i, executor=executor):
+            return riak2.utils.concurrent_map(lambda j: i * j, range(3), 3, executor)
+        futures = [executor.submit(nested, i) for i in xrange(2)]
+        self.assertEqual([[0, 0, 0], [0, 1, 2]], [f.result(5) for f in futures])
+
+        threads = executor._threads
+        del executor, futures, nested # The threads go with it.
+        for t in threads:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+
+    def test_multiget_errors_and_buckets(self):
+        self.client["b1"].new("foo", 1).store()
+        self.client["b2"].new("foo", 2).store()
+        objs = self.client.multiget([("b1", "foo"), (self.client["b2"], "foo"), ("b1", None)])
+        self.assertEqual([1, 2], [o.data for o in objs[:2]])
+        self.assertTrue(isinstance(objs[2], Exception))
+        objs[0].delete()
+        objs[1].delete()
+
+    def test_multistore_and_multidelete(self):
+        bucket = self.client["test_bucket"]
+        pulled = []
+        def objects():
+            for i in xrange(50):
+                pulled.append(i)
+                yield bucket.new("key%d" % i, i)
+
+        results = bucket.multistore(objects(), concurrency=4)
+        obj, result = next(results)
+        self.assertTrue(obj is result)
+        self.assertTrue(len(pulled) < 50) # Backpressure
+        results = [obj] + [r for o, r in results]
+        self.assertEqual(50, len(results))
+        self.assertEqual(50, len(bucket.get_keys()))
+        self.assertEqual(set(range(50)), set(r.data for r in results))
+
+        keys = ["key%d" % i for i in xrange(50)]
+        deleted = list(bucket.multidelete(keys, concurrency=4))
+        self.assertEqual(set(keys), set(k for k, r in deleted))
+        self.assertEqual([None] * 50, [r for k, r in deleted])
+        self.assertEqual(0, len(bucket.get_keys()))
+
+    def test_multistore_errors(self):
+        bucket = self.client["test_bucket"]
+        good = bucket.new("good", 1)
+        bad = bucket.new("bad", set([1])) # Can't be encoded as json
+        results = dict(bucket.multistore([good, bad], return_body=False))
+        self.assertTrue(results[good] is good)
+        self.assertTrue(isinstance(results[bad], TypeError))
+        self.assertEqual(["good"], bucket.get_keys())
+        good.delete()
+
+
+class Riak2StreamTest(FakeRiakTest):
+    def test_stream_keys(self):
+        bucket = self.client["test_bucket"]
+        for i in xrange(10):
+            bucket.new("key%d" % i, i).store(return_body=False)
+        self.assertEqual(set("key%d" % i for i in xrange(10)), set(bucket.stream_keys()))
+        self.assertTrue("test_bucket" in list(self.client.stream_buckets()))
+        list(bucket.multidelete(bucket.get_keys()))
+
+    def test_mapreduce_stream(self):
+        bucket = self.client["test_bucket"]
+        bucket.new("foo", 2).store()
+        bucket.new("bar", 3).store()
+        results = self.client.add("test_bucket") \
+                      .map("Riak.mapValuesJson", {"keep": True}) \
+                      .reduce("Riak.reduceSum", {"keep": True}).stream()
+        self.assertEqual([(0, [2, 3]), (1, [5])],
+                         sorted((phase, sorted(r)) for phase, r in results))
+
+        links = list(self.client.add("test_bucket", "foo").stream())
+        self.assertEqual(1, len(links))
+        phase, objs = links[0]
+        self.assertEqual(2, objs[0].data)
+
+        bucket.get("foo").delete()
+        bucket.get("bar").delete()
+
+    def check_value_streams(self, client):
+        bucket = client["stream_bucket"]
+        value = "".join(chr(i % 256) for i in xrange(200 * 1024))
+        with tempfile.TemporaryFile() as f:
+            f.write("skipped" + value)
+            f.seek(7)
+            obj = bucket.new("big", None, "application/octet-stream")
+            obj.add_index("size_int", len(value))
+            obj.store_from(f)
+        self.assertEqual(value, bucket.get("big").data)
+        self.assertEqual(["big"], bucket.index("size_int", len(value)))
+
+        with bucket.get_stream("big") as reader:
+            self.assertEqual("application/octet-stream", reader.metadata["content-type"])
+            self.assertEqual(bucket.get("big").vclock, reader.vclock)
+            self.assertEqual(value[:10], reader.read(10))
+            buf = bytearray(100 * 1024)
+            self.assertEqual(len(buf), reader.readinto(buf))
+            self.assertEqual(value[10:10 + len(buf)], str(buf))
+            self.assertEqual(value[10 + len(buf):], reader.read())
+            self.assertEqual(0, reader.readinto(buf))
+
+        reader = bucket.get_stream("big")
+        reader.read(5)
+        reader.close() # Early
+        self.assertEqual(value, "".join(bucket.get_stream("big")))
+        self.assertEqual(None, bucket.get_stream("nope"))
+
+        read, write = os.pipe() # Can't seek, so it goes chunked.
+        os.write(write, value[:1000])
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            obj = bucket.new(None, None, "text/plain").store_from(pipe)
+        self.assertEqual(value[:1000], "".join(bucket.get_stream(obj.key)))
+
+        bucket.set_properties(allow_mult=True)
+        bucket.new("big", "other", "text/plain").store(return_body=False)
+        self.assertRaises(riak2.exceptions.ConflictError, bucket.get_stream, "big")
+        bucket.set_properties(allow_mult=False)
+        for key in ("big", obj.key):
+            bucket.get(key).delete()
+
+    def test_value_streams_pbc(self):
+        self.check_value_streams(self.client)
+
+    def test_value_streams_http(self):
+        self.check_value_streams(self.http_client())
+
+
+class Riak2IndexTest(FakeRiakTest):
+    def check_pagination(self, client):
+        bucket = client["index_bucket"]
+        for obj, result in bucket.multistore(
+                (bucket.new("key%03d" % i, i).add_index("n_int", i).add_index("g_bin", "g%d" % (i % 2))
+                 for i in xrange(250)), return_body=False):
+            self.assertTrue(result is obj)
+
+        page = bucket.index("n_int", 10, 19)
+        self.assertEqual(["key%03d" % i for i in xrange(10, 20)], page)
+        self.assertEqual(None, page.continuation)
+        self.assertEqual(None, page.next_page())
+
+        pages = [bucket.index("g_bin", "g0", max_results=50)]
+        while pages[-1].continuation is not None:
+            pages.append(pages[-1].next_page())
+        self.assertEqual([50, 50, 25], [len(p) for p in pages])
+        self.assertEqual(["key%03d" % i for i in xrange(0, 250, 2)], sum(pages, []))
+        self.assertEqual(pages[2], bucket.index("g_bin", "g0", max_results=50,
+                                                continuation=pages[1].continuation))
+
+        self.assertEqual([(i, "key%03d" % i) for i in xrange(5, 8)],
+                         bucket.index("n_int", 5, 7, return_terms=True))
+        self.assertEqual([(2, "key002")], bucket.index("n_int", 2, return_terms=True))
+
+        self.assertEqual(["key%03d" % i for i in xrange(250)], list(bucket.iter_index("n_int", 0, 1000)))
+        self.assertEqual([("g1", "key%03d" % i) for i in xrange(1, 250, 2)],
+                         list(bucket.iter_index("g_bin", "g1", "g1", return_terms=True, max_results=30)))
+        keys = bucket.iter_index("n_int", 0, 1000)
+        self.assertEqual("key000", next(keys))
+        keys.close() # Early
+        self.assertEqual(10, len(bucket.index("n_int", 0, 9)))
+        list(bucket.multidelete(bucket.get_keys()))
+
+    def test_pagination_pbc(self):
+        self.check_pagination(self.client)
+
+    def test_pagination_http(self):
+        self.check_pagination(self.http_client())
+
+
+class Riak2ChunkedTest(FakeRiakTest):
+    def test_put_and_get(self):
+        files = riak2.ChunkedBucket(self.client["files"], chunk_size=1000, concurrency=3)
+        chunks = self.client["files_chunks"]
+        value = "".join(chr(i % 256) for i in xrange(10500))
+        manifest = files.put("big", value)
+        self.assertEqual((10500, 11), (manifest["size"], len(manifest["chunks"])))
+        self.assertEqual(11, len(chunks.get_keys()))
+        self.assertEqual(value, files.get_data("big"))
+
+        with files.get("big") as reader:
+            self.assertEqual((10500, "application/octet-stream"),
+                             (reader.size, reader.content_type))
+            self.assertEqual(value[:1500], reader.read(1500))
+            buf = bytearray(2000)
+            self.assertEqual(2000, reader.readinto(buf))
+            self.assertEqual(value[1500:3500], str(buf))
+        reader = files.get("big")
+        reader.read(10)
+        reader.close() # Early, the fetches ahead are dropped.
+        self.assertEqual(None, files.get("nope"))
+
+        with tempfile.TemporaryFile() as f: # Replaced, the old chunks stay a while.
+            f.write(value[:2500])
+            f.seek(0)
+            files.put("big", f, "text/plain")
+        self.assertEqual(14, len(chunks.get_keys()))
+        self.assertEqual("text/plain", files.get("big").content_type)
+        self.assertEqual(value[:2500], files.get_data("big"))
+        files.put("empty", "")
+        self.assertEqual("", files.get_data("empty"))
+
+        files.delete("big")
+        files.delete("empty")
+        self.assertEqual(None, files.manifest("big"))
+        self.assertEqual([], chunks.get_keys())
+
+    def test_overwrite_while_reading(self):
+        files = riak2.ChunkedBucket(self.client["files"], chunk_size=10, concurrency=2,
+                                    grace=0.2)
+        chunks = self.client["files_chunks"]
+        files.put("foo", "a" * 100)
+        reader = files.get("foo")
+        self.assertEqual("a" * 10, reader.read(10))
+        files.put("foo", "b" * 100) # The reader keeps to the old value.
+        self.assertEqual("a" * 90, reader.read())
+        self.assertEqual("b" * 100, files.get_data("foo"))
+        self.assertEqual(20, len(chunks.get_keys()))
+
+        reader = files.get("foo")
+        self.assertEqual("b" * 10, reader.read(10))
+        time.sleep(0.25)
+        files.put("foo", "c" * 50) # The "a" chunks go, the "b" ones are still kept.
+        self.assertEqual(15, len(chunks.get_keys()))
+        self.assertEqual("b" * 90, reader.read())
+        self.assertEqual(1, len(files.manifest("foo")["replaced"]))
+
+        reader = files.get("foo")
+        self.assertEqual("c" * 10, reader.read(10))
+        files.put("foo", "d")
+        time.sleep(0.25)
+        files.put("foo", "e") # Too slow a reader: the "c" chunks are gone.
+        self.assertEqual(2, len(chunks.get_keys()))
+        self.assertRaises(riak2.ChangedError, reader.read)
+
+        reader = files.get("foo")
+        files.delete("foo")
+        self.assertRaises(riak2.ChangedError, reader.read)
+        self.assertEqual([], chunks.get_keys())
+
+    def test_integrity(self):
+        files = riak2.ChunkedBucket(self.client["files"], chunk_size=10)
+        chunks = files.put("foo", "x" * 25)["chunks"]
+        obj = self.client["files_chunks"].get(chunks[1][0])
+        obj.data = "y" * 10
+        obj.store()
+        reader = files.get("foo")
+        self.assertEqual("x" * 10, reader.read(10))
+        self.assertRaises(riak2.IntegrityError, reader.read)
+
+        self.client["files_chunks"].get(chunks[1][0]).delete()
+        self.assertRaises(riak2.NotFoundError, files.get_data, "foo")
+        files.delete("foo")
+
+
+class Riak2SiblingTest(FakeRiakTest):
+    def test_conflict_handler(self):
+        bucket = self.client["sibling_bucket"]
+        bucket.set_properties(allow_mult=True)
+        bucket.new("foo", {"v": 1}).store()
+        bucket.new("foo", {"v": 2}).store(return_body=False)
+
+        seen = []
+        def resolve(obj):
+            seen.extend(sorted(s.data["v"] for s in obj.siblings.values()))
+            sibling = max(obj.siblings.values(), key=lambda s: s.data["v"])
+            obj.siblings = {sibling.vclock: sibling}
+        obj = bucket.get("foo", conflict_handler=resolve)
+        self.assertEqual([1, 2], seen)
+        self.assertEqual({"v": 2}, obj.data)
+        obj.delete()
+
+
+class Riak2ViewTest(FakeRiakTest):
+    def test_views(self):
+        bucket = self.client["view_bucket"]
+        obj = bucket.new("foo", {"list": [1, 2], "nested": {"a": 1}})
+        obj.usermeta = {"owner": "me"}
+        obj.add_index("field_bin", "a")
+        obj.add_link(bucket.new("bar"), "friend")
+
+        data = obj.get_data()
+        self.assertEqual({"list": [1, 2], "nested": {"a": 1}}, data)
+        self.assertEqual([1, 2], data["list"])
+        self.assertEqual(json.loads(json.dumps(obj.data)), json.loads(json.dumps(data)))
+        self.assertEqual(set(["a"]), obj.get_indexes("field_bin"))
+        self.assertEqual(set(["a"]) | set(["b"]), obj.get_indexes()["field_bin"] | set(["b"]))
+        self.assertEqual([("view_bucket", "bar", "friend")], obj.get_links())
+        self.assertEqual(["owner"], obj.get_usermeta().keys())
+
+        self.assertRaises(TypeError, operator.setitem, data, "x", 1)
+        self.assertRaises(TypeError, data["list"].append, 3)
+        self.assertRaises(TypeError, data["nested"].update, {})
+        self.assertRaises(AttributeError, getattr, obj.get_indexes("field_bin"), "add")
+        self.assertRaises(TypeError, obj.get_links().append, None)
+        self.assertRaises(TypeError, hash, data)
+
+        thawed = data.thaw()
+        thawed["list"].append(3)
+        self.assertEqual([1, 2], obj.data["list"])
+        obj.data["list"].append(4) # A snapshot, like a copy would be.
+        self.assertEqual([1, 2], data["list"])
+
+        obj.store()
+        obj = bucket.get("foo")
+        self.assertEqual({"list": [1, 2, 4], "nested": {"a": 1}}, obj.get_data())
+        self.assertEqual({"owner": "me"}, obj.get_usermeta())
+        self.assertEqual(1, len(obj.get_links()))
+        obj.delete()
+
+    def test_store_after_get(self):
+        bucket = self.client["view_bucket"]
+        a = bucket.new("a", {"x": [1, {"y": 2}]}).store()
+
+        bucket.new("copy", a.get_data()).store()
+        self.assertEqual({"x": [1, {"y": 2}]}, bucket.get("copy").data)
+
+        d = dict(a.get_data())
+        d["y"] = 1
+        a.set_data(d)
+        a.store()
+        self.assertEqual({"x": [1, {"y": 2}], "y": 1}, bucket.get("a").data)
+        a.data["x"].append(3) # Stored as plain, mutable containers.
+        self.assertEqual([1, {"y": 2}, 3], a.data["x"])
+
+        b = bucket.new("b")
+        b.data = a.get_data() # Thawed on the way in, like set_data.
+        b.get_data(return_copy=False)["w"] = 1
+        b.metadata = a.get_metadata()
+        b.usermeta = a.get_usermeta()
+        b.usermeta["u"] = "1"
+        b.links = a.get_links()
+        b.links.append(("view_bucket", "a", "a"))
+        self.assertEqual(1, b.data["w"])
+        self.assertEqual({"u": "1"}, b.get_usermeta())
+
+        a.set_data(a.get_data(), use_copy=False)
+        a.data["z"] = 2
+        a.set_usermeta(a.get_usermeta())
+        a.store()
+        self.assertEqual(2, bucket.get("a").data["z"])
+        for key in ("a", "copy"):
+            bucket.get(key).delete()
+
+    def test_snapshots_are_kept(self):
+        bucket = self.client["view_bucket"]
+        bucket.new("foo", {"a": [1]}).add_index("field_bin", "a").store()
+        obj = bucket.get("foo")
+        for name in ("data", "metadata", "usermeta", "links", "indexes"):
+            get = getattr(obj, "get_" + name)
+            self.assertTrue(get() is get(), name) # No copy without a change.
+
+        data = obj.get_data()
+        obj.set_data({"a": [2]})
+        self.assertEqual({"a": [1]}, data)
+        self.assertEqual({"a": [2]}, obj.get_data())
+        indexes = obj.get_indexes()
+        obj.add_index("field_bin", "b")
+        self.assertEqual(set(["a"]), indexes["field_bin"])
+        self.assertEqual(set(["a", "b"]), obj.get_indexes("field_bin"))
+        obj.set_indexes(["c"], "field_bin")
+        self.assertEqual(set(["c"]), obj.get_indexes("field_bin"))
+        links = obj.get_links()
+        obj.add_link(bucket.new("bar"))
+        self.assertEqual(([], 1), (links, len(obj.get_links())))
+        obj.remove_link(bucket.new("bar"), "view_bucket")
+        self.assertEqual([], obj.get_links())
+
+        # Handed out as is, changes in place show.
+        obj.data["a"].append(3)
+        self.assertEqual({"a": [2, 3]}, obj.get_data())
+        obj.get_usermeta(return_copy=False)["m"] = "1"
+        self.assertEqual({"m": "1"}, obj.get_usermeta())
+        usermeta = {}
+        obj.set_usermeta(usermeta, use_copy=False)
+        obj.get_usermeta()
+        usermeta["n"] = "2"
+        self.assertEqual({"n": "2"}, obj.get_usermeta())
+
+        data = obj.get_data()
+        obj.reload()
+        self.assertEqual({"a": [1]}, obj.get_data())
+        self.assertFalse(data is obj.get_data())
+        obj.delete()
+
+    def test_slots(self):
+        bucket = self.client["view_bucket"]
+        obj = bucket.new("foo", {"a": 1})
+        self.assertFalse(hasattr(obj, "__dict__"))
+        self.assertRaises(AttributeError, setattr, obj, "nope", 1)
+        self.assertRaises(AttributeError, setattr, obj, "vclock", "x")
+
+        sibling = obj.siblings.values()[0]
+        self.assertFalse(hasattr(sibling, "__dict__"))
+        for slot in ("_metadata", "_indexes", "_links", "_usermeta"):
+            self.assertEqual(None, getattr(sibling, slot)) # Nothing allocated yet.
+        obj.store()
+        obj = bucket.get("foo")
+        sibling = obj.siblings.values()[0]
+        self.assertEqual((None, None, None), (sibling._indexes, sibling._links, sibling._usermeta))
+        self.assertEqual({"a": 1}, obj.data)
+        self.assertEqual([], obj.links) # Allocated when asked for.
+        self.assertEqual([], sibling._links)
+
+        obj.indexes = {"field_bin": set(["x"])}
+        obj.add_link(bucket.new("bar"))
+        obj.content_type = "application/json"
+        obj.store()
+        obj = bucket.get("foo")
+        self.assertEqual(set(["x"]), obj.indexes["field_bin"])
+        self.assertEqual([("view_bucket", "bar", "view_bucket")], obj.links)
+        self.assertTrue(obj.vclock)
+        obj.delete()
+
+    def test_lazy_decoding(self):
+        bucket = self.client["lazy_bucket"]
+        decoded = []
+        def decode(data):
+            decoded.append(data)
+            return json.loads(data)
+        bucket.decoders["application/json"] = decode
+
+        bucket.new("foo", {"a": 1}).store(return_body=False)
+        bucket.encoders["application/json"] = lambda data: self.fail("encoded")
+        obj = bucket.get("foo")
+        obj.usermeta = {"m": "1"}
+        obj.store()
+        obj = bucket.get("foo")
+        self.assertTrue(obj.exists and obj.vclock)
+        self.assertEqual({"m": "1"}, obj.usermeta)
+        self.assertEqual([], decoded)
+
+        self.assertEqual({"a": 1}, obj.data)
+        self.assertEqual({"a": 1}, obj.data)
+        self.assertEqual(['{"a": 1}'], decoded)
+
+        obj.data["a"] = 2 # Changed in place, so it has to be encoded again.
+        bucket.encoders["application/json"] = json.dumps
+        obj.store()
+        self.assertEqual({"a": 2}, bucket.get("foo").data)
+        obj.delete()
+
+
+class Riak2SerializerTest(FakeRiakTest):
+    def test_registries(self):
+        client = self.client
+        bucket = client["serializer_bucket"]
+        other = client["other_bucket"]
+        self.assertTrue(bucket.decoders["application/json"] is riak2.serializers.json_loads)
+        self.assertEqual(sorted(riak2.serializers.DECODERS), sorted(bucket.decoders.keys()))
+        self.assertEqual(dict(riak2.serializers.DECODERS), dict(bucket.decoders))
+        self.assertEqual(len(riak2.serializers.DECODERS), len(bucket.decoders))
+
+        client.encoders["text/upper"] = lambda data: data.upper()
+        client.decoders["text/upper"] = lambda data: data.lower()
+        other.decoders["text/upper"] = lambda data: "mine"
+        self.assertTrue("text/upper" in bucket.encoders)
+        self.assertFalse("text/nope" in bucket.encoders)
+        self.assertEqual(None, bucket.decoders.get("text/nope"))
+
+        bucket.new("foo", "abc", "text/upper").store()
+        self.assertEqual("abc", bucket.get("foo").data)
+        self.assertEqual("ABC", bucket.get("foo").get_encoded_data())
+        self.assertEqual("mine", other.decoders["text/upper"]("X"))
+        self.assertEqual("x", bucket.decoders["text/upper"]("X"))
+        self.assertEqual(1, bucket.decoders.keys().count("text/upper"))
+        self.assertEqual(1, other.decoders.keys().count("text/upper"))
+        self.assertEqual("mine", dict(other.decoders.items())["text/upper"]("X"))
+        del other.decoders["text/upper"] # Back to the client's.
+        self.assertEqual("x", other.decoders["text/upper"]("X"))
+        self.assertRaises(KeyError, other.decoders.__delitem__, "text/upper")
+        bucket.get("foo").delete()
+
+    def test_fast_json(self):
+        values = [{"a": [1, -2, 2 ** 40, 0.5, 1.25, True, False, None]},
+                  [u"caf\xe9", u"\u2603", "quote \" and \\ and \n"],
+                  {"nested": {"deeper": [{}, [], ""]}}, "", 0, []]
+        encoders, decoders = riak2.utils.Registry(), riak2.utils.Registry()
+        self.assertEqual(None, riak2.serializers.use_fast_json(encoders, decoders,
+                                                               ("no_such_json",)))
+        self.assertEqual([], encoders.keys())
+
+        for name in ("ujson", "simplejson", "json"):
+            encoders, decoders = riak2.utils.Registry(), riak2.utils.Registry()
+            if riak2.serializers.use_fast_json(encoders, decoders, (name,)) is None:
+                continue # Not installed
+            dumps, loads = encoders["application/json"], decoders["text/json"]
+            for value in values:
+                # Each way, and both ways, it's what json makes of it.
+                expected = json.loads(json.dumps(value))
+                self.assertEqual(expected, loads(dumps(value)))
+                self.assertEqual(expected, json.loads(dumps(value)))
+                self.assertEqual(expected, loads(json.dumps(value)))
+        # The defaults stay put.
+        self.assertTrue(self.client.decoders["application/json"] is json.loads)
+
+    def check_compression(self, client):
+        bucket = client["compressed_bucket"]
+        value = {"text": "x" * 5000}
+        bucket.new("small", {"a": 1}).store()
+        bucket.new("large", value).store()
+        self.assertEqual(None, bucket.get("large").metadata.get("content-encoding"))
+
+        client.compression = "gzip"
+        obj = bucket.new("large", value).store()
+        self.assertEqual(value, obj.data)
+        obj = bucket.get("large")
+        self.assertEqual("gzip", obj.metadata["content-encoding"])
+        self.assertTrue(len(obj.siblings.values()[0]._encoded) < 100)
+        self.assertEqual(value, obj.data)
+        bucket.new("small", {"a": 1}).store() # Under the threshold.
+        self.assertEqual(None, bucket.get("small").metadata.get("content-encoding"))
+
+        obj = bucket.get("large")
+        client.compression = None # Untouched, so it goes back as it came.
+        obj.usermeta = {"m": "1"}
+        obj.store(return_body=False)
+        self.assertEqual("gzip", bucket.get("large").metadata["content-encoding"])
+
+        bucket.compression = "deflate"
+        bucket.compress_threshold = 1
+        self.assertEqual(None, client.compression)
+        obj = bucket.new(None, {"a": 1}).store()
+        self.assertEqual({"a": 1}, obj.data)
+        self.assertEqual({"a": 1}, bucket.get(obj.key).data)
+        self.assertEqual("deflate", bucket.get(obj.key).metadata["content-encoding"])
+        for key in ("small", "large", obj.key):
+            bucket.get(key).delete()
+
+    def test_compression_pbc(self):
+        self.check_compression(self.client)
+
+    def test_compression_http(self):
+        self.check_compression(self.http_client())
+
+
+class Riak2CacheTest(FakeRiakTest):
+    def test_read_through(self):
+        cache = self.client.cache = riak2.ObjectCache()
+        bucket = self.client["test_bucket"]
+        bucket.new("foo", {"value": 1}).store()
+
+        obj = bucket.get("foo")
+        self.assertEqual({"value": 1}, obj.data)
+        obj.data["value"] = 2 # Doesn't leak into the cache
+        self.assertEqual({"value": 1}, bucket.get("foo").data)
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+
+        obj.store()
+        self.assertEqual({"value": 2}, bucket.get("foo").data)
+        obj.store(return_body=False)
+        self.assertEqual(0, len(cache))
+        self.assertEqual({"value": 2}, bucket.get("foo").data)
+        self.assertEqual(1, cache.misses)
+
+        obj.delete()
+        self.assertFalse(bucket.get("foo").exists)
+        self.assertEqual(0, len(cache))
+
+    def test_hits_share_decoded_data(self):
+        self.client.cache = riak2.ObjectCache()
+        bucket = self.client["cache_decode_bucket"]
+        decoded = []
+        def decode(data):
+            decoded.append(data)
+            return json.loads(data)
+        bucket.decoders["application/json"] = decode
+        bucket.new("foo", {"list": [1]}).store(return_body=False)
+
+        self.assertEqual({"list": [1]}, bucket.get("foo").get_data()) # The miss
+        self.assertEqual({"list": [1]}, bucket.get("foo").get_data()) # Decoded for good
+        self.assertEqual(2, len(decoded))
+        for i in xrange(3):
+            self.assertEqual({"list": [1]}, bucket.get("foo").get_data())
+            obj = bucket.get("foo")
+            obj.data["list"].append(2) # Thawed, for this object only.
+            self.assertEqual([1, 2], obj.get_data()["list"])
+        self.assertEqual(2, len(decoded))
+
+        obj.store()
+        self.assertEqual([1, 2], bucket.get("foo").data["list"])
+        bucket.get("foo").delete()
+
+    def test_ttl_and_revalidate(self):
+        other = self.client["test_bucket"]
+        self.client.cache = riak2.ObjectCache(ttl=0.05)
+        bucket = self.client["test_bucket"]
+        obj = bucket.new("foo", 1).store()
+
+        other_client = riak2.Client(self.server.host, self.server.port,
+                                    transport_class=PbcTransport)
+        other = other_client["test_bucket"].get("foo")
+        other.data = 2
+        other.store()
+        self.assertEqual(1, bucket.get("foo").data) # Stale until the ttl is over
+        time.sleep(0.06)
+        self.assertEqual(2, bucket.get("foo").data)
+
+        cache = self.client.cache = riak2.ObjectCache(revalidate=True)
+        self.assertEqual(2, bucket.get("foo").data)
+        self.assertEqual(2, bucket.get("foo").data)
+        self.assertEqual((1, 1, 1), (cache.hits, cache.revalidated, cache.misses))
+        other.data = 3
+        other.store()
+        self.assertEqual(3, bucket.get("foo").data)
+        self.assertEqual(2, cache.misses)
+        obj.delete()
+
+    def test_eviction(self):
+        cache = self.client.cache = riak2.ObjectCache(max_entries=2)
+        bucket = self.client["test_bucket"]
+        for key in ("a", "b", "c"):
+            bucket.new(key, "x" * 100, content_type="text/plain").store()
+        self.assertEqual([("test_bucket", "b"), ("test_bucket", "c")], list(cache._entries))
+        self.assertEqual(1, cache.evictions)
+
+        cache = self.client.cache = riak2.ObjectCache(max_bytes=400)
+        bucket.get("a")
+        bucket.get("b")
+        bucket.get("a")
+        bucket.get("c")
+        self.assertEqual([("test_bucket", "a"), ("test_bucket", "c")], list(cache._entries))
+        self.assertTrue(cache.bytes <= 400)
+        bucket.new("big", "x" * 1000, content_type="text/plain").store()
+        self.assertEqual(2, len(cache))
+
+        list(bucket.multidelete(["a", "b", "c", "big"]))
+        self.assertEqual(0, len(cache))
+
+
+class BenchmarkTest(FakeRiakTest):
+    def test_workloads(self):
+        # Just that they all still run, the numbers mean nothing here.
+        options = argparse.Namespace(size=1024, chunk_size=256, siblings=3)
+        for name, workload in benchmark.WORKLOADS.iteritems():
+            result = benchmark.bench(workload(self.client, options), 3)
+            self.assertEqual(name, result["workload"])
+            self.assertTrue(result["ops"] >= 3 and result["ops/s"] > 0)
+        self.assertEqual(None, self.client.instrument)
+
+
+class Riak2InstrumentTest(FakeRiakTest):
+    def check(self, client):
+        collector = HistogramCollector()
+        client.instrument = collector
+        bucket = client["instrument_bucket"]
+        for i in xrange(10):
+            bucket.new("key%d" % i, {"i": i}).store()
+        for i in xrange(10):
+            self.assertEqual({"i": i}, bucket.get("key%d" % i).data)
+        self.assertEqual(10, len(client.transport.get_keys("instrument_bucket")))
+        list(bucket.multidelete(["key%d" % i for i in xrange(10)]))
+
+        stats = collector.stats()
+        for name in ("get", "put", "load", "store", "stream_keys"):
+            self.assertEqual(10 if name != "stream_keys" else 1, stats[name]["count"])
+            self.assertTrue(0 < stats[name]["p50"] <= stats[name]["p99"] <= stats[name]["max"])
+        self.assertEqual(10, stats["delete"]["count"])
+        self.assertEqual(0, stats["get"]["errors"])
+
+        get = stats["get"]
+        host = "%s:%s" % client.connection_manager.hosts[0].hostport
+        self.assertEqual([host], get["hosts"].keys())
+        self.assertEqual(10, get["hosts"][host]["count"])
+        self.assertTrue(set(["prepare", "checkout", "write", "read", "parse"]) <= set(get["phases"]))
+        self.assertTrue(get["bytes_in"] > 0 and stats["put"]["bytes_out"] > 0)
+        self.assertEqual(set(["fetch", "decode"]), set(stats["load"]["phases"]))
+        self.assertEqual(set(["encode", "send", "decode"]), set(stats["store"]["phases"]))
+        self.assertTrue(stats["stream_keys"]["bytes_in"] > 0)
+
+        client.instrument = None
+        bucket.get("key0")
+        self.assertEqual(10, collector.stats()["get"]["count"])
+        return stats
+
+    def test_pbc(self):
+        self.check(self.client)
+
+    def test_http(self):
+        stats = self.check(self.http_client())
+        self.assertTrue("server" in stats["get"]["phases"])
+
+    def test_operation(self):
+        collector = HistogramCollector()
+        ops = []
+        class Recorder(Instrument):
+            def begin(self, op):
+                ops.append(op)
+
+            def end(self, op):
+                collector.end(op)
+
+        def fail():
+            with operation(Recorder(), "fail", "b") as op:
+                op.mark("one")
+                raise ValueError("nope")
+
+        self.assertRaises(ValueError, fail)
+        self.assertTrue(isinstance(ops[0].error, ValueError))
+        self.assertEqual(["one"], ops[0].phases.keys())
+        self.assertEqual(1, collector.stats()["fail"]["errors"])
+        with operation(None, "nothing") as op:
+            self.assertEqual(None, op)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(0, histogram.percentile(50))
+        for i in xrange(1, 101):
+            histogram.add(i / 1000.0)
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(0.1, histogram.max)
+        for p in (50, 95, 99):
+            # Within a bucket, that is 10%.
+            self.assertTrue(p / 1000.0 <= histogram.percentile(p) <= p / 1000.0 * 1.1)
+        self.assertEqual(0.1, histogram.percentile(100))
+        self.assertAlmostEqual(0.0505, histogram.summary()["mean"])
+
+
+class Riak2FutureTest(FakeRiakTest):
+    def setUp(self):
+        FakeRiakTest.setUp(self)
+        self.fclient = riak2.FutureClient(self.client, workers=4)
+
+    def tearDown(self):
+        self.fclient.close()
+
+    def test_store_get_delete(self):
+        bucket = self.fclient["test_bucket"]
+        stored = [bucket.new("key%d" % i, i).store() for i in xrange(10)]
+        for future in stored:
+            self.assertTrue(future.result(5).exists)
+
+        futures = bucket.multiget(["key%d" % i for i in xrange(10)])
+        self.assertEqual(range(10), [f.result(5).data for f in futures])
+
+        done = threading.Event()
+        future = futures[0].result().delete()
+        future.add_done_callback(lambda f: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertFalse(future.result().exists)
+        self.assertFalse(bucket.get("key0").result(5).exists)
+
+        for f in futures[1:]:
+            f.result().delete().result(5)
+
+    def test_exceptions(self):
+        future = self.fclient["test_bucket"].get(None)
+        self.assertTrue(isinstance(future.exception(5), riak2.core.RiakError))
+        self.assertRaises(riak2.core.RiakError, future.result)
+
+    def test_raising_callbacks(self):
+        class Records(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+            def emit(self, record):
+                self.records.append(record)
+
+        def bad(f):
+            raise ValueError("callback")
+
+        log = logging.getLogger("riak2.utils")
+        handler = Records()
+        log.addHandler(handler)
+        try:
+            # More of them than workers: none of the workers may die.
+            for i in xrange(8):
+                done = threading.Event()
+                future = self.fclient.transport.ping()
+                future.add_done_callback(bad)
+                future.add_done_callback(lambda f: done.set())
+                self.assertTrue(done.wait(5))
+            self.assertTrue(self.fclient.transport.ping().result(5))
+            future.add_done_callback(bad) # Already done, runs right here.
+        finally:
+            log.removeHandler(handler)
+        self.assertEqual(9, len(handler.records))
+
+    def test_bulk_and_streams(self):
+        bucket = self.fclient["future_bucket"]
+        self.assertEqual(("future_bucket", "quorum"), (bucket.name, bucket.r))
+        objs = [bucket.new("key%d" % i, i).add_index("i_int", i) for i in xrange(5)]
+        objs.append(self.client["future_bucket"].new("key5", 5).add_index("i_int", 5))
+        self.assertEqual(range(6), [f.result(5).data for f in bucket.multistore(objs)])
+
+        keys = []
+        self.assertEqual(6, bucket.stream_keys(keys.append).result(5))
+        self.assertEqual(["key%d" % i for i in xrange(6)], sorted(keys))
+        self.assertEqual(6, len(bucket.get_keys().result(5)))
+        names = []
+        self.assertTrue(self.fclient.stream_buckets(names.append).result(5) > 0)
+        self.assertTrue("future_bucket" in names)
+        self.assertTrue("future_bucket" in self.fclient.get_buckets().result(5))
+
+        page = bucket.index("i_int", 1, 4, max_results=2).result(5)
+        self.assertEqual(["key1", "key2"], sorted(page))
+        found = []
+        self.assertEqual(4, bucket.iter_index(found.append, "i_int", 1, 4).result(5))
+        self.assertEqual(["key1", "key2", "key3", "key4"], sorted(found))
+
+        bucket.new("blob", "x" * 100, "application/octet-stream").store().result(5)
+        chunks = []
+        reader = bucket.get_stream("blob", chunks.append).result(5)
+        self.assertEqual(("x" * 100, True), ("".join(chunks), reader.closed))
+        self.assertEqual(None, bucket.get_stream("nope", chunks.append).result(5))
+        link = self.fclient.get_from_link(("future_bucket", "key1", None)).result(5)
+        self.assertEqual(1, link.data)
+        self.assertEqual(3, self.fclient.submit(lambda a, b: a + b, 1, b=2).result(5))
+
+        futures = bucket.multidelete(keys + ["blob"])
+        self.assertEqual([None] * 7, [f.result(5) for f in futures])
+        self.assertEqual([], bucket.get_keys().result(5))
+
+    def test_transport_and_mapreduce(self):
+        self.assertTrue(self.fclient.transport.ping().result(5))
+        self.assertTrue(self.fclient.is_alive().result(5))
+        self.fclient["test_bucket"].new("foo", 2).store().result(5)
+        future = self.fclient.add("test_bucket") \
+                     .map("Riak.mapValuesJson").reduce("Riak.reduceSum").run()
+        self.assertEqual([2], future.result(5))
+        self.client["test_bucket"].get("foo").delete()
+
+
+def dead_port():
+    """A port nothing listens on."""
+    dead = socket.socket()
+    dead.bind(("127.0.0.1", 0))
+    port = dead.getsockname()[1]
+    dead.close()
+    return port
+
+class RetryPolicyTest(unittest.TestCase):
+    def failing(self, *errors):
+        calls = []
+        def func():
+            calls.append(1)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return "done"
+        return func, calls
+
+    def test_idempotency(self):
+        policy = RetryPolicy(backoff=0)
+        reset = socket.error(errno.ECONNRESET, "reset")
+        func, calls = self.failing(reset, httplib.BadStatusLine(""))
+        self.assertEqual("done", policy.call(func))
+        self.assertEqual(3, len(calls))
+
+        func, calls = self.failing(reset)
+        self.assertRaises(socket.error, policy.call, func, False)
+        self.assertEqual(1, len(calls))
+
+        # Nothing was sent, so it's fine either way.
+        func, calls = self.failing(socket.error(errno.ECONNREFUSED, "refused"))
+        self.assertEqual("done", policy.call(func, False))
+
+        func, calls = self.failing(riak2.core.RiakError("nope"))
+        self.assertRaises(riak2.core.RiakError, policy.call, func)
+        self.assertEqual(1, len(calls))
+
+    def test_attempts_backoff_and_deadline(self):
+        reset = socket.error(errno.ECONNRESET, "reset")
+        func, calls = self.failing(reset, reset, reset)
+        self.assertRaises(socket.error, RetryPolicy(backoff=0).call, func)
+        self.assertEqual(3, len(calls))
+
+        policy = RetryPolicy(backoff=0.1, multiplier=2, max_backoff=0.3, jitter=False)
+        self.assertEqual([0.1, 0.2, 0.3], [policy.delay(i) for i in (1, 2, 3)])
+        policy.jitter = True
+        self.assertTrue(all(0 <= policy.delay(2) <= 0.2 for i in xrange(20)))
+
+        policy = RetryPolicy(attempts=10, backoff=0.02, jitter=False, deadline=0.05)
+        func, calls = self.failing(*[reset] * 10)
+        start = time.time()
+        self.assertRaises(socket.error, policy.call, func)
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertEqual(2, len(calls)) # 0.02 + 0.04 is past the deadline
+
+        # The request's own deadline counts too.
+        policy.deadline = None
+        func, calls = self.failing(*[reset] * 10)
+        self.assertRaises(socket.error, policy.call, func, True, time.time() + 0.05)
+        self.assertEqual(2, len(calls))
+
+    def test_server_timeout(self):
+        transport = HttpTransport(deadline=2)
+        self.assertEqual(None, transport._server_timeout(None))
+        end = transport._deadline(None)
+        self.assertTrue(1900 < transport._server_timeout(end) <= 2000)
+        self.assertEqual(1000, json.loads(transport._mapred_job([], [], 1000, end))["timeout"])
+        self.assertTrue(1900 < json.loads(transport._mapred_job([], [], None, end))["timeout"])
+        self.assertRaises(socket.timeout, transport._remaining, time.time() - 1)
+
+    def test_retries_go_to_another_host(self):
+        server = FakeHttpServer().start()
+        try:
+            cm = ConnectionManager(httplib.HTTPConnection,
+                                   [("127.0.0.1", dead_port()), (server.host, server.port)])
+            transport = HttpTransport(cm, retry_policy=RetryPolicy(backoff=0))
+            for i in xrange(4):
+                self.assertTrue(transport.ping())
+            self.assertFalse(cm.hosts[0].healthy)
+            self.assertEqual(0, cm.hosts[1].failures)
+        finally:
+            server.stop()
+
+
+class HttpMessageTest(unittest.TestCase):
+    def test_parse_response(self):
+        transport = HttpTransport()
+        headers = {"http_code": 200, "content-type": "text/plain", "etag": "e",
+                   "x-riak-vclock": "vc", "x-riak-meta-owner": "me",
+                   "x-riak-index-a_bin": 'x, y,z, "q, r"',
+                   "x-riak-index-b_int": "1, -2,30",
+                   "x-riak-index-c_int": "05, +6",
+                   "x-riak-index-d_bin": "",
+                   "x-riak-indexer": "not an index",
+                   "link": '</riak/b>; rel="up", </riak/b/k1>; riaktag="t1",'
+                           '</riak/b/k2>;riaktag="t%202", </riak/b/k3>'}
+        vclock, metadata, data = transport._parse_response((headers, "body"), 200)
+        self.assertEqual(("vc", "body"), (vclock, data))
+        self.assertEqual({"owner": "me"}, metadata["usermeta"])
+        self.assertEqual(sorted([("a_bin", "x"), ("a_bin", "y"), ("a_bin", "z"),
+                                 ("a_bin", "q, r"), ("b_int", 1), ("b_int", -2),
+                                 ("b_int", 30), ("c_int", 5), ("c_int", 6)]),
+                         sorted(metadata["index"]))
+        self.assertEqual([("b", "k1", "t1"), ("b", "k2", "t%202")], metadata["link"])
+        self.assertEqual("not an index", metadata["x-riak-indexer"])
+        self.assertEqual(("text/plain", "e"), (metadata["content-type"], metadata["etag"]))
+        self.assertFalse("x-riak-vclock" in metadata or "x-riak-meta-owner" in metadata)
+
+        headers["x-riak-index-e_int"] = "1, x"
+        self.assertRaises(ValueError, transport._parse_response, (headers, ""), 200)
+        # JSON, but not integers: int() would have none of them either.
+        for value in ("1, 2.5", "1e5", "NaN", "Infinity", "-Infinity", "true", "null",
+                      '"1"', "[1]", "{}"):
+            self.assertRaises(ValueError, transport._parse_index, "e_int", value)
+        self.assertEqual([("e_int", 10 ** 20)], transport._parse_index("e_int", str(10 ** 20)))
+
+    def test_build_request(self):
+        transport = HttpTransport(client_id="me")
+        self.assertEqual("/riak/a+b", transport._build_rest_path("a b"))
+        self.assertEqual("/riak/b/k%2F1", transport._build_rest_path("b", "k/1"))
+        self.assertEqual("/riak/b/k?r=2", transport._build_rest_path("b", "k", {"r": 2}))
+        self.assertEqual("/riak/b", transport._build_rest_path("b", params={}))
+        self.assertEqual("/mapred/b", transport._build_rest_path("b", prefix="mapred"))
+        path = transport._build_rest_path("b", "k", {"w": "a&b", "dw": 1})
+        self.assertTrue(path in ("/riak/b/k?w=a%26b&dw=1", "/riak/b/k?dw=1&w=a%26b"))
+
+        headers = transport.make_put_header("text/plain",
+                                            [("b", "k 1", "t"), ("c", "k", "c")],
+                                            [("f_bin", "x"), ("g_int", 1), ("f_bin", "y")],
+                                            {"m": "v"}, "vc", "gzip")
+        self.assertEqual({"Accept": transport._accept, "X-Riak-ClientId": "me",
+                          "Content-Type": "text/plain", "X-Riak-Vclock": "vc",
+                          "Content-Encoding": "gzip", "X-Riak-Meta-m": "v",
+                          "X-Riak-Index-f_bin": "x, y", "X-Riak-Index-g_int": "1",
+                          "Link": '</riak/b/k+1>; riaktag="t", </riak/c/k>; riaktag="c"'},
+                         headers)
+        headers["Content-Type"] = "changed"
+        self.assertEqual("application/json", transport.make_put_header()["Content-Type"])
+        transport.client_id = "you"
+        self.assertEqual("you", transport.make_put_header()["X-Riak-ClientId"])
+
+        memo = riak2.core.http._Memo(str.upper, 2)
+        self.assertEqual(["A", "B", "C"], [memo["a"], memo["b"], memo["c"]])
+        self.assertEqual({"c": "C"}, dict(memo)) # Forgot everything when full.
+
+
+class StreamTest(unittest.TestCase):
+    def test_json_stream_decoder(self):
+        data = '{"keys":["a","b"]}\n{"keys":[]} {"keys":["c"]}'
+        for size in (1, 3, 7, len(data)):
+            decoder = JsonStreamDecoder()
+            values = []
+            for i in xrange(0, len(data), size):
+                values.extend(decoder.feed(data[i:i+size]))
+            decoder.close()
+            self.assertEqual([{"keys": ["a", "b"]}, {"keys": []}, {"keys": ["c"]}], values)
+
+        decoder = JsonStreamDecoder()
+        decoder.feed('{"keys":["a"]}{"keys":[')
+        self.assertRaises(riak2.core.ConnectionError, decoder.close)
+
+    def test_multipart_stream_decoder(self):
+        data = ("\r\n--XyZ\r\nContent-Type: application/json\r\n\r\n[1]"
+                "\r\n--XyZ\r\n\r\nno headers\r\n--XyZ--\r\n")
+        for size in (1, 5, len(data)):
+            decoder = MultipartStreamDecoder("XyZ")
+            parts = []
+            for i in xrange(0, len(data), size):
+                parts.extend(decoder.feed(data[i:i+size]))
+            decoder.close()
+            self.assertEqual([({"content-type": "application/json"}, "[1]"),
+                              ({}, "no headers")], parts)
+
+        decoder = MultipartStreamDecoder("XyZ")
+        decoder.feed(data[:30])
+        self.assertRaises(riak2.core.ConnectionError, decoder.close)
+
+    def test_chunk_reader(self):
+        def chunks():
+            try:
+                yield "abc"
+                yield ""
+                yield "defgh"
+            finally:
+                closed.append(True)
+        closed = []
+        reader = ChunkReader(chunks())
+        self.assertEqual("ab", reader.read(2))
+        self.assertEqual("cdef", reader.read(4))
+        self.assertEqual(["gh"], list(reader))
+        self.assertEqual("", reader.read(1))
+        self.assertEqual([True], closed)
+
+        buf = bytearray(4)
+        with ChunkReader(chunks()) as reader:
+            self.assertEqual(4, reader.readinto(buf))
+            self.assertEqual("abcd", str(buf))
+        self.assertEqual([True, True], closed)
+        self.assertRaises(ValueError, reader.read, 1)
+
+    def test_file_body(self):
+        with tempfile.TemporaryFile() as f:
+            f.write("0123456789")
+            f.seek(3)
+            body = FileBody(f, chunk_size=4)
+            self.assertEqual(7, body.length)
+            for i in xrange(2): # Rewound every time
+                sent = []
+                self.assertEqual(7, body.send(lambda data: sent.append(str(bytearray(data)))))
+                self.assertEqual(["3456", "789"], sent)
+
+        read, write = os.pipe()
+        os.write(write, "0123456789")
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            body = FileBody(pipe, chunk_size=8)
+            self.assertFalse(body.seekable)
+            sent = []
+            self.assertEqual(10, body.send(lambda data: sent.append(str(bytearray(data)))))
+            self.assertEqual("8\r\n01234567\r\n2\r\n89\r\n0\r\n\r\n", "".join(sent))
+
+
+class DummyConnection(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+class PickFirst(object):
+    def select(self, hosts):
+        return hosts[0]
+
+class ConnectionManagerTest(unittest.TestCase):
+    def test_reuses_connections(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1)])
+        with cm.withconn() as conn:
+            pass
+        with cm.withconn() as conn2:
+            self.assertTrue(conn is conn2)
+        self.assertEqual(1, cm.size())
+
+    def test_max_connections_blocks_and_times_out(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1)], max_connections=2)
+        conns = [cm.take(), cm.take()]
+        self.assertEqual(2, cm.size("a", 1))
+        self.assertRaises(PoolTimeout, cm.take, 0.05)
+
+        # A giveback from another thread wakes up the waiter.
+        timer = threading.Timer(0.05, cm.giveback, [conns[0]])
+        timer.start()
+        self.assertTrue(cm.take(2) is conns[0])
+        timer.join()
+        self.assertEqual(2, cm.size())
+
+    def test_spills_to_next_host(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)], max_connections=1)
+        hosts = set(cm.take().host for i in xrange(2))
+        self.assertEqual({"a", "b"}, hosts)
+
+    def test_idle_connections_are_reaped(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1)], idle_timeout=0.01)
+        conn = cm.take()
+        cm.giveback(conn)
+        time.sleep(0.02)
+        self.assertEqual(1, cm.reap())
+        self.assertEqual(1, conn.closed)
+        self.assertEqual(0, cm.size())
+        self.assertFalse(cm.take() is conn)
+
+    def test_remove_hostport(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)])
+        borrowed = cm.take()
+        cm.remove_hostport(borrowed.host)
+        cm.giveback(borrowed)
+        self.assertEqual(1, borrowed.closed)
+        for i in xrange(3):
+            with cm.withconn() as conn:
+                self.assertNotEqual(borrowed.host, conn.host)
+
+    def test_round_robin(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2), ("c", 3)])
+        conns = [cm.take() for i in xrange(6)]
+        self.assertEqual(["a", "b", "c"] * 2, [c.host for c in conns])
+        self.assertEqual([2, 2, 2], [h.inflight for h in cm.hosts])
+        for conn in conns:
+            cm.giveback(conn)
+        self.assertEqual([0, 0, 0], [h.inflight for h in cm.hosts])
+
+    def test_least_outstanding(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)],
+                               selector=LeastOutstanding())
+        a = cm.take()
+        for i in xrange(3):
+            with cm.withconn() as conn:
+                self.assertEqual("b", conn.host)
+        cm.giveback(a)
+
+    def test_latency_weighted(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)],
+                               selector=LatencyWeighted())
+        slow, fast = cm.hosts
+        slow.latency = 1.0
+        fast.latency = 0.01
+        with cm.withconn() as conn:
+            self.assertEqual("b", conn.host)
+        self.assertTrue(fast.latency < 0.01)
+
+    def test_hosts_without_idle_connections_get_traffic(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1)])
+        with cm.withconn():
+            pass
+        cm.add_hostport("b", 2)
+        hosts = []
+        for i in xrange(100):
+            with cm.withconn() as conn:
+                hosts.append(conn.host)
+        self.assertEqual(50, hosts.count("b"))
+
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("a", 1)], selector=LeastOutstanding())
+        cm.add_hostport("b", 2)
+        held = cm.take()
+        with cm.withconn() as conn: # a still has an idle one, b is picked.
+            self.assertEqual("b", conn.host)
+        cm.giveback(held)
+
+        cm = ConnectionManager(DummyConnection, [("a", 1)], selector=LatencyWeighted())
+        cm.hosts[0].latency = 0.01
+        cm.add_hostport("b", 2)
+        with cm.withconn() as conn:
+            self.assertEqual("b", conn.host)
+        self.assertEqual(1, len(cm.hosts[1].idle)) # Measured, and back in the fast path.
+
+    def test_full_host_borrows_from_others(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)], max_connections=1,
+                               selector=PickFirst())
+        held = cm.take()
+        self.assertEqual("a", held.host)
+        with cm.withconn() as conn: # a is picked again, but it's full.
+            self.assertEqual("b", conn.host)
+        cm.giveback(held)
+
+    def test_circuit_breaker(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)],
+                               max_failures=2, eject_for=0.05)
+        a, b = cm.hosts
+        conn = cm.take()
+        cm.report_failure(conn)
+        self.assertTrue(a.healthy)
+        cm.report_failure(conn)
+        self.assertFalse(a.healthy)
+        cm.giveback(conn)
+        for i in xrange(4):
+            with cm.withconn() as conn:
+                self.assertEqual("b", conn.host)
+
+        # Back on probation once the window is over. One failure is enough.
+        time.sleep(0.06)
+        self.assertEqual({"a", "b"}, set(cm.take().host for i in xrange(2)))
+        cm.report_failure(DummyConnection("a", 1))
+        self.assertFalse(a.healthy)
+        self.assertEqual(2, a.ejections)
+
+        cm.report_success(DummyConnection("a", 1))
+        self.assertTrue(a.healthy)
+        self.assertEqual(0, a.failures)
+
+    def test_exclude(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1), ("b", 2)])
+        for i in xrange(3):
+            with cm.withconn(exclude=[("a", 1)]) as conn:
+                self.assertEqual("b", conn.host)
+        with cm.withconn(exclude=[("a", 1), ("b", 2)]) as conn:
+            pass # Better than nothing
+
+    def test_all_hosts_ejected(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1)])
+        cm.eject(cm.hosts[0])
+        with cm.withconn() as conn:
+            self.assertEqual("a", conn.host)
+
+    def test_health_checks(self):
+        server = FakePbcServer().start()
+        dead = socket.socket()
+        dead.bind(("127.0.0.1", 0))
+        dead_port = dead.getsockname()[1]
+        dead.close()
+
+        cm = ConnectionManager(PbcConnection, [(server.host, server.port),
+                                               ("127.0.0.1", dead_port)],
+                               eject_for=0.01)
+        alive, down = cm.hosts
+        cm.eject(alive)
+        cm.eject(down)
+        cm.start_health_checks(PbcTransport(cm), interval=0.01)
+        try:
+            for i in xrange(100):
+                if alive.healthy:
+                    break
+                time.sleep(0.01)
+            self.assertTrue(alive.healthy)
+            self.assertFalse(down.healthy)
+        finally:
+            cm.stop_health_checks()
+            server.stop()
+
+    def test_recovered_host_gets_traffic(self):
+        servers = [FakePbcServer().start(), FakePbcServer().start()]
+        try:
+            cm = ConnectionManager(PbcConnection, [(s.host, s.port) for s in servers])
+            collector = HistogramCollector()
+            transport = PbcTransport(cm, instrument=collector)
+            for i in xrange(10): # Both warm.
+                transport.ping()
+            first, second = ["%s:%s" % h.hostport for h in cm.hosts]
+
+            cm.eject(cm.hosts[0])
+            collector.reset()
+            for i in xrange(10):
+                transport.ping()
+            self.assertEqual([second], collector.stats()["ping"]["hosts"].keys())
+
+            cm.mark_healthy(cm.hosts[0])
+            collector.reset()
+            for i in xrange(100):
+                transport.ping()
+            hosts = collector.stats()["ping"]["hosts"]
+            self.assertEqual((50, 50), (hosts[first]["count"], hosts[second]["count"]))
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_threads(self):
+        cm = ConnectionManager(DummyConnection, [("a", 1)], max_connections=4)
+        def work():
+            for i in xrange(200):
+                with cm.withconn(5):
+                    pass
+        threads = [threading.Thread(target=work) for i in xrange(16)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertTrue(cm.size() <= 4)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)